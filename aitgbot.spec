@@ -15,11 +15,31 @@ a = Analysis(
         'db',
         'paths',
         'version',
+        'ai_config',
+        'sender',
+        'startup_audit',
+        'profiling',
+        'tracing',
+        'dashboard_feed',
+        'documents',
+        'job_queue',
+        'knowledge',
+        'maintenance',
+        'media_cache',
+        'tenants',
         'services',
         'services.base',
         'services.router',
         'services.lm_studio',
         'services.ollama',
+        'services.lifecycle',
+        'services.fallback',
+        'services.batching',
+        'services.registry',
+        'services.openai_compat',
+        'services.tokens',
+        'services.summarize',
+        'services.semantic_cache',
         'uvicorn',
         'uvicorn.logging',
         'uvicorn.loops',
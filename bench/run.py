@@ -0,0 +1,203 @@
+"""End-to-end benchmark: synthetic Telegram updates through the real Dispatcher against a stub LLM.
+
+Nothing touches the network. Bot API calls are answered by a stub session, the configured
+provider points at a local stub server, and the database is a throwaway file.
+
+    python bench/run.py --messages 500 --users 50 --provider ollama --token-latency-ms 10 --slots 4
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), "src"))
+sys.path.insert(0, BENCH_DIR)
+
+from stub_llm import StubConfig, StubLLMServer  # noqa: E402
+from stub_telegram import StubSession, make_bot, text_update  # noqa: E402
+
+BENCH_TOKEN = "123456:BENCHBENCHBENCHBENCHBENCHBENCHBENCH"
+MODEL = "stub-model"
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class DBCounter:
+    """Counts connections and SQL statements made through db.get_connection."""
+
+    def __init__(self):
+        self.connections = 0
+        self.statements = 0
+
+    def install(self, db_module):
+        original = db_module.get_connection
+
+        def counted_connection():
+            conn = original()
+            self.connections += 1
+            conn.set_trace_callback(self._trace)
+            return conn
+
+        db_module.get_connection = counted_connection
+
+    def _trace(self, statement: str):
+        self.statements += 1
+
+    def reset(self):
+        self.connections = 0
+        self.statements = 0
+
+
+class LagProbe:
+    """Measures how late a periodic timer fires, i.e. how long the event loop was blocked."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - start - self.interval))
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+
+
+def configure(db, args, server: StubLLMServer):
+    db.set_config('bot_token', BENCH_TOKEN)
+    db.set_config('webui_password', 'bench-admin')
+    db.set_config('model', MODEL)
+    db.set_config('request_timeout', args.timeout)
+    db.set_config('batching_enabled', args.batching)
+    if args.provider == 'ollama':
+        db.set_config('ai_provider', 'ollama')
+        db.set_config('ollama_url', server.ollama_url)
+    elif args.provider == 'lm_studio':
+        db.set_config('ai_provider', 'lm_studio')
+        db.set_config('lm_studio_url', server.openai_url)
+    else:
+        db.set_config('openai_endpoints', f"bench {server.openai_url} {args.slots * 2}")
+        db.set_config('ai_provider', 'bench')
+    for user_id in range(1, args.users + 1):
+        db.add_user(1000 + user_id, f"user{user_id}")
+
+
+async def run(args) -> Dict[str, float]:
+    data_dir = tempfile.mkdtemp(prefix="aitgbot-bench-")
+    import db
+    import tracing
+    db.DB_PATH = os.path.join(data_dir, "bench.db")
+    tracing.TRACE_PATH = os.path.join(data_dir, "traces.jsonl")
+
+    server = StubLLMServer(StubConfig(tokens=args.tokens, token_latency=args.token_latency_ms / 1000.0,
+                                      prompt_latency=args.prompt_latency_ms / 1000.0, slots=args.slots))
+    await server.start()
+    configure(db, args, server)
+
+    import bot as bot_module
+    import sender
+    # Telegram's per-chat pacing would dominate latency; benchmark the bot, not the API limits
+    pipeline = sender.get_send_pipeline()
+    pipeline.chat_rate = args.send_rate
+    pipeline.global_rate = max(args.send_rate, sender.GLOBAL_RATE)
+
+    session = StubSession(api_latency=args.api_latency_ms / 1000.0)
+    tg_bot = make_bot(session, BENCH_TOKEN)
+    await bot_module.prepare_model(MODEL)
+
+    counter = DBCounter()
+    counter.install(db)
+    lag = LagProbe()
+    lag.start()
+    server.stats.tokens = 0
+
+    latencies: List[float] = []
+    per_user = [args.messages // args.users + (1 if i < args.messages % args.users else 0)
+                for i in range(args.users)]
+
+    async def user_session(user_id: int, count: int):
+        for i in range(count):
+            reply = session.wait_for_message(user_id)
+            start = time.perf_counter()
+            await bot_module.dp.feed_update(tg_bot, text_update(user_id, f"Question {i} from {user_id}"))
+            await asyncio.wait_for(reply, args.timeout + 5)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[user_session(1000 + i + 1, n) for i, n in enumerate(per_user) if n])
+    elapsed = time.perf_counter() - start
+    lag.stop()
+    # Close the bot's pooled connections first, so the server's handlers end cleanly
+    await bot_module.get_router().close()
+    await server.stop()
+
+    messages = len(latencies)
+    return {
+        "messages": messages,
+        "elapsed_s": elapsed,
+        "throughput_msg_s": messages / elapsed if elapsed else 0.0,
+        "throughput_tok_s": server.stats.tokens / elapsed if elapsed else 0.0,
+        "latency_p50_ms": percentile(latencies, 50) * 1000,
+        "latency_p95_ms": percentile(latencies, 95) * 1000,
+        "latency_p99_ms": percentile(latencies, 99) * 1000,
+        "loop_lag_p50_ms": percentile(lag.samples, 50) * 1000,
+        "loop_lag_p99_ms": percentile(lag.samples, 99) * 1000,
+        "loop_lag_max_ms": max(lag.samples, default=0.0) * 1000,
+        "db_connections_per_msg": counter.connections / messages if messages else 0.0,
+        "db_statements_per_msg": counter.statements / messages if messages else 0.0,
+        "backend_max_parallel": server.stats.max_active,
+        "backend_cancelled": server.stats.cancelled,
+        "traces_recorded": len(tracing.recent_traces(tracing.RING_SIZE)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="aitgbot end-to-end benchmark")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--provider", choices=["ollama", "lm_studio", "openai_compat"], default="ollama")
+    parser.add_argument("--tokens", type=int, default=32, help="tokens generated per reply")
+    parser.add_argument("--token-latency-ms", type=float, default=10.0)
+    parser.add_argument("--prompt-latency-ms", type=float, default=30.0)
+    parser.add_argument("--slots", type=int, default=4, help="parallel decode slots of the stub backend")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="simulated Bot API latency")
+    parser.add_argument("--send-rate", type=float, default=1000.0, help="per-chat send rate limit (msg/s)")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--batching", action="store_true")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = asyncio.run(run(args))
+
+    print(f"aitgbot benchmark: {args.messages} messages, {args.users} users, provider {args.provider}")
+    print("-" * 60)
+    for key, value in results.items():
+        print(f"{key:<26} {value:12.2f}" if isinstance(value, float) else f"{key:<26} {value:12d}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+"""Stub LLM server speaking enough of the Ollama and OpenAI-compatible APIs for benchmarking.
+
+Emulates prompt processing time, per-token latency and a limited number of parallel decode
+slots, and stops generating when the client disconnects, like the real backends.
+
+    python bench/stub_llm.py --port 11500 --tokens 64 --token-latency-ms 15 --slots 4
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import re
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional, Set
+
+# Bag-of-words vectors: texts sharing words get similar embeddings, which is all retrieval needs here
+EMBED_DIM = 64
+
+
+@dataclass
+class StubConfig:
+    tokens: int = 64
+    token_latency: float = 0.015
+    prompt_latency: float = 0.05
+    slots: int = 4
+    context_length: int = 8192
+
+
+@dataclass
+class StubStats:
+    requests: int = 0
+    completed: int = 0
+    cancelled: int = 0
+    tokens: int = 0
+    max_active: int = 0
+    embeddings: int = 0
+    active: int = field(default=0, repr=False)
+
+
+class StubLLMServer:
+    def __init__(self, config: Optional[StubConfig] = None, host: str = "127.0.0.1", port: int = 0):
+        self.config = config or StubConfig()
+        self.host = host
+        self.port = port
+        self.stats = StubStats()
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        # Handlers of open (keep-alive) connections, closed by stop()
+        self._connections: Set[asyncio.Task] = set()
+
+    @property
+    def ollama_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def openai_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    async def start(self):
+        self._slots = asyncio.Semaphore(self.config.slots)
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            # Pooled clients keep idle connections open: end their handlers, or they die with the loop
+            for task in self._connections:
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = b""
+                if "content-length" in headers:
+                    body = await reader.readexactly(int(headers["content-length"]))
+                payload = json.loads(body) if body else {}
+                await self._route(method, path, payload, writer)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # Only stop() cancels handlers; finishing normally keeps asyncio from logging it
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _route(self, method: str, path: str, payload: dict, writer: asyncio.StreamWriter):
+        model = payload.get("model", "stub-model")
+        if path == "/api/tags":
+            await self._json(writer, {"models": [{"name": "stub-model"}]})
+        elif path == "/v1/models":
+            await self._json(writer, {"data": [{"id": "stub-model", "object": "model",
+                                                "max_model_len": self.config.context_length}]})
+        elif path == "/api/show":
+            await self._json(writer, {"capabilities": ["completion"],
+                                      "model_info": {"llama.context_length": self.config.context_length}})
+        elif path.startswith("/api/v0/models/"):
+            await self._json(writer, {"id": model, "type": "llm", "max_context_length": self.config.context_length})
+        elif path == "/api/generate":
+            await self._json(writer, {"model": model, "response": "", "done": True, "load_duration": 0})
+        elif path == "/api/chat":
+            await self._generate(writer, payload, ollama=True)
+        elif path == "/v1/chat/completions":
+            await self._generate(writer, payload, ollama=False)
+        elif path == "/api/embed":
+            await self._json(writer, {"model": model, "embeddings": self._embed(payload.get("input", []))})
+        elif path == "/v1/embeddings":
+            vectors = self._embed(payload.get("input", []))
+            await self._json(writer, {"object": "list", "model": model, "data": [
+                {"object": "embedding", "index": i, "embedding": v} for i, v in enumerate(vectors)]})
+        else:
+            await self._json(writer, {"error": f"not found: {method} {path}"}, status="404 Not Found")
+
+    def _embed(self, texts) -> List[List[float]]:
+        self.stats.embeddings += 1
+        vectors = []
+        for text in [texts] if isinstance(texts, str) else texts:
+            vector = [0.0] * EMBED_DIM
+            for word in re.findall(r"\w+", text.lower()):
+                vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % EMBED_DIM] += 1.0
+            vectors.append(vector)
+        return vectors
+
+    async def _json(self, writer: asyncio.StreamWriter, data: dict, status: str = "200 OK"):
+        body = json.dumps(data).encode()
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+
+    async def _generate(self, writer: asyncio.StreamWriter, payload: dict, ollama: bool):
+        self.stats.requests += 1
+        model = payload.get("model", "stub-model")
+        stream = payload.get("stream", ollama)
+        limit = payload.get("max_tokens") or self.config.tokens
+        tokens = [f"tok{i} " for i in range(min(limit, self.config.tokens))]
+        prompt_chars = sum(len(str(m.get("content", ""))) for m in payload.get("messages", []))
+        prompt_tokens = max(1, prompt_chars // 4)
+        started = time.perf_counter()
+
+        async with self._slots:
+            self.stats.active += 1
+            self.stats.max_active = max(self.stats.max_active, self.stats.active)
+            try:
+                await asyncio.sleep(self.config.prompt_latency)
+                if not stream:
+                    await asyncio.sleep(self.config.token_latency * len(tokens))
+                    self.stats.tokens += len(tokens)
+                    self.stats.completed += 1
+                    if ollama:
+                        data = {"model": model, "message": {"role": "assistant", "content": "".join(tokens)},
+                                "done": True, "prompt_eval_count": prompt_tokens, "eval_count": len(tokens)}
+                    else:
+                        data = {"id": "stub", "object": "chat.completion", "created": int(time.time()),
+                                "model": model,
+                                "choices": [{"index": 0, "finish_reason": "stop",
+                                             "message": {"role": "assistant", "content": "".join(tokens)}}],
+                                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                                          "total_tokens": prompt_tokens + len(tokens)}}
+                    await self._json(writer, data)
+                    return
+
+                content_type = "application/x-ndjson" if ollama else "text/event-stream"
+                writer.write(f"HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\n"
+                             f"Transfer-Encoding: chunked\r\n\r\n".encode())
+                for token in tokens:
+                    await asyncio.sleep(self.config.token_latency)
+                    if ollama:
+                        event = {"model": model, "message": {"role": "assistant", "content": token}, "done": False}
+                        line = json.dumps(event) + "\n"
+                    else:
+                        event = {"id": "stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                                 "model": model,
+                                 "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+                        line = f"data: {json.dumps(event)}\n\n"
+                    await self._chunk(writer, line)
+                    self.stats.tokens += 1
+
+                elapsed_ns = int((time.perf_counter() - started) * 1e9)
+                if ollama:
+                    final = {"model": model, "message": {"role": "assistant", "content": ""}, "done": True,
+                             "prompt_eval_count": prompt_tokens, "eval_count": len(tokens),
+                             "total_duration": elapsed_ns, "load_duration": 0,
+                             "prompt_eval_duration": int(self.config.prompt_latency * 1e9),
+                             "eval_duration": int(self.config.token_latency * len(tokens) * 1e9)}
+                    await self._chunk(writer, json.dumps(final) + "\n")
+                else:
+                    usage = {"id": "stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                             "model": model, "choices": [],
+                             "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                                       "total_tokens": prompt_tokens + len(tokens)}}
+                    await self._chunk(writer, f"data: {json.dumps(usage)}\n\ndata: [DONE]\n\n")
+                writer.write(b"0\r\n\r\n")
+                await writer.drain()
+                self.stats.completed += 1
+            except (ConnectionError, asyncio.CancelledError):
+                # The client went away: stop generating, like Ollama / LM Studio do
+                self.stats.cancelled += 1
+                raise ConnectionResetError()
+            finally:
+                self.stats.active -= 1
+
+    async def _chunk(self, writer: asyncio.StreamWriter, text: str):
+        data = text.encode()
+        writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+        await writer.drain()
+
+
+async def _serve(args):
+    server = StubLLMServer(StubConfig(tokens=args.tokens, token_latency=args.token_latency_ms / 1000.0,
+                                      prompt_latency=args.prompt_latency_ms / 1000.0, slots=args.slots),
+                           port=args.port)
+    await server.start()
+    print(f"Stub LLM listening: Ollama {server.ollama_url}, OpenAI-compatible {server.openai_url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=11500)
+    parser.add_argument("--tokens", type=int, default=64)
+    parser.add_argument("--token-latency-ms", type=float, default=15.0)
+    parser.add_argument("--prompt-latency-ms", type=float, default=50.0)
+    parser.add_argument("--slots", type=int, default=4)
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
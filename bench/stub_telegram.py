@@ -0,0 +1,85 @@
+"""Offline stand-in for the Telegram Bot API and helpers to build synthetic updates."""
+import asyncio
+import itertools
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional
+
+from aiogram import Bot, methods, types
+from aiogram.client.session.base import BaseSession
+
+_ids = itertools.count(1)
+
+
+class StubSession(BaseSession):
+    """Answers Bot API calls locally and records every outgoing message."""
+
+    def __init__(self, api_latency: float = 0.0, file_content: bytes = b""):
+        super().__init__()
+        self.api_latency = api_latency
+        self.file_content = file_content
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.sent: List[tuple] = []
+        self._waiters: Dict[int, List[asyncio.Future]] = defaultdict(list)
+
+    def wait_for_message(self, chat_id: int) -> asyncio.Future:
+        """Future resolved with the text of the next message sent to chat_id."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id].append(future)
+        return future
+
+    async def make_request(self, bot: Bot, method: methods.TelegramMethod, timeout: Optional[int] = None) -> Any:
+        self.calls[type(method).__name__] += 1
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+
+        if isinstance(method, (methods.SendMessage, methods.EditMessageText)):
+            self.sent.append((method.chat_id, method.text, time.perf_counter()))
+            for waiter in self._waiters.pop(method.chat_id, []):
+                if not waiter.done():
+                    waiter.set_result(method.text)
+            return types.Message(
+                message_id=next(_ids),
+                date=datetime.now(),
+                chat=types.Chat(id=method.chat_id, type="private"),
+                text=method.text,
+            )
+        if isinstance(method, methods.GetMe):
+            return types.User(id=bot.id, is_bot=True, first_name="Bench Bot", username="bench_bot")
+        if isinstance(method, methods.GetFile):
+            return types.File(file_id=method.file_id, file_unique_id=method.file_id,
+                              file_size=len(self.file_content), file_path=f"files/{method.file_id}")
+        return True
+
+    async def stream_content(self, url: str, headers: Optional[Dict[str, Any]] = None, timeout: int = 30,
+                             chunk_size: int = 65536, raise_for_status: bool = True) -> AsyncGenerator[bytes, None]:
+        for i in range(0, len(self.file_content), chunk_size):
+            yield self.file_content[i:i + chunk_size]
+
+    async def close(self):
+        pass
+
+
+def text_update(user_id: int, text: str, username: Optional[str] = None) -> types.Update:
+    update_id = next(_ids)
+    user = types.User(id=user_id, is_bot=False, first_name=username or f"user{user_id}",
+                      username=username or f"user{user_id}")
+    return types.Update(
+        update_id=update_id,
+        message=types.Message(
+            message_id=update_id,
+            date=datetime.now(),
+            chat=types.Chat(id=user_id, type="private"),
+            from_user=user,
+            text=text,
+        ),
+    )
+
+
+def make_bot(session: StubSession, token: str = "123456:BENCHBENCHBENCHBENCHBENCHBENCHBENCH") -> Bot:
+    return Bot(token=token, session=session)
+
+
+def count_calls(session: StubSession, predicate: Callable[[str], bool] = lambda name: True) -> int:
+    return sum(n for name, n in session.calls.items() if predicate(name))
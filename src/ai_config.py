@@ -0,0 +1,49 @@
+from dataclasses import asdict
+
+import db
+from services import get_router, get_model_manager, build_fallback_policy
+from services.registry import OPENAI_COMPAT, get_registry, parse_endpoints
+
+
+def configure_router():
+    """Apply the saved AI settings to the shared router; cheap to call on every request."""
+    registry = get_registry()
+    registry.register_from_config(db.get_config('provider_plugins', ''))
+
+    router = get_router()
+
+    # Configure providers based on saved settings
+    lm_studio_url = db.get_config('lm_studio_url', 'http://127.0.0.1:1234/v1')
+    ollama_url = db.get_config('ollama_url', 'http://127.0.0.1:11434')
+    keep_alive = db.get_config('keep_alive', '-1')
+
+    router.configure_provider('lm_studio', base_url=lm_studio_url, keep_alive=keep_alive)
+    router.configure_provider('ollama', base_url=ollama_url, keep_alive=keep_alive,
+                              num_ctx=db.get_config('ollama_num_ctx', ''))
+
+    # Each OpenAI-compatible endpoint (llama.cpp server, vLLM, ...) becomes its own provider
+    for endpoint in parse_endpoints(db.get_config('openai_endpoints', '')):
+        name = endpoint.pop('name')
+        registry.register(name, OPENAI_COMPAT)
+        router.configure_provider(name, **endpoint)
+
+    router.set_current_provider(db.get_config('ai_provider', 'lm_studio'))
+    router.set_fallback_policy(build_fallback_policy(
+        db.get_config('fallback_chain', ''),
+        timeout=db.get_config('fallback_timeout', 60),
+        hedge_after_ms=db.get_config('hedge_after_ms', 0)
+    ))
+    return router
+
+
+def _record_load(record):
+    db.set_metric('model_load', asdict(record))
+
+
+async def prepare_model(model_id):
+    """Load the model on the backend and cache its capabilities, recording both for the dashboard."""
+    router = configure_router()
+    manager = get_model_manager(on_load=_record_load)
+    await manager.schedule_warm_up(model_id)
+    capabilities = await router.get_capabilities(model_id)
+    db.set_metric('model_capabilities', {'model': model_id, **asdict(capabilities)})
@@ -3,13 +3,29 @@ import logging
 import os
 import base64
 import io
-from aiogram import Bot, Dispatcher, types
+import time
+from aiogram import Bot, Dispatcher, F, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import CommandStart, Command
 
 import db
+import documents
+import job_queue
+import knowledge
+import media_cache
 import paths
-from services import get_router
+import profiling
+import tenants
+import tracing
+from sender import get_send_pipeline
+from ai_config import configure_router, prepare_model as load_model_and_capabilities
+from services import get_router, get_batch_dispatcher
 from services.base import Message
+from services.semantic_cache import CacheEntry, DEFAULT_CAPACITY, DEFAULT_THRESHOLD, get_semantic_cache, scope_id
+from services.summarize import DEFAULT_CONCURRENCY, DocumentTooLargeError, MapReduceSummarizer
+from services.tokens import PromptTooLongError, fit_to_context
+from tenants import Tenant
 
 logger = logging.getLogger(__name__)
 
@@ -21,62 +37,445 @@ if not TOKEN:
 WEBUI_PASSWORD = db.get_config('webui_password', 'admin')
 
 dp = Dispatcher()
-bot = Bot(token=TOKEN)
 
+# Bots being served by ID, for job queue workers to reply through
+_bots = {}
 
-def get_access_password():
-    return db.get_config('access_password', 'secret')
+# Generation handler task per (chat_id, user_id), so a newer message can cancel a stale one
+_generations = {}
+_superseded = set()
+
+# Live counters for the WebUI dashboard, published through the metrics collection
+ACTIVITY_INTERVAL = 2.0
+_activity = {'in_flight': 0, 'completed': 0, 'failed': 0, 'completion_tokens': 0}
+# The same counters per hosted bot, to see which one uses the shared backends
+_bot_activity = {}
+
+# A document takes one model call per part, so it gets more time than a single message
+DOCUMENT_TIMEOUT = 600
+
+USERS_PAGE_SIZE = 20
+
+
+@dp.message.outer_middleware()
+async def trace_message(handler, event: types.Message, data):
+    """Trace every incoming message; the spans below it show where its time went."""
+    kind = "photo" if event.photo else "document" if event.document else "command" if (event.text or "").startswith("/") else "text"
+    user_id = event.from_user.id if event.from_user else None
+    with tracing.start_trace("telegram.message", chat_id=event.chat.id, user_id=user_id, kind=kind) as span:
+        # Handlers get the tenant of the bot that received the message as their `tenant` argument
+        with tracing.span("tenant"):
+            tenant = tenants.get_tenant(event.bot.id)
+        if tenant is None:
+            logger.warning(f"Ignoring update for bot {event.bot.id}: it is no longer hosted")
+            return None
+        data["tenant"] = tenant
+        span.set(bot=tenant.name)
+        return await handler(event, data)
+
+
+@dp.callback_query.outer_middleware()
+async def trace_callback(handler, event: types.CallbackQuery, data):
+    with tracing.start_trace("telegram.callback", user_id=event.from_user.id, data=event.data) as span:
+        with tracing.span("tenant"):
+            tenant = tenants.get_tenant(event.bot.id)
+        if tenant is None:
+            logger.warning(f"Ignoring update for bot {event.bot.id}: it is no longer hosted")
+            return None
+        data["tenant"] = tenant
+        span.set(bot=tenant.name)
+        return await handler(event, data)
+
+
+def get_access_password(tenant: Tenant):
+    return tenant.get_config('access_password', 'secret')
+
+
+def reply(message: types.Message, text: str, **kwargs):
+    """Queue a reply through the send pipeline, split to Telegram's size limit, without waiting for it."""
+    if message.is_topic_message and message.message_thread_id:
+        kwargs.setdefault('message_thread_id', message.message_thread_id)
+    return get_send_pipeline().send(message.bot, message.chat.id, text, **kwargs)
+
+
+def reply_to_job(bot: Bot, payload: dict, text: str):
+    kwargs = {'message_thread_id': payload['thread_id']} if payload.get('thread_id') else {}
+    return get_send_pipeline().send(bot, payload['chat_id'], text, **kwargs)
+
+
+def get_deadline():
+    try:
+        timeout = float(db.get_config('request_timeout', 120))
+    except (TypeError, ValueError):
+        timeout = 120.0
+    return time.monotonic() + timeout
+
+
+def supersede_generation(key):
+    """Register the current task for key and cancel the previous one when superseding is enabled."""
+    previous = _generations.get(key)
+    if previous and not previous.done() and db.get_config('supersede_stale', False):
+        _superseded.add(previous)
+        previous.cancel()
+    _generations[key] = asyncio.current_task()
+
+
+def batching_enabled():
+    return bool(db.get_config('batching_enabled', False))
+
+
+def _record_parallelism(provider_name, model_id, parallelism):
+    # One entry per provider/model: hosted bots serve their own models side by side
+    probed = db.get_metric('batch_parallelism_by_model') or {}
+    probed[f"{provider_name}/{model_id}"] = parallelism
+    db.set_metric('batch_parallelism_by_model', probed)
+
+
+def configure_dispatcher():
+    dispatcher = get_batch_dispatcher(on_probe=_record_parallelism)
+    try:
+        dispatcher.configure(
+            window=float(db.get_config('batch_window_ms', 20)) / 1000.0,
+            max_parallelism=int(db.get_config('batch_max_parallel', 8))
+        )
+    except (TypeError, ValueError):
+        pass
+    return dispatcher
+
+
+async def probe_parallelism(model_id):
+    """Discover the backend's best degree of parallelism for a loaded model."""
+    await configure_dispatcher().probe(model_id)
+
+
+async def prepare_model(model_id):
+    """Load the model, then cache its capabilities and (with batching) its best parallelism."""
+    await load_model_and_capabilities(model_id)
+    if batching_enabled():
+        await probe_parallelism(model_id)
+
+
+async def prepare_models(model_ids):
+    # One after the other, so the models do not compete for backend memory while loading
+    for model_id in model_ids:
+        try:
+            await prepare_model(model_id)
+        except Exception as e:
+            logger.warning(f"Preparing {model_id} failed: {e}")
+
+
+async def generate(router, messages, model_name, deadline, tenant: Tenant):
+    batching = batching_enabled()
+    counters = (_activity, _bot_activity.setdefault(tenant.name, {key: 0 for key in _activity}))
+    for activity in counters:
+        activity['in_flight'] += 1
+    try:
+        with tracing.span("generate", model=model_name, batching=batching):
+            if batching:
+                response = await configure_dispatcher().submit(messages, model_name, deadline=deadline)
+            else:
+                response = await router.chat(messages, model=model_name, deadline=deadline)
+    except Exception:
+        for activity in counters:
+            activity['failed'] += 1
+        raise
+    finally:
+        for activity in counters:
+            activity['in_flight'] -= 1
+    for activity in counters:
+        activity['completed'] += 1
+        activity['completion_tokens'] += (response.usage or {}).get('completion_tokens', 0)
+    return response
+
+
+async def generate_and_reply(router, message: types.Message, messages, model_name, deadline, tenant: Tenant):
+    """Generate and send the answer, through the job queue when it is enabled.
+
+    Returns the response, or None when the queue gave up on the job (it told the user).
+    """
+    queue = job_queue.get_job_queue()
+    if queue is None or not queue.started:
+        response = await generate(router, messages, model_name, deadline, tenant)
+        reply(message, response.text or "Empty response from AI.")
+        return response
+    thread_id = message.message_thread_id if message.is_topic_message else None
+    with tracing.span("job_queue.submit"):
+        ticket = await queue.submit(f"{message.bot.id}:{message.chat.id}:{message.from_user.id}", {
+            'bot_id': message.bot.id, 'chat_id': message.chat.id, 'thread_id': thread_id,
+            'model': model_name, 'messages': [{'role': m.role, 'content': m.content} for m in messages],
+            'trace_id': tracing.current_trace_id(),
+        })
+    try:
+        with tracing.span("job_queue.wait"):
+            return await queue.wait(ticket)
+    except asyncio.CancelledError:
+        # Superseded by a newer message: the queued or running job goes too
+        await queue.cancel(ticket)
+        raise
+
+
+async def run_job(payload):
+    """Job queue worker: generate the answer to a queued message and send it."""
+    bot = _bots.get(payload['bot_id'])
+    tenant = tenants.get_tenant(payload['bot_id']) if bot else None
+    if tenant is None:
+        logger.warning(f"Dropping job for chat {payload['chat_id']}: bot {payload['bot_id']} is no longer hosted")
+        return None
+    with tracing.start_trace("job", chat_id=payload['chat_id'], message_trace=payload.get('trace_id')):
+        router = configure_router()
+        messages = [Message(role=m['role'], content=m['content']) for m in payload['messages']]
+        # Time spent queued doesn't count: each attempt gets the full timeout
+        response = await generate(router, messages, payload['model'], get_deadline(), tenant)
+    reply_to_job(bot, payload, response.text or "Empty response from AI.")
+    return response
+
+
+async def job_backend_healthy():
+    return await configure_router().health_check()
+
+
+async def job_failed(payload, error):
+    bot = _bots.get(payload['bot_id'])
+    if bot is None:
+        return
+    if isinstance(error, asyncio.TimeoutError):
+        reply_to_job(bot, payload, "Error: the AI took too long to respond. Please try again.")
+    else:
+        reply_to_job(bot, payload, f"Error: {error}")
+
+
+def start_job_queue():
+    """Start the durable job queue when it is enabled. Read once at startup."""
+    if not db.get_config('job_queue_enabled', False):
+        return
+    try:
+        workers = int(db.get_config('job_queue_workers', job_queue.DEFAULT_WORKERS))
+    except (TypeError, ValueError):
+        workers = job_queue.DEFAULT_WORKERS
+    # Jobs left by a previous run are picked up as soon as their leases lapse
+    job_queue.init_job_queue(run_job, job_backend_healthy, job_failed).start(workers)
+
+
+def summarize_concurrency(router, model_name):
+    """Parallel chunk calls the backend can take: its own limit, else the probed batch parallelism."""
+    provider = router.get_provider()
+    if provider and provider.max_concurrency:
+        return provider.max_concurrency
+    probed = db.get_metric('batch_parallelism_by_model') or {}
+    return probed.get(f"{router.get_current_provider()}/{model_name}", DEFAULT_CONCURRENCY)
+
+
+async def summarize_document(router, message: types.Message, model_name, context_length):
+    """Stream a text document from Telegram and condense it into summaries that fit one prompt."""
+    document = message.document
+    summarizer = MapReduceSummarizer(
+        router, model_name, context_length,
+        concurrency=summarize_concurrency(router, model_name),
+        deadline=time.monotonic() + DOCUMENT_TIMEOUT,
+        cache_get=documents.get_cached_summary, cache_set=documents.set_cached_summary,
+        # With batching, chunk calls share the dispatcher's admission control with chat messages
+        chat=configure_dispatcher().submit if batching_enabled() else None
+    )
+    with tracing.span("document.summarize", file_size=document.file_size) as span:
+        summaries = await summarizer.summarize_stream(documents.stream_document_text(message.bot, document))
+        summary = await summarizer.reduce(summaries)
+        if span:
+            span.set(chunks=summarizer.chunks, cached=summarizer.cached)
+    await asyncio.to_thread(documents.prune_summary_cache)
+    return summary
+
+
+def configure_semantic_cache():
+    """The response cache, or None when it is disabled."""
+    if not db.get_config('semantic_cache_enabled', False):
+        return None
+    cache = get_semantic_cache()
+    try:
+        cache.configure(capacity=int(db.get_config('semantic_cache_size', DEFAULT_CAPACITY)),
+                        threshold=float(db.get_config('semantic_cache_threshold', DEFAULT_THRESHOLD)))
+    except (TypeError, ValueError):
+        pass
+    return cache
+
+
+def configure_vision_cache():
+    cache = media_cache.get_vision_cache()
+    try:
+        cache.configure(max_bytes=int(float(db.get_config('vision_cache_mb', 64)) * 1024 * 1024))
+    except (TypeError, ValueError):
+        pass
+    return cache
+
+
+async def embed_question(router, text, embedding_model, cache):
+    """Embed a question once for both the response cache and the knowledge base, if either needs it."""
+    if not embedding_model or not text:
+        return None
+    knowledge_base = knowledge.get_knowledge_base()
+    await knowledge_base.refresh()
+    if cache is None and not knowledge_base.usable(embedding_model):
+        return None
+    with tracing.span("embed_question", model=embedding_model):
+        try:
+            return await knowledge.embed_query(router, text, embedding_model)
+        except Exception as e:
+            # Answer without the cache and the knowledge base rather than not at all
+            logger.warning(f"Embedding the question failed: {e}")
+            return None
+
+
+async def add_knowledge(text, vector, embedding_model):
+    """Append the knowledge base passages relevant to text."""
+    try:
+        top_k = int(db.get_config('retrieval_top_k', knowledge.DEFAULT_TOP_K))
+        min_score = float(db.get_config('retrieval_min_score', knowledge.DEFAULT_MIN_SCORE))
+    except (TypeError, ValueError):
+        top_k, min_score = knowledge.DEFAULT_TOP_K, knowledge.DEFAULT_MIN_SCORE
+    with tracing.span("knowledge.search", model=embedding_model) as span:
+        hits = await knowledge.get_knowledge_base().search(vector, embedding_model, top_k, min_score)
+        if span:
+            span.set(hits=len(hits), best=hits[0]['score'] if hits else None)
+    if not hits:
+        return text
+    return f"{text}\n\n{knowledge.format_passages(hits)}"
+
+
+async def publish_activity():
+    """Publish request counters for the WebUI, only when they change (plus a periodic heartbeat)."""
+    last, last_write = None, 0.0
+    while True:
+        queue = job_queue.get_job_queue()
+        jobs = None
+        if queue is not None and queue.started:
+            try:
+                jobs = await queue.stats()
+            except Exception as e:
+                logger.error(f"Failed to read job queue stats: {e}")
+        snapshot = {**_activity, 'pending_sends': get_send_pipeline().pending(), 'job_queue': jobs,
+                    'semantic_cache': get_semantic_cache().stats(),
+                    'vision_cache': media_cache.get_vision_cache().stats(),
+                    'bots': {name: dict(counters) for name, counters in _bot_activity.items()}}
+        if snapshot != last or time.monotonic() - last_write > 30:
+            try:
+                await asyncio.to_thread(db.set_metric, 'bot_activity', {**snapshot, 'updated_at': time.time()})
+                last, last_write = snapshot, time.monotonic()
+            except Exception as e:
+                logger.error(f"Failed to publish activity: {e}")
+        await asyncio.sleep(ACTIVITY_INTERVAL)
 
 @dp.message(CommandStart())
-async def command_start_handler(message: types.Message):
+async def command_start_handler(message: types.Message, tenant: Tenant):
     if not message.from_user:
         return
-    if db.is_user_authorized(message.from_user.id):
+    if db.is_user_authorized(message.from_user.id, tenant.namespace):
         await message.answer("Welcome back! I am ready to chat.")
     else:
         await message.answer("Welcome! This bot is password protected. Please enter the access password.")
 
+def format_user(u):
+    admin_tag = ""
+    if u.get('is_super_admin'):
+        admin_tag = " (Super Admin)"
+    elif u.get('is_admin'):
+        admin_tag = " (Admin)"
+    return f"- {u.get('username') or '-'} (ID: {u['user_id']}){admin_tag}"
+
+
+def users_page(namespace, after=None, before=None):
+    """One page of /users and its navigation buttons.
+
+    Keyset queries and a maintained user count: every page costs the same with 10 users or 100k.
+    """
+    # One extra row tells whether there is a page beyond this one
+    users = db.get_users_page(after, USERS_PAGE_SIZE + 1, namespace, before=before)
+    if before is None:
+        has_prev, has_next = after is not None, len(users) > USERS_PAGE_SIZE
+        users = users[:USERS_PAGE_SIZE]
+    else:
+        has_prev, has_next = len(users) > USERS_PAGE_SIZE, True
+        users = users[-USERS_PAGE_SIZE:]
+    total = db.count_users(namespace)
+    lines = [format_user(u) for u in users] or ["No users on this page."]
+    text = f"Authorized Users ({total}):\n" + "\n".join(lines)
+    # Callback data is limited to 64 bytes: the boundary key is all a page needs
+    buttons = []
+    if has_prev and users:
+        buttons.append(types.InlineKeyboardButton(text="« Prev", callback_data=f"users:p:{users[0]['key']}"))
+    if has_next and users:
+        buttons.append(types.InlineKeyboardButton(text="Next »", callback_data=f"users:n:{users[-1]['key']}"))
+    markup = types.InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    return text, markup
+
+
 @dp.message(Command("users"))
-async def list_users(message: types.Message):
-    if not message.from_user or not db.is_user_admin(message.from_user.id):
-        return
-    users = db.get_users()
-    text = "Authorized Users:\n"
-    for u in users:
-        admin_tag = ""
-        if u.get('is_super_admin'):
-            admin_tag = " (Super Admin)"
-        elif u.get('is_admin'):
-            admin_tag = " (Admin)"
-        text += f"- {u['username']} (ID: {u['user_id']}){admin_tag}\n"
-    await message.answer(text)
+async def list_users(message: types.Message, tenant: Tenant):
+    if not message.from_user or not db.is_user_admin(message.from_user.id, tenant.namespace):
+        return
+    parts = (message.text or "").split(maxsplit=1)
+    query = parts[1].strip().lstrip('@') if len(parts) > 1 else ""
+    if query:
+        users = await asyncio.to_thread(db.find_users, query, USERS_PAGE_SIZE + 1, tenant.namespace)
+        lines = [format_user(u) for u in users[:USERS_PAGE_SIZE]]
+        if len(users) > USERS_PAGE_SIZE:
+            lines.append(f"Showing the first {USERS_PAGE_SIZE} matches, refine the search to see others.")
+        reply(message, "\n".join(lines) if lines else f"No users whose username starts with {query}.")
+        return
+    text, markup = await asyncio.to_thread(users_page, tenant.namespace)
+    reply(message, text, reply_markup=markup)
+
+
+@dp.callback_query(F.data.startswith("users:"))
+async def users_page_callback(callback: types.CallbackQuery, tenant: Tenant):
+    if not db.is_user_admin(callback.from_user.id, tenant.namespace):
+        await callback.answer("Admins only.")
+        return
+    _, direction, key = callback.data.split(":", 2)
+    text, markup = await asyncio.to_thread(
+        users_page, tenant.namespace, after=key if direction == "n" else None, before=key if direction == "p" else None
+    )
+    if callback.message:
+        try:
+            await callback.message.edit_text(text, reply_markup=markup)
+        except TelegramBadRequest:
+            # "message is not modified": the page didn't change since it was sent
+            pass
+    await callback.answer()
+
+def _id_list(ids, limit=20):
+    """Comma-separated IDs, the rest of a long list summarized as a count."""
+    shown = ', '.join(str(i) for i in ids[:limit])
+    return shown if len(ids) <= limit else f"{shown} and {len(ids) - limit} more"
 
 @dp.message(Command("kick"))
-async def kick_user(message: types.Message):
-    if not message.from_user or not db.is_user_admin(message.from_user.id):
+async def kick_user(message: types.Message, tenant: Tenant):
+    if not message.from_user or not db.is_user_admin(message.from_user.id, tenant.namespace):
         return
     if not message.text:
         return
+    args = message.text.replace(',', ' ').split()[1:]
+    if not args:
+        await message.answer("Usage: /kick <user_id> [<user_id> ...]")
+        return
     try:
-        args = message.text.split()
-        if len(args) < 2:
-            await message.answer("Usage: /kick <user_id>")
-            return
-        target_id = int(args[1])
-        if db.is_user_super_admin(target_id):
-            await message.answer("Cannot kick a Super Admin.")
-            return
-        
-        if db.remove_user(target_id):
-            await message.answer(f"User {target_id} kicked out.")
-        else:
-            await message.answer("Failed to kick user.")
+        target_ids = [int(arg) for arg in args]
     except ValueError:
         await message.answer("Invalid user ID.")
+        return
+    # All in one transaction, however many IDs there are
+    result = await asyncio.to_thread(db.kick_users, target_ids, tenant.namespace)
+    lines = []
+    if result['removed']:
+        lines.append(f"User {result['removed'][0]} kicked out." if len(result['removed']) == 1
+                     else f"Kicked out {len(result['removed'])} users: {_id_list(result['removed'])}.")
+    if result['super_admins']:
+        lines.append(f"Cannot kick a Super Admin: {_id_list(result['super_admins'])}.")
+    if result['missing']:
+        lines.append(f"Not found: {_id_list(result['missing'])}.")
+    reply(message, "\n".join(lines))
 
 @dp.message(Command("deadmin"))
-async def deadmin_user(message: types.Message):
-    if not message.from_user or not db.is_user_admin(message.from_user.id):
+async def deadmin_user(message: types.Message, tenant: Tenant):
+    if not message.from_user or not db.is_user_admin(message.from_user.id, tenant.namespace):
         return
     if not message.text:
         return
@@ -87,7 +486,7 @@ async def deadmin_user(message: types.Message):
             return
         target_id = int(args[1])
         
-        if db.make_admin(target_id, is_admin=False):
+        if db.make_admin(target_id, is_admin=False, namespace=tenant.namespace):
             await message.answer(f"User {target_id} is no longer an admin.")
         else:
             await message.answer("Failed: Cannot remove admin privileges from a Super Admin.")
@@ -95,49 +494,41 @@ async def deadmin_user(message: types.Message):
         await message.answer("Invalid user ID.")
 
 @dp.message(Command("invite"))
-async def generate_invite(message: types.Message):
-    if not message.from_user or not db.is_user_admin(message.from_user.id):
+async def generate_invite(message: types.Message, tenant: Tenant):
+    if not message.from_user or not db.is_user_admin(message.from_user.id, tenant.namespace):
         return
-    code = db.create_invite(is_admin_invite=False)
+    code = db.create_invite(is_admin_invite=False, namespace=tenant.namespace)
     await message.answer(f"Generated One-Time Password (User): `{code}`", parse_mode="Markdown")
 
 @dp.message(Command("inviteadmin"))
-async def generate_admin_invite(message: types.Message):
-    if not message.from_user or not db.is_user_admin(message.from_user.id):
+async def generate_admin_invite(message: types.Message, tenant: Tenant):
+    if not message.from_user or not db.is_user_admin(message.from_user.id, tenant.namespace):
         return
-    code = db.create_invite(is_admin_invite=True)
+    code = db.create_invite(is_admin_invite=True, namespace=tenant.namespace)
     await message.answer(f"Generated One-Time Password (Admin): `{code}`", parse_mode="Markdown")
 
 @dp.message(Command("models"))
-async def list_models(message: types.Message):
-    if not message.from_user or not db.is_user_admin(message.from_user.id):
+async def list_models(message: types.Message, tenant: Tenant):
+    if not message.from_user or not db.is_user_admin(message.from_user.id, tenant.namespace):
         return
-    
-    router = get_router()
-    current_provider = db.get_config('ai_provider', 'lm_studio')
-    router.set_current_provider(current_provider)
-    
-    # Configure providers based on saved settings
-    lm_studio_url = db.get_config('lm_studio_url', 'http://127.0.0.1:1234/v1')
-    ollama_url = db.get_config('ollama_url', 'http://127.0.0.1:11434')
-    
-    router.configure_provider('lm_studio', base_url=lm_studio_url)
-    router.configure_provider('ollama', base_url=ollama_url)
-    
+
+    router = configure_router()
+    current_provider = router.get_current_provider()
+
     try:
         models_list = await router.list_models()
         text = f"Available Models ({current_provider.replace('_', ' ').title()}):\n"
-        current = db.get_config('model')
+        current = tenant.get_config('model')
         for m in models_list:
             mark = " [CURRENT]" if m.id == current else ""
             text += f"- `{m.id}`{mark}\n"
-        await message.answer(text, parse_mode="Markdown")
+        reply(message, text, parse_mode="Markdown")
     except Exception as e:
         await message.answer(f"Error fetching models: {e}")
 
 @dp.message(Command("setmodel"))
-async def set_model(message: types.Message):
-    if not message.from_user or not db.is_user_admin(message.from_user.id):
+async def set_model(message: types.Message, tenant: Tenant):
+    if not message.from_user or not db.is_user_admin(message.from_user.id, tenant.namespace):
         return
     if not message.text:
         return
@@ -147,20 +538,21 @@ async def set_model(message: types.Message):
             await message.answer("Usage: /setmodel <model_id>")
             return
         model_id = parts[1].strip()
-        db.set_config('model', model_id)
-        await message.answer(f"Model set to: {model_id}")
+        tenant.set_config('model', model_id)
+        asyncio.create_task(prepare_model(model_id))
+        await message.answer(f"Model set to: {model_id} (loading in background)")
     except Exception as e:
         await message.answer(f"Error: {e}")
 
 @dp.message()
-async def chat_handler(message: types.Message):
+async def chat_handler(message: types.Message, tenant: Tenant):
     text = message.text or message.caption
     
     if not message.from_user:
         return
 
-    # Allow authorized users to send images without text
-    if not text and not (message.photo and db.is_user_authorized(message.from_user.id)):
+    # Allow authorized users to send images and documents without text
+    if not text and not ((message.photo or message.document) and db.is_user_authorized(message.from_user.id, tenant.namespace)):
         return
         
     if not text:
@@ -169,18 +561,18 @@ async def chat_handler(message: types.Message):
     user_id = message.from_user.id
     username = message.from_user.username or message.from_user.first_name or "Unknown"
     
-    if not db.is_user_authorized(user_id):
-        if text == get_access_password():
-            db.add_user(user_id, username, is_admin=False)
+    if not db.is_user_authorized(user_id, tenant.namespace):
+        if text == get_access_password(tenant):
+            db.add_user(user_id, username, is_admin=False, namespace=tenant.namespace)
             await message.answer("Password accepted! You are now authorized to use this bot.")
         elif text == WEBUI_PASSWORD:
-            db.add_user(user_id, username, is_admin=True)
+            db.add_user(user_id, username, is_admin=True, namespace=tenant.namespace)
             await message.answer("Admin Access Granted! You can now control models and users.")
         else:
-            invite_result = db.use_invite(text)
+            invite_result = db.use_invite(text, tenant.namespace)
             if invite_result and invite_result["success"]:
                 is_admin = invite_result["is_admin"]
-                db.add_user(user_id, username, is_admin=is_admin)
+                db.add_user(user_id, username, is_admin=is_admin, namespace=tenant.namespace)
                 role_msg = "Admin Access Granted!" if is_admin else "Invite accepted!"
                 await message.answer(f"{role_msg} You are now authorized to use this bot.")
             else:
@@ -190,52 +582,146 @@ async def chat_handler(message: types.Message):
     # User is authorized
     # Check for admin promotion
     if text == WEBUI_PASSWORD:
-        db.make_admin(user_id)
+        db.make_admin(user_id, namespace=tenant.namespace)
         await message.answer("You are now an admin.")
         return
 
-    model_name = db.get_config('model', 'local-model')
-    system_prompt = db.get_config('system_prompt', 'You are a helpful assistant.')
-    current_provider = db.get_config('ai_provider', 'lm_studio')
-    
-    router = get_router()
-    router.set_current_provider(current_provider)
-    
-    # Configure providers based on saved settings
-    lm_studio_url = db.get_config('lm_studio_url', 'http://127.0.0.1:1234/v1')
-    ollama_url = db.get_config('ollama_url', 'http://127.0.0.1:11434')
-    
-    router.configure_provider('lm_studio', base_url=lm_studio_url)
-    router.configure_provider('ollama', base_url=ollama_url)
+    model_name = tenant.get_config('model', 'local-model')
+    system_prompt = tenant.get_config('system_prompt', 'You are a helpful assistant.')
+    deadline = get_deadline()
 
-    await bot.send_chat_action(chat_id=message.chat.id, action="typing")
+    with tracing.span("configure_router"):
+        router = configure_router()
+    key = (message.chat.id, user_id)
+    supersede_generation(key)
+    cache, cache_scope, question_vector = None, None, None
+    vision_cache, answer_key = None, None
 
     try:
+        with tracing.span("telegram.chat_action"):
+            await message.bot.send_chat_action(chat_id=message.chat.id, action="typing")
         messages = [Message(role="system", content=str(system_prompt))]
+        # Discovered once per model and cached by the provider
+        with tracing.span("capabilities"):
+            capabilities = await router.get_capabilities(model_name)
 
         if message.photo:
+            if not capabilities.vision:
+                reply(message, f"The current model ({model_name}) doesn't support images.")
+                return
             photo = message.photo[-1]
-            file_io = io.BytesIO()
-            await bot.download(photo, destination=file_io)
-            file_io.seek(0)
-            base64_image = base64.b64encode(file_io.getvalue()).decode('utf-8')
+            prompt = text or "What is in this image?"
+            vision_cache = configure_vision_cache()
+            # Forwards of a photo share its file_unique_id, even across bots
+            answer_key = vision_cache.answer_key(photo.file_unique_id, prompt, model_name, str(system_prompt))
+            with tracing.span("vision_cache") as span:
+                answer = vision_cache.get_answer(answer_key)
+                base64_image = None if answer else vision_cache.get_image(photo.file_unique_id)
+                if span:
+                    span.set(answer_hit=answer is not None, image_hit=base64_image is not None)
+            if answer:
+                reply(message, answer)
+                return
+            if base64_image is None:
+                file_io = io.BytesIO()
+                with tracing.span("photo.download", file_size=photo.file_size):
+                    await message.bot.download(photo, destination=file_io)
+                # Large photos take milliseconds to encode, keep that off the event loop
+                with tracing.span("photo.encode"):
+                    encoded = await asyncio.to_thread(base64.b64encode, file_io.getvalue())
+                base64_image = encoded.decode('utf-8')
+                vision_cache.put_image(photo.file_unique_id, base64_image)
             user_content = [
-                {"type": "text", "text": text or "What is in this image?"},
+                {"type": "text", "text": prompt},
                 {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
             ]
             messages.append(Message(role="user", content=user_content))
+        elif message.document:
+            if not documents.is_text_document(message.document):
+                reply(message, "Only text documents are supported (plain text, Markdown, CSV, JSON, code...).")
+                return
+            summary = await summarize_document(router, message, model_name, capabilities.context_length)
+            # The answer gets the usual timeout of its own, counted from now
+            deadline = get_deadline()
+            name = message.document.file_name or "document"
+            messages.append(Message(role="user", content=(
+                f"Summaries of the parts of the document '{name}':\n\n{summary}\n\n"
+                f"{text or 'Summarize this document.'}"
+            )))
         else:
-            messages.append(Message(role="user", content=text))
+            embedding_model = db.get_config('embedding_model', '')
+            cache = configure_semantic_cache()
+            question_vector = await embed_question(router, text, embedding_model, cache)
+            if cache is not None and question_vector is not None:
+                # Answers depend on everything that shapes the prompt, not just the question
+                cache_scope = scope_id(model_name, str(system_prompt), embedding_model,
+                                       str(knowledge.get_knowledge_base().version))
+                with tracing.span("semantic_cache") as span:
+                    hit = cache.lookup(cache_scope, question_vector)
+                    if span:
+                        span.set(hit=hit is not None, score=hit.score if hit else None)
+                if hit:
+                    reply(message, hit.entry.answer)
+                    return
+            content = text
+            if question_vector is not None:
+                # Relevant passages go after the question, so the system prompt stays a stable, cacheable prefix
+                content = await add_knowledge(text, question_vector, embedding_model)
+            messages.append(Message(role="user", content=content))
+
+        # Reject or trim over-long prompts here instead of after a round-trip to the backend
+        with tracing.span("context_guard", context_length=capabilities.context_length):
+            messages = fit_to_context(messages, model_name, capabilities.context_length,
+                                      policy=db.get_config('context_overflow', 'reject'))
 
-        response = await router.chat(messages, model=model_name)
-        await message.answer(response.text or "Empty response from AI.")
+        started = time.perf_counter()
+        response = await generate_and_reply(router, message, messages, model_name, deadline, tenant)
+        if response is None:
+            return
+        if cache_scope is not None and response.text:
+            # Backend-reported time when there is one: the wall clock also counts queueing
+            seconds = (response.timings or {}).get('total_ms', 0) / 1000 or time.perf_counter() - started
+            cache.put(cache_scope, question_vector, CacheEntry(text, response.text, seconds))
+        if answer_key is not None and response.text:
+            vision_cache.put_answer(answer_key, response.text)
+    except asyncio.CancelledError:
+        task = asyncio.current_task()
+        if task not in _superseded:
+            raise
+        # Cancelling closed the backend stream, so the model has already stopped generating
+        _superseded.discard(task)
+        logger.info(f"Generation for chat {message.chat.id} superseded by a newer message")
+    except DocumentTooLargeError as e:
+        reply(message, f"This document is too long: it has more than {e.chunks} parts. "
+                       f"Please send a shorter excerpt.")
+    except documents.DocumentError as e:
+        reply(message, str(e))
+    except PromptTooLongError as e:
+        reply(message, f"Your message is too long for {model_name}: about {e.tokens} tokens, "
+                       f"but it accepts {e.limit}. Please shorten it.")
+    except asyncio.TimeoutError:
+        logger.warning(f"AI request for chat {message.chat.id} exceeded its deadline "
+                       f"(trace {tracing.current_trace_id()})")
+        await message.answer("Error: the AI took too long to respond. Please try again.")
     except Exception as e:
-        logger.exception("AI request failed")
+        logger.exception(f"AI request failed (trace {tracing.current_trace_id()})")
         await message.answer(f"Error: {e}")
+    finally:
+        if _generations.get(key) is asyncio.current_task():
+            del _generations[key]
 
 async def main():
     logger.info("Starting bot...")
-    await dp.start_polling(bot)
+    profiling.start_instrumentation("bot")
+    asyncio.create_task(publish_activity())
+    asyncio.create_task(prepare_models(tenants.models_to_serve()))
+    # All hosted bots share one dispatcher, one HTTP session to Telegram and the AI backends
+    session = AiohttpSession()
+    bots = [Bot(token=token, session=session) for token in tenants.tokens_to_serve()]
+    _bots.update((b.id, b) for b in bots)
+    logger.info(f"Serving {len(bots)} bot(s)")
+    start_job_queue()
+    await dp.start_polling(*bots)
 
 
 if __name__ == "__main__":
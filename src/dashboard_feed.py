@@ -0,0 +1,137 @@
+import asyncio
+import json
+import logging
+import time
+from typing import AsyncIterator, Dict, Optional, Set
+
+import db
+from ai_config import configure_router
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 2.0
+HEALTH_INTERVAL = 10.0
+KEEPALIVE_INTERVAL = 15.0
+# The bot publishes at least every 30 s, so an older snapshot means it isn't running
+BOT_STALE_AFTER = 60.0
+
+
+class DashboardFeed:
+    """Polls for changes once on behalf of every open dashboard and fans them out as server-sent events.
+
+    Events carry the latest state of one topic (users, health, activity). Each is only sent when
+    it changed, and new subscribers get the current state of every topic first.
+    """
+
+    def __init__(self, interval: float = POLL_INTERVAL, health_interval: float = HEALTH_INTERVAL):
+        self.interval = interval
+        self.health_interval = health_interval
+        self._subscribers: Set[asyncio.Queue] = set()
+        self._latest: Dict[str, dict] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._last_health = 0.0
+        self._health_task: Optional[asyncio.Task] = None
+        self._last_activity: Optional[dict] = None
+        self._rates = {'msg_per_min': 0.0, 'tok_per_s': 0.0}
+
+    def subscribe(self) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=100)
+        for event, data in self._latest.items():
+            queue.put_nowait((event, data))
+        self._subscribers.add(queue)
+        # Polling only runs while someone is watching
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+
+    def publish(self, event: str, data: dict):
+        if self._latest.get(event) == data:
+            return
+        self._latest[event] = data
+        for queue in list(self._subscribers):
+            if queue.full():
+                # A client that stopped reading: drop its oldest update, the newest state wins anyway
+                queue.get_nowait()
+            queue.put_nowait((event, data))
+
+    def snapshot(self) -> Dict[str, dict]:
+        return dict(self._latest)
+
+    async def stream(self) -> AsyncIterator[str]:
+        """Server-sent event stream for one client."""
+        queue = self.subscribe()
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    # Keeps proxies from closing an idle connection
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            self.unsubscribe(queue)
+
+    async def _run(self):
+        while self._subscribers:
+            try:
+                await self.poll()
+            except Exception as e:
+                logger.error(f"Dashboard feed update failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def poll(self, force_health: bool = False):
+        self.publish('users', await asyncio.to_thread(db.get_users_version))
+
+        activity = await asyncio.to_thread(db.get_metric, 'bot_activity')
+        if activity:
+            self.publish('activity', self._with_rates(activity))
+
+        if force_health:
+            await self._check_health()
+        elif time.monotonic() - self._last_health >= self.health_interval and not self._health_task:
+            # An unreachable backend can take seconds to fail, don't hold up the other topics
+            self._health_task = asyncio.create_task(self._check_health())
+
+    async def _check_health(self):
+        self._last_health = time.monotonic()
+        try:
+            router = configure_router()
+            provider = router.get_current_provider()
+            try:
+                healthy = await asyncio.wait_for(router.health_check(provider), 10.0)
+            except Exception:
+                healthy = False
+            self.publish('health', {'provider': provider, 'model': db.get_config('model', 'local-model'),
+                                    'healthy': healthy})
+        finally:
+            self._health_task = None
+
+    def _with_rates(self, activity: dict) -> dict:
+        previous = self._last_activity
+        if previous is None or activity['updated_at'] != previous['updated_at']:
+            if previous is not None:
+                elapsed = activity['updated_at'] - previous['updated_at']
+                # Counters restart with the bot, so never report a negative rate
+                completed = max(0, activity['completed'] - previous['completed'])
+                tokens = max(0, activity['completion_tokens'] - previous['completion_tokens'])
+                if elapsed > 0:
+                    self._rates = {'msg_per_min': 60 * completed / elapsed, 'tok_per_s': tokens / elapsed}
+            self._last_activity = activity
+        online = time.time() - activity['updated_at'] < BOT_STALE_AFTER
+        return {**activity, **(self._rates if online else {'msg_per_min': 0.0, 'tok_per_s': 0.0}),
+                'bot_online': online}
+
+
+_feed_instance: Optional[DashboardFeed] = None
+
+
+def get_dashboard_feed() -> DashboardFeed:
+    global _feed_instance
+    if _feed_instance is None:
+        _feed_instance = DashboardFeed()
+    return _feed_instance
@@ -2,57 +2,133 @@ import sqlite3
 import os
 import secrets
 import json
+import functools
 from datetime import datetime, timedelta
 
 import paths
+import tracing
 
 DB_PATH = paths.get_data_path('bot.db')
 
 
+DEFAULT_CONFIG = {
+    'model': 'local-model',
+    'system_prompt': 'You are a helpful assistant.',
+    'lm_studio_url': 'http://127.0.0.1:1234/v1',
+}
+
+_initialized = False
+
+USERNAME_EXPR = "lower(json_extract(data, '$.username'))"
+
+
 def get_connection():
+    # Schema setup is deferred to first use so importing db stays cheap
+    if not _initialized:
+        init_db()
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
     return conn
 
 
 def init_db():
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS documents (
-            collection TEXT NOT NULL,
-            doc_key TEXT NOT NULL,
-            data TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY (collection, doc_key)
+    global _initialized
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        c = conn.cursor()
+        # Lets maintenance return free pages in small steps; only takes effect on a new, empty database
+        c.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        # Readers and the writer don't block each other, so the bot, the WebUI and backups run side by side.
+        # Persistent; may fail while the other process has the database open, it then succeeds next start.
+        try:
+            c.execute('PRAGMA journal_mode = WAL')
+        except sqlite3.OperationalError:
+            pass
+        # One transaction for schema and defaults instead of a connect/commit per statement
+        c.execute('BEGIN')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS documents (
+                collection TEXT NOT NULL,
+                doc_key TEXT NOT NULL,
+                data TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (collection, doc_key)
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_collection ON documents(collection)')
+        # Document count and a change counter per collection, kept by triggers so polling them is a key lookup
+        new_stats = c.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'collection_stats'"
+        ).fetchone() is None
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS collection_stats (
+                collection TEXT PRIMARY KEY,
+                count INTEGER NOT NULL DEFAULT 0,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        if new_stats:
+            c.execute(
+                'INSERT INTO collection_stats (collection, count, version) '
+                'SELECT collection, COUNT(*), 1 FROM documents GROUP BY collection'
+            )
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS stats_insert AFTER INSERT ON documents BEGIN
+                INSERT INTO collection_stats (collection, count, version) VALUES (NEW.collection, 1, 1)
+                ON CONFLICT(collection) DO UPDATE SET count = count + 1, version = version + 1;
+            END
+        ''')
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS stats_delete AFTER DELETE ON documents BEGIN
+                UPDATE collection_stats SET count = count - 1, version = version + 1 WHERE collection = OLD.collection;
+            END
+        ''')
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS stats_update AFTER UPDATE ON documents BEGIN
+                UPDATE collection_stats SET version = version + 1 WHERE collection = NEW.collection;
+            END
+        ''')
+        # Username search; the expression must match USERNAME_EXPR exactly for SQLite to use it
+        c.execute(f'CREATE INDEX IF NOT EXISTS idx_username ON documents(collection, {USERNAME_EXPR})')
+        c.executemany(
+            "INSERT OR IGNORE INTO documents (collection, doc_key, data) VALUES ('config', ?, ?)",
+            [(key, json.dumps({'value': value})) for key, value in DEFAULT_CONFIG.items()]
         )
-    ''')
-    c.execute('CREATE INDEX IF NOT EXISTS idx_collection ON documents(collection)')
-    conn.commit()
-    conn.close()
+        conn.commit()
+    finally:
+        conn.close()
+    _initialized = True
+
+
+def _traced(func):
+    name = f"db.{func.__name__}"
 
-    if get_doc('config', 'model') is None:
-        set_doc('config', 'model', {'value': 'local-model'})
-    if get_doc('config', 'system_prompt') is None:
-        set_doc('config', 'system_prompt', {'value': 'You are a helpful assistant.'})
-    if get_doc('config', 'lm_studio_url') is None:
-        set_doc('config', 'lm_studio_url', {'value': 'http://127.0.0.1:1234/v1'})
+    @functools.wraps(func)
+    def wrapper(collection, *args, **kwargs):
+        with tracing.span(name, collection=collection):
+            return func(collection, *args, **kwargs)
+    return wrapper
 
 
+@_traced
 def set_doc(collection, key, data):
     conn = get_connection()
     c = conn.cursor()
     try:
+        # An upsert rather than INSERT OR REPLACE: the replace's implicit delete wouldn't fire the stats trigger
         c.execute('''
-            INSERT OR REPLACE INTO documents (collection, doc_key, data, updated_at)
-            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            INSERT INTO documents (collection, doc_key, data, updated_at)
+            VALUES (?, ?, ?, strftime('%Y-%m-%d %H:%M:%f', 'now'))
+            ON CONFLICT(collection, doc_key) DO UPDATE SET
+                data = excluded.data, created_at = excluded.created_at, updated_at = excluded.updated_at
         ''', (collection, str(key), json.dumps(data)))
         conn.commit()
     finally:
         conn.close()
 
 
+@_traced
 def get_doc(collection, key):
     conn = get_connection()
     c = conn.cursor()
@@ -67,6 +143,7 @@ def get_doc(collection, key):
         conn.close()
 
 
+@_traced
 def delete_doc(collection, key):
     conn = get_connection()
     c = conn.cursor()
@@ -81,6 +158,7 @@ def delete_doc(collection, key):
         conn.close()
 
 
+@_traced
 def get_all_docs(collection):
     conn = get_connection()
     c = conn.cursor()
@@ -97,6 +175,63 @@ def get_all_docs(collection):
         conn.close()
 
 
+@_traced
+def get_docs_page(collection, after=None, limit=50, before=None):
+    """Up to `limit` documents in key order, starting after the key `after`.
+
+    Keyset pagination: pass the last key of a page to get the next one, or its first key as
+    `before` to get the previous one. It walks the primary key index, so deep pages cost the
+    same as the first.
+    """
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        if before is not None:
+            c.execute(
+                'SELECT doc_key, data, created_at FROM documents '
+                'WHERE collection = ? AND doc_key < ? ORDER BY doc_key DESC LIMIT ?',
+                (collection, str(before), limit)
+            )
+            return [
+                {'key': row['doc_key'], 'created_at': row['created_at'], **json.loads(row['data'])}
+                for row in reversed(c.fetchall())
+            ]
+        if after is None:
+            c.execute(
+                'SELECT doc_key, data, created_at FROM documents WHERE collection = ? ORDER BY doc_key LIMIT ?',
+                (collection, limit)
+            )
+        else:
+            c.execute(
+                'SELECT doc_key, data, created_at FROM documents '
+                'WHERE collection = ? AND doc_key > ? ORDER BY doc_key LIMIT ?',
+                (collection, str(after), limit)
+            )
+        return [
+            {'key': row['doc_key'], 'created_at': row['created_at'], **json.loads(row['data'])}
+            for row in c.fetchall()
+        ]
+    finally:
+        conn.close()
+
+
+@_traced
+def get_collection_version(collection):
+    """A fingerprint of a collection that changes when a document is added, updated or removed.
+
+    Read from collection_stats, so it costs the same however large the collection is.
+    """
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        c.execute('SELECT count, version FROM collection_stats WHERE collection = ?', (collection,))
+        row = c.fetchone()
+        return {'count': row['count'], 'version': row['version']} if row else {'count': 0, 'version': 0}
+    finally:
+        conn.close()
+
+
+@_traced
 def update_doc(collection, key, updates):
     conn = get_connection()
     c = conn.cursor()
@@ -110,7 +245,7 @@ def update_doc(collection, key, updates):
             data = json.loads(row['data'])
             data.update(updates)
             c.execute('''
-                UPDATE documents SET data = ?, updated_at = CURRENT_TIMESTAMP
+                UPDATE documents SET data = ?, updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now')
                 WHERE collection = ? AND doc_key = ?
             ''', (json.dumps(data), collection, str(key)))
             conn.commit()
@@ -119,58 +254,170 @@ def update_doc(collection, key, updates):
     finally:
         conn.close()
 
-def add_user(user_id, username, is_admin=False, is_super_admin=False):
-    existing = get_doc('users', user_id)
+
+@_traced
+def prune_collection(collection, keep):
+    """Delete all but the `keep` most recently updated documents of a collection."""
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        c.execute('''
+            DELETE FROM documents WHERE collection = ? AND doc_key NOT IN (
+                SELECT doc_key FROM documents WHERE collection = ? ORDER BY updated_at DESC LIMIT ?
+            )
+        ''', (collection, collection, keep))
+        conn.commit()
+        return c.rowcount
+    finally:
+        conn.close()
+
+def users_collection(namespace=''):
+    """Each hosted bot has its own users; the primary bot keeps the original collection."""
+    return f'users:{namespace}' if namespace else 'users'
+
+
+def invites_collection(namespace=''):
+    return f'invites:{namespace}' if namespace else 'invites'
+
+
+def add_user(user_id, username, is_admin=False, is_super_admin=False, namespace=''):
+    collection = users_collection(namespace)
+    existing = get_doc(collection, user_id)
     data = {
         'user_id': user_id,
         'username': username,
         'is_admin': is_admin or (existing.get('is_admin', False) if existing else False),
         'is_super_admin': is_super_admin or (existing.get('is_super_admin', False) if existing else False),
     }
-    set_doc('users', user_id, data)
+    set_doc(collection, user_id, data)
 
 
-def make_admin(user_id, is_admin=True):
-    user = get_doc('users', user_id)
+def make_admin(user_id, is_admin=True, namespace=''):
+    collection = users_collection(namespace)
+    user = get_doc(collection, user_id)
     if not user:
         return False
     if not is_admin and user.get('is_super_admin'):
         return False
-    return update_doc('users', user_id, {'is_admin': is_admin})
+    return update_doc(collection, user_id, {'is_admin': is_admin})
 
 
-def make_super_admin(user_id, is_super=True):
-    user = get_doc('users', user_id)
+def make_super_admin(user_id, is_super=True, namespace=''):
+    collection = users_collection(namespace)
+    user = get_doc(collection, user_id)
     if not user:
         return False
     updates = {'is_super_admin': is_super}
     if is_super:
         updates['is_admin'] = True
-    return update_doc('users', user_id, updates)
+    return update_doc(collection, user_id, updates)
 
 
-def remove_user(user_id):
-    user = get_doc('users', user_id)
+def remove_user(user_id, namespace=''):
+    collection = users_collection(namespace)
+    user = get_doc(collection, user_id)
     if user and user.get('is_super_admin'):
         return False
-    return delete_doc('users', user_id)
+    return delete_doc(collection, user_id)
+
 
+def get_users(namespace=''):
+    return get_all_docs(users_collection(namespace))
+
+
+def get_users_page(after=None, limit=50, namespace='', before=None):
+    return get_docs_page(users_collection(namespace), after, limit, before)
+
+
+@_traced
+def search_users(collection, prefix, limit=50):
+    """Users whose username starts with prefix, case-insensitively, in username order."""
+    prefix = prefix.lower()
+    # A range on the indexed expression; LIKE can't use the index
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        c.execute(
+            f'SELECT doc_key, data, created_at FROM documents '
+            f'WHERE collection = ? AND {USERNAME_EXPR} >= ? AND {USERNAME_EXPR} < ? '
+            f'ORDER BY {USERNAME_EXPR} LIMIT ?',
+            (collection, prefix, upper, limit)
+        )
+        return [
+            {'key': row['doc_key'], 'created_at': row['created_at'], **json.loads(row['data'])}
+            for row in c.fetchall()
+        ]
+    finally:
+        conn.close()
 
-def get_users():
-    return get_all_docs('users')
 
+def find_users(prefix, limit=50, namespace=''):
+    return search_users(users_collection(namespace), prefix, limit)
 
-def is_user_authorized(user_id):
-    return get_doc('users', user_id) is not None
 
+@_traced
+def remove_users(collection, user_ids):
+    """Remove many users in one transaction. Super admins are kept.
 
-def is_user_admin(user_id):
-    user = get_doc('users', user_id)
+    Returns the IDs that were removed, that belong to super admins and that weren't found.
+    """
+    # An ID given twice is removed (and reported) once
+    keys = list(dict.fromkeys(str(user_id) for user_id in user_ids))
+    result = {'removed': [], 'super_admins': [], 'missing': []}
+    if not keys:
+        return result
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        placeholders = ','.join('?' * len(keys))
+        c.execute(
+            f'SELECT doc_key, data FROM documents WHERE collection = ? AND doc_key IN ({placeholders})',
+            (collection, *keys)
+        )
+        found = {row['doc_key']: json.loads(row['data']) for row in c.fetchall()}
+        for key in keys:
+            if key not in found:
+                result['missing'].append(key)
+            elif found[key].get('is_super_admin'):
+                result['super_admins'].append(key)
+            else:
+                result['removed'].append(key)
+        if result['removed']:
+            c.executemany(
+                'DELETE FROM documents WHERE collection = ? AND doc_key = ?',
+                [(collection, key) for key in result['removed']]
+            )
+        conn.commit()
+        return result
+    finally:
+        conn.close()
+
+
+def kick_users(user_ids, namespace=''):
+    return remove_users(users_collection(namespace), user_ids)
+
+
+def get_users_version(namespace=''):
+    return get_collection_version(users_collection(namespace))
+
+
+def count_users(namespace=''):
+    """From the maintained collection_stats row, not a scan of the users."""
+    return get_users_version(namespace)['count']
+
+
+def is_user_authorized(user_id, namespace=''):
+    return get_doc(users_collection(namespace), user_id) is not None
+
+
+def is_user_admin(user_id, namespace=''):
+    user = get_doc(users_collection(namespace), user_id)
     return user is not None and user.get('is_admin', False)
 
 
-def is_user_super_admin(user_id):
-    user = get_doc('users', user_id)
+def is_user_super_admin(user_id, namespace=''):
+    user = get_doc(users_collection(namespace), user_id)
     return user is not None and user.get('is_super_admin', False)
 
 
@@ -183,27 +430,36 @@ def get_config(key, default=None):
     return doc.get('value', default) if doc else default
 
 
-def create_invite(is_admin_invite=False):
+def set_metric(name, data):
+    set_doc('metrics', name, data)
+
+
+def get_metric(name):
+    return get_doc('metrics', name)
+
+
+def create_invite(is_admin_invite=False, namespace=''):
     code = secrets.token_hex(4)
-    set_doc('invites', code, {'is_admin_invite': is_admin_invite})
+    set_doc(invites_collection(namespace), code, {'is_admin_invite': is_admin_invite})
     return code
 
 
-def use_invite(code):
+def use_invite(code, namespace=''):
+    collection = invites_collection(namespace)
     conn = get_connection()
     c = conn.cursor()
     try:
         c.execute('''
             SELECT data, created_at FROM documents 
-            WHERE collection = 'invites' AND doc_key = ?
-        ''', (code,))
+            WHERE collection = ? AND doc_key = ?
+        ''', (collection, code))
         row = c.fetchone()
 
         c.execute('''
             DELETE FROM documents 
-            WHERE collection = 'invites' 
+            WHERE collection = ? 
             AND datetime(created_at) <= datetime('now', '-1 hour')
-        ''')
+        ''', (collection,))
         conn.commit()
 
         if not row:
@@ -211,15 +467,28 @@ def use_invite(code):
 
         created_at = datetime.fromisoformat(row['created_at'].replace(' ', 'T'))
         if datetime.now() - created_at > timedelta(hours=1):
-            delete_doc('invites', code)
+            delete_doc(collection, code)
             return None
 
         data = json.loads(row['data'])
         is_admin = data.get('is_admin_invite', False)
-        delete_doc('invites', code)
+        delete_doc(collection, code)
         return {"success": True, "is_admin": is_admin}
     finally:
         conn.close()
 
 
-init_db()
+def get_bots():
+    return get_all_docs('bots')
+
+
+def get_bot(bot_id):
+    return get_doc('bots', bot_id)
+
+
+def save_bot(bot_id, data):
+    set_doc('bots', bot_id, data)
+
+
+def remove_bot(bot_id):
+    return delete_doc('bots', bot_id)
@@ -0,0 +1,90 @@
+import codecs
+import os
+from typing import AsyncIterator, Optional
+
+import aiofiles
+from aiogram import Bot, types
+
+import db
+
+# Bot API limit for files bots can download
+MAX_DOCUMENT_BYTES = 20 * 1024 * 1024
+READ_CHUNK_BYTES = 64 * 1024
+DOWNLOAD_TIMEOUT = 120
+SUMMARY_CACHE_SIZE = 5000
+
+TEXT_MIME_TYPES = {
+    "application/json", "application/xml", "application/x-yaml", "application/yaml",
+    "application/javascript", "application/x-sh", "application/sql", "application/x-subrip",
+}
+TEXT_EXTENSIONS = {
+    ".txt", ".md", ".markdown", ".rst", ".csv", ".tsv", ".json", ".jsonl", ".xml", ".yaml", ".yml",
+    ".html", ".htm", ".log", ".ini", ".cfg", ".toml", ".py", ".js", ".ts", ".java", ".c", ".cpp", ".h",
+    ".cs", ".go", ".rs", ".rb", ".php", ".sh", ".sql", ".srt", ".vtt", ".tex",
+}
+
+
+class DocumentError(Exception):
+    pass
+
+
+def is_text_file(file_name: Optional[str], mime_type: Optional[str]) -> bool:
+    mime = (mime_type or "").lower()
+    if mime.startswith("text/") or mime in TEXT_MIME_TYPES:
+        return True
+    return os.path.splitext(file_name or "")[1].lower() in TEXT_EXTENSIONS
+
+
+def is_text_document(document: types.Document) -> bool:
+    return is_text_file(document.file_name, document.mime_type)
+
+
+async def stream_file(bot: Bot, file_path: str) -> AsyncIterator[bytes]:
+    """Yield a Telegram file in chunks as it downloads, without buffering it whole."""
+    if bot.session.api.is_local:
+        async with aiofiles.open(str(bot.session.api.wrap_local_file.to_local(file_path)), "rb") as f:
+            while chunk := await f.read(READ_CHUNK_BYTES):
+                yield chunk
+        return
+    url = bot.session.api.file_url(bot.token, file_path)
+    async for chunk in bot.session.stream_content(url=url, timeout=DOWNLOAD_TIMEOUT,
+                                                  chunk_size=READ_CHUNK_BYTES, raise_for_status=True):
+        yield chunk
+
+
+async def decode_text(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Decode streamed UTF-8 text incrementally, rejecting binary files."""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    first = True
+    async for chunk in chunks:
+        if first:
+            first = False
+            if chunk.startswith(codecs.BOM_UTF8):
+                chunk = chunk[len(codecs.BOM_UTF8):]
+            # NUL bytes don't occur in text: this is a binary file with a misleading name
+            if b"\x00" in chunk[:4096]:
+                raise DocumentError("This doesn't look like a text file.")
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
+
+
+async def stream_document_text(bot: Bot, document: types.Document) -> AsyncIterator[str]:
+    """Decode a text document incrementally as it downloads."""
+    if document.file_size and document.file_size > MAX_DOCUMENT_BYTES:
+        raise DocumentError("The file is too large: bots can only download files up to 20 MB.")
+    file = await bot.get_file(document.file_id)
+    async for text in decode_text(stream_file(bot, file.file_path)):
+        yield text
+
+
+def get_cached_summary(key: str) -> Optional[str]:
+    doc = db.get_doc('chunk_summaries', key)
+    return doc['summary'] if doc else None
+
+
+def set_cached_summary(key: str, summary: str):
+    db.set_doc('chunk_summaries', key, {'summary': summary})
+
+
+def prune_summary_cache(keep: int = SUMMARY_CACHE_SIZE):
+    db.prune_collection('chunk_summaries', keep)
@@ -0,0 +1,385 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Optional
+
+import paths
+
+logger = logging.getLogger(__name__)
+
+JOBS_PATH = paths.get_data_path("jobs.db")
+DEFAULT_WORKERS = 4
+# A worker renews its lease while the job runs; a crashed process's jobs are reclaimed when it lapses
+LEASE_SECONDS = 30.0
+POLL_INTERVAL = 1.0
+MAX_ATTEMPTS = 3
+RETRY_BASE = 2.0
+# Backoff for health checks while the backend is down
+HEALTH_RETRY_MAX = 60.0
+# Give up on a job the backend couldn't serve for this long
+JOB_EXPIRY = 3600.0
+
+
+@dataclass
+class Job:
+    id: int
+    # Names the job to the process that submitted it, which knows it before the row exists
+    ticket: str
+    conversation: str
+    payload: dict
+    attempts: int
+    created_at: float
+
+
+class JobExpired(Exception):
+    pass
+
+
+class JobStore:
+    """Generation jobs in their own SQLite file in WAL mode. Every method blocks: call it in a thread."""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or JOBS_PATH
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        # Autocommit, with explicit transactions where reads and writes must be atomic
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        if not self._initialized:
+            # WAL persists in the file; it lets the claim transaction run without blocking readers
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ticket TEXT NOT NULL,
+                    conversation TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    run_after REAL NOT NULL,
+                    lease_until REAL,
+                    worker TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs(status, run_after)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_ticket ON jobs(ticket)')
+            self._initialized = True
+        # Losing the last transaction on power failure is fine, fsync on every job isn't
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def enqueue(self, ticket: str, conversation: str, payload: dict) -> int:
+        conn = self._connect()
+        try:
+            now = time.time()
+            cur = conn.execute(
+                'INSERT INTO jobs (ticket, conversation, payload, run_after, created_at) VALUES (?, ?, ?, ?, ?)',
+                (ticket, conversation, json.dumps(payload), now, now)
+            )
+            return cur.lastrowid
+        finally:
+            conn.close()
+
+    def claim(self, worker: str, lease: float = LEASE_SECONDS) -> Optional[Job]:
+        """Lease the oldest ready job: a pending one that is due, or a running one whose lease lapsed."""
+        conn = self._connect()
+        try:
+            # IMMEDIATE takes the write lock up front, so two workers can't claim the same row
+            conn.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            row = conn.execute('''
+                SELECT id, ticket, conversation, payload, attempts, created_at FROM jobs
+                WHERE (status = 'pending' AND run_after <= ?) OR (status = 'running' AND lease_until < ?)
+                ORDER BY id LIMIT 1
+            ''', (now, now)).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                (worker, now + lease, row['id'])
+            )
+            conn.execute('COMMIT')
+            return Job(row['id'], row['ticket'], row['conversation'], json.loads(row['payload']), row['attempts'] + 1,
+                       row['created_at'])
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def renew(self, job_id: int, worker: str, lease: float = LEASE_SECONDS) -> bool:
+        conn = self._connect()
+        try:
+            cur = conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (time.time() + lease, job_id, worker)
+            )
+            return cur.rowcount > 0
+        finally:
+            conn.close()
+
+    def retry(self, job_id: int, delay: float, error: Optional[str] = None, count_attempt: bool = True):
+        conn = self._connect()
+        try:
+            conn.execute(
+                "UPDATE jobs SET status = 'pending', run_after = ?, lease_until = NULL, worker = NULL, error = ?, "
+                "attempts = attempts - ? WHERE id = ?",
+                (time.time() + delay, error, 0 if count_attempt else 1, job_id)
+            )
+        finally:
+            conn.close()
+
+    def remove(self, job_id: int):
+        """Drop a finished, failed or cancelled job: only outstanding work is kept."""
+        conn = self._connect()
+        try:
+            conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+        finally:
+            conn.close()
+
+    def remove_pending(self, ticket: str) -> Optional[str]:
+        """Drop a job that no worker holds. Returns the status it had, or None when it is gone."""
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT status FROM jobs WHERE ticket = ?', (ticket,)).fetchone()
+            if row and row['status'] == 'pending':
+                conn.execute("DELETE FROM jobs WHERE ticket = ? AND status = 'pending'", (ticket,))
+            conn.execute('COMMIT')
+            return row['status'] if row else None
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def counts(self) -> Dict[str, int]:
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT status, COUNT(*) AS n FROM jobs GROUP BY status').fetchall()
+            return {row['status']: row['n'] for row in rows}
+        finally:
+            conn.close()
+
+
+class JobQueue:
+    """Durable generation queue between receiving a message and calling the backend.
+
+    A fixed pool of workers caps concurrent backend requests, so a burst waits in the queue
+    instead of opening a request per message. Jobs are written to disk before any work starts
+    and removed only once handled, so they survive restarts. While the backend's health check
+    fails, workers stop claiming jobs and poll it with exponential backoff.
+
+    process(payload) does the work and replies, so a job picked up after a restart is still
+    answered; handlers still running can await its result with wait().
+    """
+
+    def __init__(self, process: Callable[[dict], Awaitable], healthy: Callable[[], Awaitable[bool]],
+                 on_failure: Callable[[dict, Exception], Awaitable], store: Optional[JobStore] = None):
+        self.process = process
+        self.healthy = healthy
+        self.on_failure = on_failure
+        self.store = store or JobStore()
+        self.worker_id = f"{os.getpid()}-{id(self):x}"
+        self._workers = []
+        self._wakeup = asyncio.Event()
+        self._backend_up = asyncio.Event()
+        self._backend_up.set()
+        self._monitor: Optional[asyncio.Task] = None
+        self._running: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[str, asyncio.Future] = {}
+        self._cancelled = set()
+        self.retries = 0
+        self.failed = 0
+
+    @property
+    def started(self) -> bool:
+        return bool(self._workers)
+
+    def start(self, workers: int = DEFAULT_WORKERS):
+        if self._workers:
+            return
+        for _ in range(max(1, workers)):
+            # A fresh context: workers outlive the request that happened to start them
+            self._workers.append(asyncio.create_task(self._worker(), context=contextvars.Context()))
+        logger.info(f"Job queue started with {len(self._workers)} worker(s)")
+
+    async def stop(self):
+        for task in self._workers + ([self._monitor] if self._monitor else []):
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def submit(self, conversation: str, payload: dict) -> str:
+        """Store a job and return its ticket for wait() and cancel()."""
+        ticket = secrets.token_hex(8)
+        # Registered first: a worker may finish the job before to_thread() returns
+        self._waiters[ticket] = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.to_thread(self.store.enqueue, ticket, conversation, payload)
+        except BaseException:
+            self._waiters.pop(ticket, None)
+            raise
+        self._wakeup.set()
+        return ticket
+
+    async def wait(self, ticket: str):
+        """The result of process() for a job, or None if it failed (the user was already told)."""
+        future = self._waiters.get(ticket)
+        return await asyncio.shield(future) if future else None
+
+    async def cancel(self, ticket: str):
+        """Cancel a job, whether it is waiting or running in this process."""
+        self._resolve(ticket, None)
+        self._cancelled.add(ticket)
+        task = self._running.get(ticket)
+        if task:
+            task.cancel()
+            return
+        # A running row was just claimed by a worker: it stays in _cancelled so the worker drops it
+        if await asyncio.to_thread(self.store.remove_pending, ticket) != 'running':
+            self._cancelled.discard(ticket)
+
+    def _resolve(self, ticket: str, result):
+        future = self._waiters.pop(ticket, None)
+        if future and not future.done():
+            future.set_result(result)
+
+    async def _next_job(self) -> Job:
+        while True:
+            await self._backend_up.wait()
+            job = await asyncio.to_thread(self.store.claim, self.worker_id)
+            if job:
+                return job
+            self._wakeup.clear()
+            try:
+                # Woken by submit(); the timeout picks up retries that became due
+                await asyncio.wait_for(self._wakeup.wait(), POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self):
+        while True:
+            job = await self._next_job()
+            # Others may be waiting too: claim() only returns one job
+            self._wakeup.set()
+            if job.ticket in self._cancelled:
+                self._cancelled.discard(job.ticket)
+                await asyncio.to_thread(self.store.remove, job.id)
+                continue
+            task = asyncio.create_task(self._run(job))
+            self._running[job.ticket] = task
+            try:
+                await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if not task.done():
+                    # The worker itself is stopping: leave the job to be reclaimed after a restart
+                    task.cancel()
+                    raise
+            except Exception:
+                logger.exception(f"Job {job.id} crashed its worker")
+            finally:
+                self._running.pop(job.ticket, None)
+
+    async def _run(self, job: Job):
+        renew = asyncio.create_task(self._renew_lease(job.id))
+        try:
+            if time.time() - job.created_at > JOB_EXPIRY:
+                raise JobExpired(f"Job {job.id} waited more than {JOB_EXPIRY:.0f}s for the backend")
+            result = await self.process(job.payload)
+        except asyncio.CancelledError:
+            if job.ticket in self._cancelled:
+                self._cancelled.discard(job.ticket)
+                await asyncio.to_thread(self.store.remove, job.id)
+            # Otherwise the process is stopping: the job is reclaimed once its lease lapses
+            raise
+        except Exception as e:
+            await self._handle_error(job, e)
+        else:
+            await asyncio.to_thread(self.store.remove, job.id)
+            self._resolve(job.ticket, result)
+        finally:
+            renew.cancel()
+
+    async def _handle_error(self, job: Job, error: Exception):
+        if not isinstance(error, JobExpired) and not await self._check_health():
+            # Not the job's fault: hold it, without using up an attempt, until the backend is back
+            logger.warning(f"Backend unavailable, job {job.id} will be retried when it is back: {error}")
+            await asyncio.to_thread(self.store.retry, job.id, 0, str(error), False)
+            return
+        if not isinstance(error, JobExpired) and job.attempts < MAX_ATTEMPTS:
+            delay = RETRY_BASE ** job.attempts
+            self.retries += 1
+            logger.warning(f"Job {job.id} failed (attempt {job.attempts}), retrying in {delay:.0f}s: {error}")
+            await asyncio.to_thread(self.store.retry, job.id, delay, str(error))
+            return
+        self.failed += 1
+        logger.error(f"Job {job.id} failed for good: {error}")
+        await asyncio.to_thread(self.store.remove, job.id)
+        self._resolve(job.ticket, None)
+        try:
+            await self.on_failure(job.payload, error)
+        except Exception as e:
+            logger.error(f"Failed to report job {job.id} failure: {e}")
+
+    async def _check_health(self) -> bool:
+        try:
+            healthy = await self.healthy()
+        except Exception:
+            healthy = False
+        if not healthy and self._backend_up.is_set():
+            self._backend_up.clear()
+            self._monitor = asyncio.create_task(self._watch_backend(), context=contextvars.Context())
+        return healthy
+
+    async def _watch_backend(self):
+        delay = 1.0
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                if await self.healthy():
+                    logger.info("Backend is back, resuming queued jobs")
+                    self._backend_up.set()
+                    self._wakeup.set()
+                    return
+            except Exception:
+                pass
+            delay = min(delay * 2, HEALTH_RETRY_MAX)
+
+    async def _renew_lease(self, job_id: int):
+        while True:
+            await asyncio.sleep(LEASE_SECONDS / 3)
+            try:
+                await asyncio.to_thread(self.store.renew, job_id, self.worker_id)
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to renew the lease of job {job_id}: {e}")
+
+    async def stats(self) -> dict:
+        counts = await asyncio.to_thread(self.store.counts)
+        return {'queued': counts.get('pending', 0), 'running': counts.get('running', 0),
+                'retries': self.retries, 'failed': self.failed, 'backend_up': self._backend_up.is_set()}
+
+
+_queue_instance: Optional[JobQueue] = None
+
+
+def get_job_queue() -> Optional[JobQueue]:
+    """The queue set up by init_job_queue(), or None when it is disabled."""
+    return _queue_instance
+
+
+def init_job_queue(process, healthy, on_failure) -> JobQueue:
+    global _queue_instance
+    if _queue_instance is None:
+        _queue_instance = JobQueue(process, healthy, on_failure)
+    return _queue_instance
@@ -0,0 +1,251 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from typing import TYPE_CHECKING, AsyncIterator, List, Optional
+
+import paths
+import tracing
+from services.router import AIRouter
+from services.summarize import TextChunker, chunk_stream
+
+if TYPE_CHECKING:
+    # numpy is imported where vectors are handled, so processes without a knowledge base never load it
+    import numpy as np
+
+logger = logging.getLogger(__name__)
+
+KNOWLEDGE_PATH = paths.get_data_path("knowledge.json")
+# Passages small enough that a few of them add little to a prompt
+PASSAGE_TOKENS = 300
+EMBED_BATCH = 32
+DEFAULT_TOP_K = 3
+DEFAULT_MIN_SCORE = 0.3
+
+
+class KnowledgeError(Exception):
+    pass
+
+
+def _empty_index() -> dict:
+    return {"model": None, "dim": 0, "matrix": None, "documents": [], "passages": []}
+
+
+def _normalize(vectors) -> "np.ndarray":
+    import numpy as np
+    matrix = np.asarray(vectors, dtype=np.float32)
+    if matrix.ndim != 2 or not matrix.shape[0]:
+        raise KnowledgeError("The embedding endpoint returned no vectors")
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    # Unit rows turn cosine similarity into a single matrix-vector product
+    return matrix / np.maximum(norms, 1e-12)
+
+
+class KnowledgeBase:
+    """Admin-supplied documents split into passages, with one embedding per passage.
+
+    Vectors are kept in a float32 .npy matrix next to bot.db that readers memory-map, so a
+    query only pages in the matrix and never copies it. The JSON index names the current
+    matrix file and is replaced last, which makes every save atomic for the other process.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or KNOWLEDGE_PATH
+        self._index = _empty_index()
+        self._matrix: Optional["np.ndarray"] = None
+        self._mtime: Optional[int] = None
+        self._write_lock = threading.Lock()
+        self._warned_model: Optional[str] = None
+
+    def _stat(self) -> Optional[int]:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _matrix_path(self, name: str) -> str:
+        return os.path.join(os.path.dirname(self.path), name)
+
+    def _load(self):
+        """Pick up a save from the other process. Blocking: reads the index."""
+        mtime = self._stat()
+        if mtime == self._mtime:
+            return
+        index, matrix = _empty_index(), None
+        if mtime is not None:
+            with open(self.path, encoding="utf-8") as f:
+                index = json.load(f)
+            if index["matrix"]:
+                import numpy as np
+                matrix = np.load(self._matrix_path(index["matrix"]), mmap_mode="r")
+        self._index, self._matrix, self._mtime = index, matrix, mtime
+
+    def _save(self, index: dict, matrix: Optional["np.ndarray"]):
+        """Write a new matrix file, then point the index at it. Blocking."""
+        index["matrix"] = None
+        if matrix is not None and len(matrix):
+            import numpy as np
+            index["matrix"] = f"knowledge-{secrets.token_hex(4)}.npy"
+            np.save(self._matrix_path(index["matrix"]), np.ascontiguousarray(matrix, dtype=np.float32))
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(tmp, self.path)
+        # Old matrices may still be mapped by the bot; where that blocks removal (Windows) retry next save
+        pattern = os.path.join(os.path.dirname(self.path), "knowledge-*.npy")
+        for old in glob.glob(pattern):
+            if os.path.basename(old) != index["matrix"]:
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+        self._mtime = None
+        self._load()
+
+    async def refresh(self):
+        if self._stat() != self._mtime:
+            await asyncio.to_thread(self._load)
+
+    def documents(self) -> List[dict]:
+        return list(self._index["documents"])
+
+    @property
+    def model(self) -> Optional[str]:
+        return self._index["model"]
+
+    @property
+    def size(self) -> int:
+        return len(self._index["passages"])
+
+    @property
+    def version(self) -> Optional[int]:
+        """Changes with every save, e.g. to invalidate answers based on older contents."""
+        return self._mtime
+
+    def usable(self, model: str) -> bool:
+        """Whether there are passages to search with vectors from model."""
+        if self.size and self.model != model and self._warned_model != model:
+            # Vectors from different models are not comparable
+            self._warned_model = model
+            logger.warning(f"Knowledge base was built with {self.model}, not {model}: rebuild it to use it")
+        return bool(self.size) and self.model == model
+
+    async def _embed(self, router: AIRouter, texts: List[str], model: str) -> "np.ndarray":
+        import numpy as np
+        batches = []
+        for start in range(0, len(texts), EMBED_BATCH):
+            batches.append(_normalize(await router.embed(texts[start:start + EMBED_BATCH], model)))
+        return np.vstack(batches)
+
+    async def add_document(self, router: AIRouter, name: str, pieces: AsyncIterator[str], model: str) -> int:
+        """Split streamed text into passages, embed them and add them to the index."""
+        await self.refresh()
+        if self.size and self.model != model:
+            raise KnowledgeError(f"The knowledge base was built with {self.model}. Rebuild it for {model} first.")
+        passages = [chunk async for chunk in chunk_stream(pieces, TextChunker(model, PASSAGE_TOKENS))]
+        if not passages:
+            raise KnowledgeError("The document is empty")
+        with tracing.span("knowledge.embed", passages=len(passages)):
+            vectors = await self._embed(router, passages, model)
+        document = {"id": secrets.token_hex(4), "name": name, "passages": len(passages), "added_at": time.time()}
+
+        def write():
+            import numpy as np
+            with self._write_lock:
+                self._mtime = None
+                self._load()
+                index = self._index
+                if self._matrix is not None and self._matrix.shape[1] != vectors.shape[1]:
+                    raise KnowledgeError(f"{model} returned {vectors.shape[1]}-dimensional vectors, "
+                                         f"the index holds {self._matrix.shape[1]}")
+                matrix = vectors if self._matrix is None else np.vstack([self._matrix, vectors])
+                self._save({
+                    **index, "model": model, "dim": int(vectors.shape[1]),
+                    "documents": index["documents"] + [document],
+                    "passages": index["passages"] + [{"doc": document["id"], "text": p} for p in passages],
+                }, matrix)
+        await asyncio.to_thread(write)
+        return len(passages)
+
+    async def remove_document(self, doc_id: str):
+        def write():
+            import numpy as np
+            with self._write_lock:
+                self._mtime = None
+                self._load()
+                index = self._index
+                keep = [p["doc"] != doc_id for p in index["passages"]]
+                matrix = self._matrix[np.asarray(keep, dtype=bool)] if self._matrix is not None else None
+                documents = [d for d in index["documents"] if d["id"] != doc_id]
+                self._save({
+                    **index,
+                    "model": index["model"] if documents else None,
+                    "documents": documents,
+                    "passages": [p for p, k in zip(index["passages"], keep) if k],
+                }, matrix)
+        await asyncio.to_thread(write)
+
+    async def rebuild(self, router: AIRouter, model: str):
+        """Re-embed every passage, e.g. after switching the embedding model."""
+        await self.refresh()
+        index = self._index
+        if not index["passages"]:
+            return
+        vectors = await self._embed(router, [p["text"] for p in index["passages"]], model)
+
+        def write():
+            with self._write_lock:
+                self._mtime = None
+                self._load()
+                if self._index["passages"] != index["passages"]:
+                    raise KnowledgeError("The knowledge base changed during the rebuild, try again")
+                self._save({**index, "model": model, "dim": int(vectors.shape[1])}, vectors)
+        await asyncio.to_thread(write)
+
+    async def search(self, query_vector: "np.ndarray", model: str, top_k: int = DEFAULT_TOP_K,
+                     min_score: float = DEFAULT_MIN_SCORE) -> List[dict]:
+        """The passages most similar to a query embedded with embed_query(), best first."""
+        await self.refresh()
+        index, matrix = self._index, self._matrix
+        if not self.usable(model) or matrix is None or query_vector.shape[0] != matrix.shape[1]:
+            return []
+
+        def score():
+            import numpy as np
+            scores = matrix @ query_vector
+            k = min(top_k, len(scores))
+            # Partial sort: only the top k need ordering
+            best = np.argpartition(-scores, k - 1)[:k]
+            return [(int(i), float(scores[i])) for i in best[np.argsort(-scores[best])]]
+        ranked = await asyncio.to_thread(score)
+        names = {d["id"]: d["name"] for d in index["documents"]}
+        hits = []
+        for row, value in ranked:
+            if value < min_score:
+                break
+            passage = index["passages"][row]
+            hits.append({"document": names.get(passage["doc"], ""), "text": passage["text"], "score": value})
+        return hits
+
+
+async def embed_query(router: AIRouter, text: str, model: str) -> "np.ndarray":
+    return _normalize(await router.embed([text], model))[0]
+
+
+def format_passages(hits: List[dict]) -> str:
+    excerpts = "\n\n".join(f"[{i}] {hit['document']}\n{hit['text']}" for i, hit in enumerate(hits, 1))
+    return f"Excerpts from the knowledge base that may help with the question above:\n\n{excerpts}"
+
+
+_knowledge_instance: Optional[KnowledgeBase] = None
+
+
+def get_knowledge_base() -> KnowledgeBase:
+    global _knowledge_instance
+    if _knowledge_instance is None:
+        _knowledge_instance = KnowledgeBase()
+    return _knowledge_instance
@@ -3,7 +3,6 @@ import logging
 import multiprocessing
 import os
 import sys
-import uvicorn
 import secrets
 import string
 
@@ -52,6 +51,8 @@ def run_web():
     src_dir = os.path.dirname(os.path.abspath(__file__))
     sys.path.insert(0, src_dir)
     os.chdir(paths.get_base_path())
+    # Imported here so the bot process doesn't pay for the web stack
+    import uvicorn
     from web import app
     uvicorn.run(app, host="0.0.0.0", port=7860, reload=False)
 
@@ -72,6 +73,11 @@ if __name__ == "__main__":
         print_version_info()
         sys.exit(0)
 
+    if len(sys.argv) > 1 and sys.argv[1] == '--startup-audit':
+        from startup_audit import run_audit
+        run_audit()
+        sys.exit(0)
+
     # Setup first run configuration
     setup_first_run()
 
@@ -0,0 +1,237 @@
+import asyncio
+import glob
+import logging
+import math
+import os
+import shutil
+import sqlite3
+import time
+from datetime import datetime
+from typing import Optional
+
+import db
+import paths
+
+logger = logging.getLogger(__name__)
+
+BACKUP_DIR = paths.get_data_path("backups")
+DEFAULT_INTERVAL_HOURS = 24
+DEFAULT_BACKUPS_KEPT = 7
+# Work is done a few pages at a time, pausing in between so the bot and the WebUI can write
+BACKUP_STEP_PAGES = 256
+VACUUM_STEP_PAGES = 256
+STEP_PAUSE = 0.01
+# Writes from other connections restart a backup; past this many it copies in one go instead
+MAX_BACKUP_RESTARTS = 3
+# How often the scheduler checks whether maintenance is due
+CHECK_INTERVAL = 300.0
+LOCK_TIMEOUT = 30
+
+_lock = asyncio.Lock()
+
+
+class _BackupRestarting(Exception):
+    pass
+
+
+def database_stats(path: Optional[str] = None) -> dict:
+    path = path or db.DB_PATH
+    conn = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+    try:
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        pages = conn.execute('PRAGMA page_count').fetchone()[0]
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        auto_vacuum = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+        journal_mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+    finally:
+        conn.close()
+    wal = path + '-wal'
+    return {
+        'size_bytes': os.path.getsize(path) + (os.path.getsize(wal) if os.path.exists(wal) else 0),
+        'journal_mode': journal_mode,
+        'page_size': page_size,
+        'pages': pages,
+        'free_pages': free,
+        'auto_vacuum': {0: 'none', 1: 'full', 2: 'incremental'}.get(auto_vacuum, str(auto_vacuum)),
+    }
+
+
+def backup(path: Optional[str] = None, backup_dir: str = BACKUP_DIR, keep: int = DEFAULT_BACKUPS_KEPT) -> dict:
+    """Copy the database with SQLite's online backup API, keeping the `keep` newest copies.
+
+    Each step holds the read lock for BACKUP_STEP_PAGES pages only; a write by another
+    connection in between makes SQLite restart the copy, so it stays consistent. If writes
+    keep restarting it, the rest is copied in one read transaction, which in WAL mode
+    doesn't hold up writers either.
+    """
+    path = path or db.DB_PATH
+    started = time.perf_counter()
+    os.makedirs(backup_dir, exist_ok=True)
+    # Leftovers of a run that was interrupted
+    for stale in glob.glob(os.path.join(backup_dir, "bot-*.db.tmp*")):
+        os.remove(stale)
+    target = os.path.join(backup_dir, f"bot-{datetime.now():%Y%m%d-%H%M%S}.db")
+    tmp = target + ".tmp"
+    steps, restarts, last_remaining = 0, 0, None
+
+    def progress(status, remaining, total):
+        nonlocal steps, restarts, last_remaining
+        steps += 1
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts > MAX_BACKUP_RESTARTS:
+                raise _BackupRestarting()
+        last_remaining = remaining
+        time.sleep(STEP_PAUSE)
+
+    source = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+    dest = sqlite3.connect(tmp)
+    try:
+        try:
+            source.backup(dest, pages=BACKUP_STEP_PAGES, progress=progress)
+        except _BackupRestarting:
+            source.backup(dest, pages=-1)
+            steps += 1
+    finally:
+        dest.close()
+        source.close()
+    # A half-written copy never carries a backup's name
+    os.replace(tmp, target)
+    for old in sorted(glob.glob(os.path.join(backup_dir, "bot-*.db")))[:-max(1, keep)]:
+        os.remove(old)
+    return {
+        'file': os.path.basename(target),
+        'size_bytes': os.path.getsize(target),
+        'steps': steps,
+        'restarts': restarts,
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+
+
+def incremental_vacuum(path: Optional[str] = None) -> dict:
+    """Return free pages to the filesystem a batch at a time, each batch its own short transaction.
+
+    Does nothing on a database that isn't in incremental auto-vacuum mode: switching takes a
+    full VACUUM, which only runs when an admin asks for it (convert_to_incremental).
+    """
+    path = path or db.DB_PATH
+    started = time.perf_counter()
+    conn = sqlite3.connect(path, timeout=LOCK_TIMEOUT, isolation_level=None)
+    try:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            return {'freed_pages': 0, 'not_incremental': True, 'seconds': round(time.perf_counter() - started, 3)}
+        pages_before = conn.execute('PRAGMA page_count').fetchone()[0]
+        # Only the pages free now: concurrent writes keep freeing a few more
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        for _ in range(math.ceil(free / VACUUM_STEP_PAGES)):
+            # execute() would stop after one step, freeing a single page; executescript() runs it to completion
+            conn.executescript(f'PRAGMA incremental_vacuum({VACUUM_STEP_PAGES});')
+            time.sleep(STEP_PAUSE)
+        freed = max(0, pages_before - conn.execute('PRAGMA page_count').fetchone()[0])
+        # In WAL mode the file only shrinks once the log is written back; a busy reader may postpone that
+        busy, _, _ = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+    finally:
+        conn.close()
+    return {'freed_pages': freed, 'checkpointed': not busy, 'seconds': round(time.perf_counter() - started, 3)}
+
+
+def convert_to_incremental(path: Optional[str] = None) -> dict:
+    """Switch a database created before incremental auto-vacuum, with one full VACUUM.
+
+    Not online: the VACUUM holds the write lock while it rewrites the whole file, and needs
+    about as much free disk space again as the database takes.
+    """
+    path = path or db.DB_PATH
+    started = time.perf_counter()
+    size = database_stats(path)['size_bytes']
+    free = shutil.disk_usage(os.path.dirname(os.path.abspath(path))).free
+    if free < 2 * size:
+        raise RuntimeError(f"Not enough free disk space: the VACUUM needs about {2 * size // (1024 * 1024)} MB")
+    conn = sqlite3.connect(path, timeout=LOCK_TIMEOUT, isolation_level=None)
+    try:
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('VACUUM')
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    finally:
+        conn.close()
+    return {'size_before': size, 'size_after': database_stats(path)['size_bytes'],
+            'seconds': round(time.perf_counter() - started, 3)}
+
+
+def optimize(path: Optional[str] = None) -> dict:
+    """Refresh query planner statistics where they are stale; cheap when nothing changed."""
+    started = time.perf_counter()
+    conn = sqlite3.connect(path or db.DB_PATH, timeout=LOCK_TIMEOUT, isolation_level=None)
+    try:
+        # analysis_limit bounds the work ANALYZE does per index on large tables
+        conn.executescript('PRAGMA analysis_limit=400; PRAGMA optimize;')
+    finally:
+        conn.close()
+    return {'seconds': round(time.perf_counter() - started, 3)}
+
+
+def _run(keep: int) -> dict:
+    result = {'started_at': time.time()}
+    for name, step in (('backup', lambda: backup(keep=keep)), ('vacuum', incremental_vacuum), ('optimize', optimize)):
+        try:
+            result[name] = step()
+        except Exception as e:
+            logger.error(f"Database maintenance: {name} failed: {e}")
+            result[name] = {'error': str(e)}
+    result['database'] = database_stats()
+    result['finished_at'] = time.time()
+    return result
+
+
+async def run_maintenance() -> dict:
+    """Back up, vacuum and optimize bot.db in a thread, then publish the results."""
+    async with _lock:
+        try:
+            keep = int(db.get_config('backups_kept', DEFAULT_BACKUPS_KEPT))
+        except (TypeError, ValueError):
+            keep = DEFAULT_BACKUPS_KEPT
+        result = await asyncio.to_thread(_run, keep)
+        db.set_metric('maintenance', result)
+        logger.info(f"Database maintenance done in {result['finished_at'] - result['started_at']:.1f}s")
+        return result
+
+
+async def run_conversion() -> dict:
+    """Convert bot.db to incremental auto-vacuum in a thread; never at the same time as maintenance."""
+    async with _lock:
+        logger.info("Switching the database to incremental auto-vacuum (full VACUUM)")
+        try:
+            result = await asyncio.to_thread(convert_to_incremental)
+        except Exception as e:
+            logger.error(f"Database conversion failed: {e}")
+            result = {'error': str(e)}
+        result['finished_at'] = time.time()
+        db.set_metric('vacuum_conversion', result)
+        return result
+
+
+def is_running() -> bool:
+    return _lock.locked()
+
+
+def is_due() -> bool:
+    try:
+        interval = float(db.get_config('maintenance_interval_hours', DEFAULT_INTERVAL_HOURS))
+    except (TypeError, ValueError):
+        interval = DEFAULT_INTERVAL_HOURS
+    if interval <= 0:
+        return False
+    last = db.get_metric('maintenance')
+    # The last run is stored in the database, so restarts don't trigger extra runs
+    return not last or time.time() - last.get('finished_at', 0) >= interval * 3600
+
+
+async def maintenance_loop():
+    """Run maintenance whenever it is due. Started by the WebUI process only."""
+    while True:
+        try:
+            if not is_running() and await asyncio.to_thread(is_due):
+                await run_maintenance()
+        except Exception as e:
+            logger.error(f"Database maintenance failed: {e}")
+        await asyncio.sleep(CHECK_INTERVAL)
@@ -0,0 +1,87 @@
+import hashlib
+from collections import OrderedDict
+from typing import Optional
+
+DEFAULT_IMAGE_BYTES = 64 * 1024 * 1024
+DEFAULT_ANSWERS = 1000
+
+
+class VisionCache:
+    """Photos and answers about them, keyed by Telegram's file_unique_id.
+
+    A forwarded photo keeps its file_unique_id, so repeats skip the download (images are kept
+    base64-encoded, ready for the prompt, up to max_bytes) and, when the question, model and
+    system prompt are the same too, the vision model. Both evict the least recently used entry.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_IMAGE_BYTES, max_answers: int = DEFAULT_ANSWERS):
+        self.max_bytes = max_bytes
+        self.max_answers = max_answers
+        self._images: "OrderedDict[str, str]" = OrderedDict()
+        self._answers: "OrderedDict[str, str]" = OrderedDict()
+        self.bytes = 0
+        self.image_hits = 0
+        self.answer_hits = 0
+
+    def configure(self, max_bytes: Optional[int] = None):
+        if max_bytes is not None:
+            self.max_bytes = max(0, max_bytes)
+            self._evict()
+
+    def get_image(self, file_unique_id: str) -> Optional[str]:
+        encoded = self._images.get(file_unique_id)
+        if encoded is not None:
+            self._images.move_to_end(file_unique_id)
+            self.image_hits += 1
+        return encoded
+
+    def put_image(self, file_unique_id: str, encoded: str):
+        if len(encoded) > self.max_bytes:
+            return
+        previous = self._images.pop(file_unique_id, None)
+        if previous is not None:
+            self.bytes -= len(previous)
+        self._images[file_unique_id] = encoded
+        self.bytes += len(encoded)
+        self._evict()
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self._images:
+            _, encoded = self._images.popitem(last=False)
+            self.bytes -= len(encoded)
+
+    @staticmethod
+    def answer_key(file_unique_id: str, prompt: str, model: str, system_prompt: str) -> str:
+        return hashlib.sha256("\0".join((file_unique_id, prompt, model, system_prompt)).encode("utf-8")).hexdigest()
+
+    def get_answer(self, key: str) -> Optional[str]:
+        answer = self._answers.get(key)
+        if answer is not None:
+            self._answers.move_to_end(key)
+            self.answer_hits += 1
+        return answer
+
+    def put_answer(self, key: str, answer: str):
+        self._answers[key] = answer
+        self._answers.move_to_end(key)
+        while len(self._answers) > self.max_answers:
+            self._answers.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            'images': len(self._images),
+            'image_mb': round(self.bytes / (1024 * 1024), 1),
+            'image_hits': self.image_hits,
+            'answers': len(self._answers),
+            'answer_hits': self.answer_hits,
+        }
+
+
+_vision_cache_instance: Optional[VisionCache] = None
+
+
+def get_vision_cache() -> VisionCache:
+    global _vision_cache_instance
+    if _vision_cache_instance is None:
+        _vision_cache_instance = VisionCache()
+    return _vision_cache_instance
@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from typing import Deque, Dict, Optional
+
+import db
+import paths
+
+logger = logging.getLogger(__name__)
+
+CONTROL_INTERVAL = 5.0
+FLUSH_INTERVAL = 10.0
+
+
+def folded_profile_path(process_name: str) -> str:
+    return paths.get_data_path(f"profile-{process_name}.folded")
+
+
+class LoopLagMonitor:
+    """Measures event loop lag: how late a periodic timer fires because something blocked the loop."""
+
+    def __init__(self, interval: float = 0.05, window: int = 1200):
+        self.interval = interval
+        self.samples: Deque[float] = deque(maxlen=window)
+        self.last_tick = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            self.last_tick = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - start - self.interval))
+
+    def stats(self) -> Dict[str, float]:
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {"samples": 0, "p50_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+        return {
+            "samples": len(ordered),
+            "p50_ms": ordered[len(ordered) // 2] * 1000,
+            "p99_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+            "max_ms": ordered[-1] * 1000,
+        }
+
+
+class StallWatchdog(threading.Thread):
+    """Logs the event loop thread's stack when the loop hasn't ticked for longer than threshold.
+
+    Unlike asyncio debug mode, this captures where the loop is stuck while it is still stuck,
+    at no cost to the loop itself.
+    """
+
+    def __init__(self, monitor: LoopLagMonitor, loop_thread_id: int, threshold: float = 0.1):
+        super().__init__(name="loop-watchdog", daemon=True)
+        self.monitor = monitor
+        self.loop_thread_id = loop_thread_id
+        self.threshold = threshold
+        self.stalls = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        reported_tick = None
+        while not self._stop_event.wait(self.threshold / 2):
+            if not self.monitor.running:
+                # The loop has shut down, a missing tick is not a stall
+                continue
+            tick = self.monitor.last_tick
+            # The monitor ticks every interval, so allow for that on top of the threshold
+            stalled_for = time.monotonic() - tick - self.monitor.interval
+            if stalled_for > self.threshold and tick != reported_tick:
+                reported_tick = tick
+                self.stalls += 1
+                frame = sys._current_frames().get(self.loop_thread_id)
+                stack = "".join(traceback.format_stack(frame)) if frame else "<no frame>"
+                logger.warning(f"Event loop blocked for over {stalled_for * 1000:.0f} ms at:\n{stack}")
+
+    def stop(self):
+        self._stop_event.set()
+
+
+class SamplingProfiler(threading.Thread):
+    """Samples one thread's stack at a fixed interval and aggregates flame-graph folded stacks."""
+
+    def __init__(self, thread_id: int, interval: float = 0.01):
+        super().__init__(name="sampling-profiler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            with self._lock:
+                self.stacks[";".join(reversed(names))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+
+    def folded(self) -> str:
+        """Stacks in `frame;frame;frame count` format, as consumed by flamegraph.pl and speedscope."""
+        with self._lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def profile_thread(thread_id: int, seconds: float, interval: float = 0.01) -> str:
+    """Blocking: sample thread_id for `seconds` and return folded stacks. Run it off the event loop."""
+    profiler = SamplingProfiler(thread_id, interval)
+    profiler.start()
+    time.sleep(seconds)
+    profiler.stop()
+    profiler.join()
+    return profiler.folded()
+
+
+class Instrumentation:
+    """Turns the lag monitor, stall watchdog and continuous profiler on and off from the settings."""
+
+    def __init__(self, process_name: str):
+        self.process_name = process_name
+        self.loop_thread_id = threading.get_ident()
+        self.monitor: Optional[LoopLagMonitor] = None
+        self.watchdog: Optional[StallWatchdog] = None
+        self.profiler: Optional[SamplingProfiler] = None
+        self._last_flush = 0.0
+
+    async def run(self):
+        while True:
+            try:
+                settings = await asyncio.to_thread(_read_settings)
+                self.apply(settings)
+                await self.publish()
+            except Exception as e:
+                logger.error(f"Instrumentation update failed: {e}")
+            await asyncio.sleep(CONTROL_INTERVAL)
+
+    def apply(self, settings: dict):
+        if settings['enabled'] and self.monitor is None:
+            self.monitor = LoopLagMonitor()
+            self.monitor.start()
+            logger.info(f"Loop lag monitoring enabled for {self.process_name}")
+        elif not settings['enabled'] and self.monitor is not None:
+            self.monitor.stop()
+            self.monitor = None
+
+        threshold = settings['slow_callback_ms'] / 1000.0
+        if self.monitor and (self.watchdog is None or self.watchdog.threshold != threshold):
+            if self.watchdog:
+                self.watchdog.stop()
+            self.watchdog = StallWatchdog(self.monitor, self.loop_thread_id, threshold)
+            self.watchdog.start()
+        elif not self.monitor and self.watchdog:
+            self.watchdog.stop()
+            self.watchdog = None
+
+        if settings['sampling'] and self.profiler is None:
+            self.profiler = SamplingProfiler(self.loop_thread_id)
+            self.profiler.start()
+        elif not settings['sampling'] and self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+
+    async def publish(self):
+        if self.monitor:
+            stats = self.monitor.stats()
+            stats['stalls'] = self.watchdog.stalls if self.watchdog else 0
+            stats['updated_at'] = time.time()
+            await asyncio.to_thread(db.set_metric, f'loop_lag_{self.process_name}', stats)
+        if self.profiler and time.monotonic() - self._last_flush >= FLUSH_INTERVAL:
+            self._last_flush = time.monotonic()
+            await asyncio.to_thread(_write_file, folded_profile_path(self.process_name), self.profiler.folded())
+
+
+def _read_settings() -> dict:
+    try:
+        slow_callback_ms = float(db.get_config('slow_callback_ms', 100))
+    except (TypeError, ValueError):
+        slow_callback_ms = 100.0
+    return {
+        'enabled': bool(db.get_config('profiling_enabled', False)),
+        'slow_callback_ms': slow_callback_ms,
+        'sampling': bool(db.get_config('sampling_profiler_enabled', False)),
+    }
+
+
+def _write_file(path: str, text: str):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+_instrumentation: Optional[Instrumentation] = None
+
+
+def start_instrumentation(process_name: str) -> Instrumentation:
+    """Start the settings-driven instrumentation task for this process; call from the event loop thread."""
+    global _instrumentation
+    if _instrumentation is None:
+        _instrumentation = Instrumentation(process_name)
+        asyncio.create_task(_instrumentation.run())
+    return _instrumentation
+
+
+def get_instrumentation() -> Optional[Instrumentation]:
+    return _instrumentation
@@ -0,0 +1,212 @@
+import asyncio
+import contextvars
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_LIMIT = 4096
+# Telegram allows roughly 30 messages/s per bot and about 1 message/s per chat
+GLOBAL_RATE = 25.0
+CHAT_RATE = 1.0
+MAX_RETRIES = 5
+WORKER_IDLE_TIMEOUT = 60.0
+
+# Preferred split points, best first
+_SEPARATORS = ("\n\n", "\n", ". ", " ")
+
+
+def _markup_cut(window: str) -> int:
+    """The last line break in window outside a ``` code block, or -1."""
+    for sep in ("\n\n", "\n"):
+        pos = window.rfind(sep)
+        while pos > 0:
+            if window.count("```", 0, pos) % 2 == 0:
+                return pos + len(sep)
+            pos = window.rfind(sep, 0, pos)
+    return -1
+
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT, markup: bool = False) -> List[str]:
+    """Split text into chunks of at most `limit` characters at paragraph, line, sentence or word boundaries.
+
+    With markup (the message has a parse_mode), chunks only end at line breaks outside code
+    blocks, so no entity is cut in two. A code block too long for one message is closed and
+    reopened around the break; other text without a line break is split like plain text.
+    """
+    strip = "\n" if markup else None
+    chunks = []
+    while len(text) > limit:
+        window = text[:limit]
+        cut = _markup_cut(window) if markup else -1
+        if markup and cut == -1:
+            # A code block longer than a message: close it at a line break and reopen it in the next chunk
+            pos = window.rfind("\n", 0, limit - len("\n```"))
+            if pos > len("```\n") and window.count("```", 0, pos) % 2:
+                chunks.append(text[:pos] + "\n```")
+                text = "```\n" + text[pos + 1:]
+                continue
+        if cut == -1:
+            for sep in _SEPARATORS:
+                pos = window.rfind(sep)
+                # Don't accept a boundary that leaves a tiny first chunk
+                if pos > limit // 2:
+                    cut = pos + len(sep)
+                    break
+        if cut == -1:
+            cut = limit
+        chunks.append(text[:cut].rstrip(strip))
+        text = text[cut:].lstrip(strip)
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+class RateLimiter:
+    """Spaces out calls to at most `rate` per second; pause() blocks everyone for a flood-control wait."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            ready_at = max(self._next, self._paused_until)
+            if ready_at > now:
+                await asyncio.sleep(ready_at - now)
+                now = time.monotonic()
+            self._next = now + self.interval
+
+
+@dataclass
+class _Outgoing:
+    bot: Bot
+    chat_id: int
+    chunks: List[str]
+    kwargs: dict
+    future: asyncio.Future = field(repr=False)
+    span: Optional[tracing.Span] = field(default=None, repr=False)
+
+
+class SendPipeline:
+    """Outbound Telegram queue: one ordered worker per chat, rate limited per chat and per bot.
+
+    send() returns immediately, so handlers don't wait on Telegram and chats are served concurrently.
+    """
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE,
+                 max_retries: int = MAX_RETRIES):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.max_retries = max_retries
+        self._queues: Dict[Tuple[int, int], asyncio.Queue] = {}
+        self._workers: Dict[Tuple[int, int], asyncio.Task] = {}
+        self._chat_limiters: Dict[Tuple[int, int], RateLimiter] = {}
+        self._bot_limiters: Dict[int, RateLimiter] = {}
+
+    def send(self, bot: Bot, chat_id: int, text: str, **kwargs) -> asyncio.Future:
+        """Queue text for chat_id, split into as many messages as needed."""
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+        key = (bot.id, chat_id)
+        queue = self._queues.setdefault(key, asyncio.Queue())
+        chunks = split_message(text, markup=bool(kwargs.get('parse_mode')))
+        # Covers queueing and rate limiting too, which is what the user actually waits for
+        span = tracing.start_span("telegram.send", chat_id=chat_id, chunks=len(chunks))
+        queue.put_nowait(_Outgoing(bot, chat_id, chunks, kwargs, future, span))
+
+        worker = self._workers.get(key)
+        if worker is None or worker.done():
+            # A fresh context: the worker outlives the request that happened to start it
+            self._workers[key] = asyncio.create_task(self._worker(key), context=contextvars.Context())
+        return future
+
+    def pending(self) -> int:
+        return sum(queue.qsize() for queue in self._queues.values())
+
+    async def _worker(self, key: Tuple[int, int]):
+        queue = self._queues[key]
+        while True:
+            try:
+                item = await asyncio.wait_for(queue.get(), WORKER_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    self._queues.pop(key, None)
+                    self._workers.pop(key, None)
+                    self._chat_limiters.pop(key, None)
+                    return
+                continue
+
+            error = None
+            try:
+                sent = []
+                for chunk in item.chunks:
+                    sent.append(await self._send_chunk(key, item, chunk))
+                if not item.future.done():
+                    item.future.set_result(sent)
+            except Exception as e:
+                error = e
+                logger.error(f"Failed to send message to chat {item.chat_id}: {e}")
+                if not item.future.done():
+                    item.future.set_exception(e)
+            finally:
+                if item.span:
+                    item.span.end(error)
+                queue.task_done()
+
+    async def _send_chunk(self, key: Tuple[int, int], item: _Outgoing, chunk: str):
+        chat_limiter = self._chat_limiters.setdefault(key, RateLimiter(self.chat_rate))
+        bot_limiter = self._bot_limiters.setdefault(item.bot.id, RateLimiter(self.global_rate))
+        kwargs = item.kwargs
+        for attempt in range(self.max_retries):
+            await chat_limiter.wait()
+            await bot_limiter.wait()
+            try:
+                return await item.bot.send_message(chat_id=item.chat_id, text=chunk, **kwargs)
+            except TelegramBadRequest as e:
+                if not kwargs.get('parse_mode'):
+                    raise
+                # Usually markup Telegram can't parse, e.g. a model's unbalanced `*` or `_`: send it as it is
+                logger.warning(f"Chat {item.chat_id} rejected a formatted message ({e}), sending it as plain text")
+                kwargs = {key: value for key, value in kwargs.items() if key != 'parse_mode'}
+            except TelegramRetryAfter as e:
+                # Flood control applies to the whole bot, so hold back every chat
+                logger.warning(f"Flood control for chat {item.chat_id}, retrying in {e.retry_after}s")
+                bot_limiter.pause(e.retry_after)
+                chat_limiter.pause(e.retry_after)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempt == self.max_retries - 1:
+                    raise
+                delay = 2 ** attempt
+                logger.warning(f"Send to chat {item.chat_id} failed ({e}), retrying in {delay}s")
+                chat_limiter.pause(delay)
+        raise RuntimeError(f"Gave up sending to chat {item.chat_id} after {self.max_retries} attempts")
+
+
+def _consume_exception(future: asyncio.Future):
+    # Callers usually don't await the future; the worker already logged the failure
+    if not future.cancelled():
+        future.exception()
+
+
+_pipeline_instance: Optional[SendPipeline] = None
+
+
+def get_send_pipeline() -> SendPipeline:
+    global _pipeline_instance
+    if _pipeline_instance is None:
+        _pipeline_instance = SendPipeline()
+    return _pipeline_instance
@@ -1,3 +1,7 @@
 from .router import AIRouter, get_router
+from .lifecycle import ModelLifecycleManager, get_model_manager
+from .fallback import FallbackPolicy, build_fallback_policy
+from .batching import BatchDispatcher, get_batch_dispatcher
 
-__all__ = ['AIRouter', 'get_router']
+__all__ = ['AIRouter', 'get_router', 'ModelLifecycleManager', 'get_model_manager', 'FallbackPolicy',
+           'build_fallback_policy', 'BatchDispatcher', 'get_batch_dispatcher']
@@ -1,7 +1,57 @@
+import asyncio
+import logging
+import time
 from abc import ABC, abstractmethod
-from typing import List, Dict, Any, Optional
+from typing import AsyncIterator, Awaitable, List, Dict, Any, Optional, TypeVar
 from dataclasses import dataclass
 
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+CAPABILITIES_RETRY_AFTER = 60.0
+
+
+def time_left(deadline: Optional[float]) -> Optional[float]:
+    """Seconds until a time.monotonic() deadline, or None when there is no deadline."""
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def request_timeout(deadline: Optional[float], default: float) -> float:
+    """HTTP timeout for a request that must finish by deadline; raises once no time is left."""
+    remaining = time_left(deadline)
+    if remaining is None:
+        return default
+    if remaining <= 0:
+        raise asyncio.TimeoutError()
+    return remaining
+
+
+async def with_deadline(aw: Awaitable[T], deadline: Optional[float]) -> T:
+    """Await aw, cancelling it (and closing any open HTTP stream) once the deadline passes."""
+    if deadline is None:
+        return await aw
+    return await asyncio.wait_for(aw, time_left(deadline))
+
+
+async def stream_with_deadline(chunks: AsyncIterator[T], deadline: Optional[float]) -> AsyncIterator[T]:
+    """Yield from chunks, raising asyncio.TimeoutError (and closing the stream) once the deadline passes."""
+    if deadline is None:
+        async for chunk in chunks:
+            yield chunk
+        return
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), time_left(deadline))
+            except StopAsyncIteration:
+                return
+            yield chunk
+    finally:
+        await chunks.aclose()
+
 
 @dataclass
 class Message:
@@ -15,6 +65,8 @@ class ChatResponse:
     model: str
     provider: str
     usage: Optional[Dict[str, int]] = None
+    # Backend-reported phase durations in milliseconds, e.g. Ollama's load/prompt_eval/eval
+    timings: Optional[Dict[str, float]] = None
 
 
 @dataclass
@@ -24,14 +76,30 @@ class Model:
     provider: str
 
 
+@dataclass
+class Capabilities:
+    vision: bool = False
+    streaming: bool = False
+    context_length: Optional[int] = None
+
+
 class AIProvider(ABC):
     name: str = "base"
     display_name: str = "Base Provider"
+    # Requests the backend serves in parallel, when the provider knows it
+    max_concurrency: Optional[int] = None
 
     @abstractmethod
-    async def chat(self, messages: List[Message], model: str) -> ChatResponse:
+    async def chat(self, messages: List[Message], model: str, deadline: Optional[float] = None) -> ChatResponse:
+        """Generate a reply. Cancelling the call must stop generation on the backend."""
         pass
 
+    async def stream(self, messages: List[Message], model: str,
+                     deadline: Optional[float] = None) -> AsyncIterator[str]:
+        """Yield the response text as it is generated. Falls back to a single chunk."""
+        response = await self.chat(messages, model, deadline=deadline)
+        yield response.text
+
     @abstractmethod
     async def list_models(self) -> List[Model]:
         pass
@@ -40,6 +108,38 @@ class AIProvider(ABC):
     async def health_check(self) -> bool:
         pass
 
+    async def embed(self, texts: List[str], model: str) -> List[List[float]]:
+        """One embedding vector per text, in order."""
+        raise NotImplementedError(f"{self.display_name} doesn't support embeddings")
+
+    async def load_model(self, model: str) -> float:
+        """Make the model resident on the backend and return the load time in seconds."""
+        return 0.0
+
+    async def get_capabilities(self, model: str) -> Capabilities:
+        """Capabilities of a model as reported by the backend, discovered once and cached."""
+        cache = self.__dict__.setdefault("_capabilities", {})
+        failed = self.__dict__.setdefault("_capabilities_failed", {})
+        if model not in cache:
+            fallback = Capabilities(vision=self.supports_vision(), streaming=self.supports_streaming())
+            # Capabilities are checked on every message, so don't hit a failing backend each time
+            if time.monotonic() - failed.get(model, float("-inf")) < CAPABILITIES_RETRY_AFTER:
+                return fallback
+            try:
+                cache[model] = await self.discover_capabilities(model)
+            except Exception as e:
+                failed[model] = time.monotonic()
+                logger.warning(f"Capability discovery for {model} on {self.name} failed: {e}")
+                return fallback
+            failed.pop(model, None)
+        return cache[model]
+
+    async def discover_capabilities(self, model: str) -> Capabilities:
+        return Capabilities(vision=self.supports_vision(), streaming=self.supports_streaming())
+
+    async def close(self):
+        pass
+
     def supports_vision(self) -> bool:
         return False
 
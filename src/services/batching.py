@@ -0,0 +1,236 @@
+import asyncio
+import contextvars
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+import tracing
+
+from .base import ChatResponse, Message
+from .router import AIRouter, get_router
+
+logger = logging.getLogger(__name__)
+
+PROBE_PROMPT = "Count from 1 to 30, separated by spaces."
+# A model whose probe failed is probed again on a request after this many seconds
+PROBE_RETRY_AFTER = 60.0
+
+
+@dataclass
+class _Request:
+    messages: List[Message]
+    model: str
+    provider_name: Optional[str]
+    deadline: Optional[float]
+    future: asyncio.Future
+    task: Optional[asyncio.Task] = None
+    # The submitter's context, so the request runs inside the submitter's trace
+    context: contextvars.Context = field(default_factory=contextvars.copy_context)
+    queued_at: float = field(default_factory=time.monotonic)
+
+
+@dataclass
+class BatchStats:
+    parallelism: int
+    requests: int = 0
+    completion_tokens: int = 0
+    busy_seconds: float = 0.0
+    in_flight: int = 0
+    active_since: float = 0.0
+    probed_tokens_per_second: Dict[int, float] = field(default_factory=dict)
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.completion_tokens / self.busy_seconds if self.busy_seconds else 0.0
+
+
+class BatchDispatcher:
+    """Groups concurrent requests for the same model and admits them to the backend together.
+
+    Requests arriving within `window` seconds of each other are released as one batch, earliest
+    deadline first, under a per-model concurrency limit. Backends with parallel decode slots
+    (LM Studio, Ollama with OLLAMA_NUM_PARALLEL) then schedule them into the same decode steps.
+
+    The limit of a model not probed yet is the provider's max_concurrency (else max_parallelism);
+    the first request for it starts a probe in the background. on_probe gets every probe result.
+    """
+
+    def __init__(self, router: AIRouter, window: float = 0.02, max_parallelism: int = 8,
+                 on_probe: Optional[Callable[[str, str, int], None]] = None):
+        self.router = router
+        self.window = window
+        self.max_parallelism = max_parallelism
+        self.on_probe = on_probe
+        self._queues: Dict[Tuple[str, str], List[_Request]] = {}
+        self._flushers: Dict[Tuple[str, str], asyncio.Task] = {}
+        self._limits: Dict[Tuple[str, str], asyncio.Semaphore] = {}
+        self._stats: Dict[Tuple[str, str], BatchStats] = {}
+        self._probes: Dict[Tuple[str, str], asyncio.Task] = {}
+        self._probe_failed: Dict[Tuple[str, str], float] = {}
+
+    def configure(self, window: Optional[float] = None, max_parallelism: Optional[int] = None):
+        if window is not None:
+            self.window = max(0.0, window)
+        if max_parallelism is not None:
+            self.max_parallelism = max(1, max_parallelism)
+
+    def _key(self, model: str, provider_name: Optional[str]) -> Tuple[str, str]:
+        return (provider_name or self.router.get_current_provider(), model)
+
+    def set_parallelism(self, model: str, parallelism: int, provider_name: Optional[str] = None):
+        key = self._key(model, provider_name)
+        parallelism = max(1, min(parallelism, self.max_parallelism))
+        self._limits[key] = asyncio.Semaphore(parallelism)
+        self._stats.setdefault(key, BatchStats(parallelism=parallelism)).parallelism = parallelism
+
+    def default_parallelism(self, provider_name: Optional[str] = None) -> int:
+        provider = self.router.get_provider(provider_name)
+        if provider and provider.max_concurrency:
+            return min(provider.max_concurrency, self.max_parallelism)
+        return self.max_parallelism
+
+    def get_parallelism(self, model: str, provider_name: Optional[str] = None) -> int:
+        stats = self._stats.get(self._key(model, provider_name))
+        return stats.parallelism if stats else self.default_parallelism(provider_name)
+
+    def is_probed(self, model: str, provider_name: Optional[str] = None) -> bool:
+        stats = self._stats.get(self._key(model, provider_name))
+        return bool(stats and stats.probed_tokens_per_second)
+
+    async def submit(self, messages: List[Message], model: str, provider_name: Optional[str] = None,
+                     deadline: Optional[float] = None) -> ChatResponse:
+        key = self._key(model, provider_name)
+        if key not in self._limits:
+            self.set_parallelism(model, self.default_parallelism(key[0]), key[0])
+        self._probe_in_background(key)
+
+        request = _Request(messages, model, provider_name, deadline, asyncio.get_running_loop().create_future())
+        self._queues.setdefault(key, []).append(request)
+        flusher = self._flushers.get(key)
+        if flusher is None or flusher.done():
+            self._flushers[key] = asyncio.create_task(self._flush_after_window(key))
+
+        try:
+            return await request.future
+        except asyncio.CancelledError:
+            # Either still queued (skipped at flush) or running: cancel so the backend stops generating
+            if request.task:
+                request.task.cancel()
+            raise
+
+    async def _flush_after_window(self, key: Tuple[str, str]):
+        await asyncio.sleep(self.window)
+        batch = [r for r in self._queues.pop(key, []) if not r.future.done()]
+        batch.sort(key=lambda r: r.deadline if r.deadline is not None else float("inf"))
+        for request in batch:
+            request.task = asyncio.create_task(self._run(key, request), context=request.context)
+
+    async def _run(self, key: Tuple[str, str], request: _Request):
+        stats = self._stats[key]
+        async with self._limits[key]:
+            tracing.set_attributes(batch_wait_ms=(time.monotonic() - request.queued_at) * 1000)
+            # busy_seconds is wall time with at least one request in flight, so tokens/s is aggregate
+            if stats.in_flight == 0:
+                stats.active_since = time.monotonic()
+            stats.in_flight += 1
+            try:
+                response = await self.router.chat(
+                    request.messages, request.model, provider_name=request.provider_name, deadline=request.deadline
+                )
+            except asyncio.CancelledError:
+                if not request.future.done():
+                    request.future.cancel()
+                raise
+            except Exception as e:
+                if not request.future.done():
+                    request.future.set_exception(e)
+                return
+            finally:
+                stats.in_flight -= 1
+                if stats.in_flight == 0:
+                    stats.busy_seconds += time.monotonic() - stats.active_since
+
+        stats.requests += 1
+        stats.completion_tokens += _completion_tokens(response)
+        if not request.future.done():
+            request.future.set_result(response)
+
+    def _probe_in_background(self, key: Tuple[str, str]):
+        if self.is_probed(key[1], key[0]) or (key in self._probes and not self._probes[key].done()):
+            return
+        if time.monotonic() - self._probe_failed.get(key, float("-inf")) < PROBE_RETRY_AFTER:
+            return
+        # Not part of any request's trace
+        self._probes[key] = asyncio.create_task(self._probe(key), context=contextvars.Context())
+
+    async def probe(self, model: str, provider_name: Optional[str] = None) -> Optional[int]:
+        """Find the degree of parallelism with the best aggregate tokens/s for a model.
+
+        Doubles the number of concurrent requests until throughput stops improving by at least 10%.
+        Returns None, keeping the current limit, when not even a single request succeeds.
+        """
+        key = self._key(model, provider_name)
+        task = self._probes.get(key)
+        if task is None or task.done():
+            task = self._probes[key] = asyncio.create_task(self._probe(key), context=contextvars.Context())
+        return await asyncio.shield(task)
+
+    async def _probe(self, key: Tuple[str, str]) -> Optional[int]:
+        provider_name, model = key
+        messages = [Message(role="user", content=PROBE_PROMPT)]
+        results: Dict[int, float] = {}
+        best, best_rate = 1, 0.0
+        n = 1
+        while n <= self.max_parallelism:
+            start = time.monotonic()
+            try:
+                responses = await asyncio.gather(*[
+                    self.router.chat(messages, model, provider_name=provider_name) for _ in range(n)
+                ])
+            except Exception as e:
+                logger.warning(f"Parallelism probe for {model} failed at {n} concurrent requests: {e}")
+                break
+            elapsed = time.monotonic() - start
+            rate = sum(_completion_tokens(r) for r in responses) / elapsed if elapsed else 0.0
+            results[n] = rate
+            logger.info(f"Probe {key[0]}/{model}: {n} parallel -> {rate:.1f} tokens/s")
+            if n > 1 and rate <= best_rate * 1.1:
+                break
+            best, best_rate = n, rate
+            n *= 2
+
+        if not results:
+            self._probe_failed[key] = time.monotonic()
+            return None
+        self.set_parallelism(model, best, provider_name)
+        self._stats[key].probed_tokens_per_second = results
+        self._probe_failed.pop(key, None)
+        logger.info(f"Using {best} parallel requests for {key[0]}/{model}")
+        if self.on_probe:
+            try:
+                self.on_probe(provider_name, model, best)
+            except Exception as e:
+                logger.warning(f"Recording the probe for {key[0]}/{model} failed: {e}")
+        return best
+
+    def stats(self) -> Dict[str, BatchStats]:
+        return {f"{provider}/{model}": stats for (provider, model), stats in self._stats.items()}
+
+
+def _completion_tokens(response: ChatResponse) -> int:
+    if response.usage and response.usage.get("completion_tokens"):
+        return response.usage["completion_tokens"]
+    # Rough estimate for backends that don't report usage
+    return len(response.text.split())
+
+
+_dispatcher_instance: Optional[BatchDispatcher] = None
+
+
+def get_batch_dispatcher(on_probe: Optional[Callable[[str, str, int], None]] = None) -> BatchDispatcher:
+    """The shared dispatcher; on_probe is only used by the call that creates it."""
+    global _dispatcher_instance
+    if _dispatcher_instance is None:
+        _dispatcher_instance = BatchDispatcher(get_router(), on_probe=on_probe)
+    return _dispatcher_instance
@@ -0,0 +1,113 @@
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+
+@dataclass
+class FallbackHop:
+    provider: str
+    model: str
+    timeout: float
+
+
+@dataclass
+class FallbackPolicy:
+    hops: List[FallbackHop] = field(default_factory=list)
+    timeout: float = 60.0
+    hedge_after: Optional[float] = None
+    failure_threshold: int = 3
+    reset_timeout: float = 30.0
+
+
+class CircuitOpen(RuntimeError):
+    """The hop's backend is skipped because its circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Opens after consecutive failures; lets a single trial request through once reset_timeout passes.
+
+    allow() takes that trial, so call it right before the request is made.
+    """
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            # Half-open: push the window forward so only one trial goes through
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def configure(self, failure_threshold: int, reset_timeout: float):
+        """Apply new thresholds, keeping the failure count; opens or closes the breaker if it now should."""
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        if self.failures >= failure_threshold:
+            if self.opened_at is None:
+                self.opened_at = time.monotonic()
+        else:
+            self.opened_at = None
+
+    def release(self):
+        """Give back a half-open trial that ended without an answer either way, e.g. when cancelled."""
+        if self.opened_at is not None:
+            self.opened_at = time.monotonic() - self.reset_timeout
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+def parse_fallback_chain(text: str, default_timeout: float) -> List[FallbackHop]:
+    """Parse one `provider:model [timeout_seconds]` entry per line.
+
+    Only the first colon separates the provider, so Ollama tags like `llama3:8b` work.
+    """
+    hops = []
+    for line in (text or "").splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        spec, *rest = line.split()
+        provider, _, model = spec.partition(":")
+        if not provider or not model:
+            continue
+        try:
+            timeout = float(rest[0]) if rest else default_timeout
+        except ValueError:
+            timeout = default_timeout
+        hops.append(FallbackHop(provider=provider, model=model, timeout=timeout))
+    return hops
+
+
+def _to_float(value, default: float) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def build_fallback_policy(chain: str, timeout=60.0, hedge_after_ms=None) -> Optional[FallbackPolicy]:
+    """Build a policy from the raw config values; None when no fallback hops are configured."""
+    timeout = _to_float(timeout, 60.0)
+    hops = parse_fallback_chain(chain, timeout)
+    if not hops:
+        return None
+    hedge_after_ms = _to_float(hedge_after_ms, 0.0)
+    hedge_after = hedge_after_ms / 1000.0 if hedge_after_ms > 0 else None
+    return FallbackPolicy(hops=hops, timeout=timeout, hedge_after=hedge_after)
@@ -0,0 +1,74 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .router import AIRouter, get_router
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class LoadRecord:
+    provider: str
+    model: str
+    seconds: float
+    loaded_at: float
+
+
+class ModelLifecycleManager:
+    """Pre-loads models on the backend so the first chat after a switch doesn't pay the load time."""
+
+    def __init__(self, router: AIRouter, on_load: Optional[Callable[[LoadRecord], None]] = None):
+        self.router = router
+        self.on_load = on_load
+        self._records: Dict[Tuple[str, str], LoadRecord] = {}
+        self._pending: Dict[Tuple[str, str], asyncio.Task] = {}
+
+    async def warm_up(self, model: str, provider_name: Optional[str] = None) -> Optional[float]:
+        name = provider_name or self.router.get_current_provider()
+        provider = self.router.get_provider(name)
+        if not provider:
+            return None
+        try:
+            seconds = await provider.load_model(model)
+        except Exception as e:
+            logger.warning(f"Failed to warm up {model} on {name}: {e}")
+            return None
+
+        record = LoadRecord(provider=name, model=model, seconds=seconds, loaded_at=time.time())
+        self._records[(name, model)] = record
+        logger.info(f"Model {model} is resident on {name} (load took {seconds:.2f}s)")
+        if self.on_load:
+            try:
+                self.on_load(record)
+            except Exception as e:
+                logger.error(f"Load callback failed: {e}")
+        return seconds
+
+    def schedule_warm_up(self, model: str, provider_name: Optional[str] = None) -> asyncio.Task:
+        name = provider_name or self.router.get_current_provider()
+        key = (name, model)
+        task = self._pending.get(key)
+        if task and not task.done():
+            return task
+
+        task = asyncio.create_task(self.warm_up(model, name))
+        self._pending[key] = task
+        task.add_done_callback(lambda t: self._pending.pop(key, None) if self._pending.get(key) is t else None)
+        return task
+
+    def load_times(self) -> List[LoadRecord]:
+        return sorted(self._records.values(), key=lambda r: r.loaded_at, reverse=True)
+
+
+_manager_instance: Optional[ModelLifecycleManager] = None
+
+
+def get_model_manager(on_load: Optional[Callable[[LoadRecord], None]] = None) -> ModelLifecycleManager:
+    """The shared manager; on_load is only used by the call that creates it."""
+    global _manager_instance
+    if _manager_instance is None:
+        _manager_instance = ModelLifecycleManager(get_router(), on_load)
+    return _manager_instance
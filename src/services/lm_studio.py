@@ -1,8 +1,11 @@
 import logging
-from typing import List
+import time
+from typing import AsyncIterator, List, Optional
+import httpx
 from openai import AsyncOpenAI
 
-from .base import AIProvider, Message, ChatResponse, Model
+from .base import (AIProvider, Capabilities, Message, ChatResponse, Model, request_timeout,
+                   stream_with_deadline, with_deadline)
 
 logger = logging.getLogger(__name__)
 
@@ -11,34 +14,93 @@ class LMStudioProvider(AIProvider):
     name = "lm_studio"
     display_name = "LM Studio"
 
-    def __init__(self, base_url: str = "http://127.0.0.1:1234/v1", api_key: str = "lm-studio"):
+    def __init__(self, base_url: str = "http://127.0.0.1:1234/v1", api_key: str = "lm-studio",
+                 keep_alive: Optional[str] = None):
         self.base_url = base_url
         self.api_key = api_key
         self.client = AsyncOpenAI(base_url=base_url, api_key=api_key)
+        # LM Studio unloads JIT-loaded models after a per-request TTL (seconds);
+        # without one, models stay loaded until LM Studio's own default expires.
+        self.ttl = None
+        try:
+            if keep_alive is not None and int(keep_alive) > 0:
+                self.ttl = int(keep_alive)
+        except (TypeError, ValueError):
+            pass
 
-    async def chat(self, messages: List[Message], model: str) -> ChatResponse:
-        openai_messages = [{"role": m.role, "content": m.content} for m in messages]
+    def _extra_body(self, **extra) -> Optional[dict]:
+        if self.ttl:
+            extra["ttl"] = self.ttl
+        return extra or None
 
-        completion = await self.client.chat.completions.create(
+    async def _open_stream(self, messages: List[Message], model: str, deadline: Optional[float]):
+        # Streaming lets cancellation close the HTTP response, which stops LM Studio generating
+        options = {}
+        if deadline is not None:
+            options["timeout"] = request_timeout(deadline, 120.0)
+        return await self.client.chat.completions.create(
             model=model,
-            messages=openai_messages
+            messages=[{"role": m.role, "content": m.content} for m in messages],
+            stream=True,
+            extra_body=self._extra_body(stream_options={"include_usage": True}),
+            **options
         )
 
-        usage = None
-        if completion.usage:
-            usage = {
-                "prompt_tokens": completion.usage.prompt_tokens,
-                "completion_tokens": completion.usage.completion_tokens,
-                "total_tokens": completion.usage.total_tokens
-            }
+    async def _collect(self, messages: List[Message], model: str, deadline: Optional[float]) -> ChatResponse:
+        parts, usage = [], None
+        stream = await self._open_stream(messages, model, deadline)
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                # Only sent by servers that honour stream_options.include_usage
+                chunk_usage = getattr(chunk, "usage", None)
+                if chunk_usage is not None and not isinstance(chunk_usage, dict):
+                    chunk_usage = chunk_usage.model_dump()
+                if chunk_usage:
+                    usage = {
+                        "prompt_tokens": chunk_usage.get("prompt_tokens", 0),
+                        "completion_tokens": chunk_usage.get("completion_tokens", 0),
+                        "total_tokens": chunk_usage.get("total_tokens", 0)
+                    }
+        finally:
+            await stream.close()
 
         return ChatResponse(
-            text=completion.choices[0].message.content or "",
+            text="".join(parts),
             model=model,
             provider=self.name,
             usage=usage
         )
 
+    async def chat(self, messages: List[Message], model: str, deadline: Optional[float] = None) -> ChatResponse:
+        return await with_deadline(self._collect(messages, model, deadline), deadline)
+
+    async def stream(self, messages: List[Message], model: str,
+                     deadline: Optional[float] = None) -> AsyncIterator[str]:
+        stream = await with_deadline(self._open_stream(messages, model, deadline), deadline)
+        try:
+            async for chunk in stream_with_deadline(stream.__aiter__(), deadline):
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            await stream.close()
+
+    async def embed(self, texts: List[str], model: str) -> List[List[float]]:
+        response = await self.client.embeddings.create(model=model, input=texts)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+    async def load_model(self, model: str) -> float:
+        # LM Studio loads models on first use, so a one-token completion warms it up
+        start = time.perf_counter()
+        await self.client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": "hi"}],
+            max_tokens=1,
+            extra_body=self._extra_body()
+        )
+        return time.perf_counter() - start
+
     async def list_models(self) -> List[Model]:
         try:
             response = await self.client.models.list()
@@ -47,6 +109,18 @@ class LMStudioProvider(AIProvider):
             logger.error(f"Failed to list models: {e}")
             return []
 
+    async def discover_capabilities(self, model: str) -> Capabilities:
+        # LM Studio's native REST API reports the model type and context size
+        root = self.base_url.rstrip('/')
+        if root.endswith("/v1"):
+            root = root[:-3]
+        async with httpx.AsyncClient(timeout=10.0) as client:
+            response = await client.get(f"{root}/api/v0/models/{model}")
+            response.raise_for_status()
+            data = response.json()
+        context_length = data.get("loaded_context_length") or data.get("max_context_length")
+        return Capabilities(vision=data.get("type") == "vlm", streaming=True, context_length=context_length)
+
     async def health_check(self) -> bool:
         try:
             await self.client.models.list()
@@ -54,10 +128,11 @@ class LMStudioProvider(AIProvider):
         except Exception:
             return False
 
+    async def close(self):
+        await self.client.close()
+
     def supports_vision(self) -> bool:
         return True
 
     def supports_streaming(self) -> bool:
         return True
-        """LM Studio supports streaming"""
-        return True
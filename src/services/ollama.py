@@ -1,18 +1,51 @@
+import json
 import logging
-from typing import List
+import time
+from typing import AsyncIterator, List, Optional, Union
 import httpx
 
-from .base import AIProvider, Message, ChatResponse, Model
+from .base import (AIProvider, Capabilities, Message, ChatResponse, Model, request_timeout,
+                   stream_with_deadline, with_deadline)
 
 logger = logging.getLogger(__name__)
 
+# Durations Ollama reports (in nanoseconds) on the final chunk of a reply
+TIMING_KEYS = ("total_duration", "load_duration", "prompt_eval_duration", "eval_duration")
+# Context window requested on every call. Ollama's own default (2048 or 4096 tokens, whatever the
+# model was trained for) silently truncates longer prompts, so the bot sets it and guards against it.
+DEFAULT_NUM_CTX = 8192
+
+
+def parse_keep_alive(value: Optional[str]) -> Optional[Union[int, str]]:
+    """Ollama accepts keep_alive as seconds (-1 pins forever) or a duration such as "30m"."""
+    if value is None or str(value).strip() == "":
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return str(value).strip()
+
 
 class OllamaProvider(AIProvider):
     name = "ollama"
     display_name = "Ollama"
 
-    def __init__(self, base_url: str = "http://127.0.0.1:11434"):
+    def __init__(self, base_url: str = "http://127.0.0.1:11434", keep_alive: Optional[str] = None,
+                 num_ctx: Optional[str] = None):
         self.base_url = base_url.rstrip('/')
+        self.keep_alive = parse_keep_alive(keep_alive)
+        try:
+            self.num_ctx = max(256, int(num_ctx)) if num_ctx not in (None, "") else DEFAULT_NUM_CTX
+        except (TypeError, ValueError):
+            self.num_ctx = DEFAULT_NUM_CTX
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # One pooled client: building a client per request costs an SSL context and a new connection each time
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(timeout=120.0)
+        return self._client
 
     def _convert_messages(self, messages: List[Message]) -> List[dict]:
         result = []
@@ -35,49 +68,136 @@ class OllamaProvider(AIProvider):
                 result.append(entry)
         return result
 
-    async def chat(self, messages: List[Message], model: str) -> ChatResponse:
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(
-                f"{self.base_url}/api/chat",
-                json={"model": model, "messages": self._convert_messages(messages), "stream": False}
-            )
+    def _build_payload(self, messages: List[Message], model: str, stream: bool) -> dict:
+        payload = {"model": model, "messages": self._convert_messages(messages), "stream": stream,
+                   "options": {"num_ctx": self.num_ctx}}
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+        return payload
+
+    async def _stream_chat(self, messages: List[Message], model: str,
+                           deadline: Optional[float]) -> AsyncIterator[dict]:
+        # Always stream: when the caller is cancelled the connection is closed
+        # and Ollama stops generating instead of finishing a reply nobody reads.
+        payload = self._build_payload(messages, model, stream=True)
+        async with self.client.stream("POST", f"{self.base_url}/api/chat", json=payload,
+                                      timeout=request_timeout(deadline, 120.0)) as response:
             response.raise_for_status()
-            data = response.json()
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                data = json.loads(line)
+                if data.get("error"):
+                    raise RuntimeError(data["error"])
+                yield data
+
+    async def _collect(self, messages: List[Message], model: str, deadline: Optional[float]) -> ChatResponse:
+        parts, final = [], {}
+        start = time.perf_counter()
+        first_token_ms = None
+        async for data in self._stream_chat(messages, model, deadline):
+            content = data.get("message", {}).get("content", "")
+            if content and first_token_ms is None:
+                first_token_ms = (time.perf_counter() - start) * 1000
+            parts.append(content)
+            if data.get("done"):
+                final = data
 
         usage = None
-        if "prompt_eval_count" in data or "eval_count" in data:
+        if "prompt_eval_count" in final or "eval_count" in final:
             usage = {
-                "prompt_tokens": data.get("prompt_eval_count", 0),
-                "completion_tokens": data.get("eval_count", 0),
-                "total_tokens": data.get("prompt_eval_count", 0) + data.get("eval_count", 0)
+                "prompt_tokens": final.get("prompt_eval_count", 0),
+                "completion_tokens": final.get("eval_count", 0),
+                "total_tokens": final.get("prompt_eval_count", 0) + final.get("eval_count", 0)
             }
 
+        timings = {key.replace("_duration", "_ms"): final[key] / 1e6 for key in TIMING_KEYS if final.get(key)}
+        if first_token_ms is not None:
+            timings["first_token_ms"] = first_token_ms
+
         return ChatResponse(
-            text=data.get("message", {}).get("content", ""),
+            text="".join(parts),
             model=model,
             provider=self.name,
-            usage=usage
+            usage=usage,
+            timings=timings or None
         )
 
+    async def chat(self, messages: List[Message], model: str, deadline: Optional[float] = None) -> ChatResponse:
+        return await with_deadline(self._collect(messages, model, deadline), deadline)
+
+    async def stream(self, messages: List[Message], model: str,
+                     deadline: Optional[float] = None) -> AsyncIterator[str]:
+        async for data in stream_with_deadline(self._stream_chat(messages, model, deadline), deadline):
+            chunk = data.get("message", {}).get("content", "")
+            if chunk:
+                yield chunk
+
+    async def embed(self, texts: List[str], model: str) -> List[List[float]]:
+        payload = {"model": model, "input": texts}
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+        response = await self.client.post(f"{self.base_url}/api/embed", json=payload)
+        response.raise_for_status()
+        return response.json()["embeddings"]
+
+    async def load_model(self, model: str) -> float:
+        # A generate request without a prompt only loads the model into memory. Same num_ctx as
+        # the chats, or the first chat would reload the model with a different context size.
+        payload = {"model": model, "options": {"num_ctx": self.num_ctx}}
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+        start = time.perf_counter()
+        response = await self.client.post(f"{self.base_url}/api/generate", json=payload, timeout=600.0)
+        response.raise_for_status()
+        data = response.json()
+        if data.get("load_duration"):
+            return data["load_duration"] / 1e9
+        return time.perf_counter() - start
+
     async def list_models(self) -> List[Model]:
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.get(f"{self.base_url}/api/tags")
-                response.raise_for_status()
-                data = response.json()
+            response = await self.client.get(f"{self.base_url}/api/tags", timeout=10.0)
+            response.raise_for_status()
+            data = response.json()
             return [Model(id=m["name"], name=m["name"], provider=self.name) for m in data.get("models", [])]
         except Exception as e:
             logger.error(f"Failed to list models: {e}")
             return []
 
+    async def discover_capabilities(self, model: str) -> Capabilities:
+        response = await self.client.post(f"{self.base_url}/api/show", json={"model": model}, timeout=10.0)
+        response.raise_for_status()
+        data = response.json()
+
+        trained = None
+        for key, value in (data.get("model_info") or {}).items():
+            if key.endswith(".context_length"):
+                trained = value
+        # Ollama runs with the num_ctx every request sends (it overrides a Modelfile's), capped at
+        # what the model was trained for: that is the window prompts must fit in
+        context_length = min(trained, self.num_ctx) if trained else self.num_ctx
+
+        capabilities = data.get("capabilities")
+        if capabilities is not None:
+            vision = "vision" in capabilities
+        else:
+            # Older Ollama versions: vision models ship a projector
+            vision = bool(data.get("projector_info")) or "clip" in (data.get("details") or {}).get("families", [])
+        return Capabilities(vision=vision, streaming=True, context_length=context_length)
+
     async def health_check(self) -> bool:
         try:
-            async with httpx.AsyncClient(timeout=5.0) as client:
-                response = await client.get(f"{self.base_url}/api/tags")
-                return response.status_code == 200
+            response = await self.client.get(f"{self.base_url}/api/tags", timeout=5.0)
+            return response.status_code == 200
         except Exception:
             return False
 
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
     def supports_vision(self) -> bool:
         return True
 
@@ -0,0 +1,157 @@
+import asyncio
+import json
+import logging
+import re
+from typing import AsyncIterator, List, Optional
+
+import httpx
+
+from .base import (AIProvider, Capabilities, Message, ChatResponse, Model, request_timeout,
+                   stream_with_deadline, with_deadline)
+
+logger = logging.getLogger(__name__)
+
+# Used when the server doesn't say whether a model accepts images
+VISION_MODEL_PATTERN = re.compile(r"llava|bakllava|vision|[-_]vl\b|[-_]vl[-_]|pixtral|minicpm-v|moondream|gemma-?3", re.I)
+
+
+class OpenAICompatProvider(AIProvider):
+    """Generic provider for OpenAI-compatible servers such as llama.cpp server and vLLM.
+
+    Uses one pooled HTTP client per endpoint and caps concurrent requests with a semaphore.
+    """
+
+    name = "openai_compat"
+    display_name = "OpenAI-Compatible"
+
+    def __init__(self, base_url: str = "http://127.0.0.1:8080/v1", api_key: str = "",
+                 max_concurrency: int = 8):
+        self.base_url = base_url.rstrip('/')
+        self.max_concurrency = max(1, int(max_concurrency))
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers=headers,
+            timeout=httpx.Timeout(120.0, connect=5.0),
+            limits=httpx.Limits(max_connections=self.max_concurrency,
+                                max_keepalive_connections=self.max_concurrency)
+        )
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._models: Optional[List[dict]] = None
+
+    def _server_root(self) -> str:
+        return self.base_url[:-3] if self.base_url.endswith("/v1") else self.base_url
+
+    async def _stream_events(self, messages: List[Message], model: str,
+                             deadline: Optional[float]) -> AsyncIterator[dict]:
+        payload = {
+            "model": model,
+            "messages": [{"role": m.role, "content": m.content} for m in messages],
+            "stream": True,
+            "stream_options": {"include_usage": True}
+        }
+        async with self._semaphore:
+            async with self.client.stream("POST", "/chat/completions", json=payload,
+                                          timeout=request_timeout(deadline, 120.0)) as response:
+                if response.status_code >= 400:
+                    await response.aread()
+                    response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    yield json.loads(data)
+
+    async def _collect(self, messages: List[Message], model: str, deadline: Optional[float]) -> ChatResponse:
+        parts, usage = [], None
+        async for event in self._stream_events(messages, model, deadline):
+            choices = event.get("choices") or []
+            if choices and choices[0].get("delta", {}).get("content"):
+                parts.append(choices[0]["delta"]["content"])
+            if event.get("usage"):
+                usage = {
+                    "prompt_tokens": event["usage"].get("prompt_tokens", 0),
+                    "completion_tokens": event["usage"].get("completion_tokens", 0),
+                    "total_tokens": event["usage"].get("total_tokens", 0)
+                }
+
+        return ChatResponse(
+            text="".join(parts),
+            model=model,
+            provider=self.name,
+            usage=usage
+        )
+
+    async def chat(self, messages: List[Message], model: str, deadline: Optional[float] = None) -> ChatResponse:
+        return await with_deadline(self._collect(messages, model, deadline), deadline)
+
+    async def stream(self, messages: List[Message], model: str,
+                     deadline: Optional[float] = None) -> AsyncIterator[str]:
+        async for event in stream_with_deadline(self._stream_events(messages, model, deadline), deadline):
+            choices = event.get("choices") or []
+            if choices and choices[0].get("delta", {}).get("content"):
+                yield choices[0]["delta"]["content"]
+
+    async def embed(self, texts: List[str], model: str) -> List[List[float]]:
+        async with self._semaphore:
+            response = await self.client.post("/embeddings", json={"model": model, "input": texts})
+        response.raise_for_status()
+        data = sorted(response.json()["data"], key=lambda item: item.get("index", 0))
+        return [item["embedding"] for item in data]
+
+    async def _fetch_models(self) -> List[dict]:
+        response = await self.client.get("/models", timeout=10.0)
+        response.raise_for_status()
+        self._models = response.json().get("data", [])
+        return self._models
+
+    async def list_models(self) -> List[Model]:
+        try:
+            models = await self._fetch_models()
+            return [Model(id=m["id"], name=m["id"], provider=self.name) for m in models]
+        except Exception as e:
+            logger.error(f"Failed to list models: {e}")
+            return []
+
+    async def discover_capabilities(self, model: str) -> Capabilities:
+        models = self._models if self._models is not None else await self._fetch_models()
+        info = next((m for m in models if m.get("id") == model), {})
+        meta = info.get("meta") or {}
+        # vLLM reports max_model_len, llama.cpp n_ctx_train in meta, others context_length
+        context_length = (info.get("max_model_len") or info.get("context_length")
+                          or info.get("max_context_length") or meta.get("n_ctx_train"))
+        vision = bool(VISION_MODEL_PATTERN.search(model))
+
+        # llama.cpp serves its runtime context size and modalities on /props
+        try:
+            response = await self.client.get(f"{self._server_root()}/props", timeout=5.0)
+            if response.status_code == 200:
+                props = response.json()
+                n_ctx = props.get("default_generation_settings", {}).get("n_ctx")
+                if n_ctx:
+                    context_length = n_ctx
+                if "modalities" in props:
+                    vision = bool(props["modalities"].get("vision"))
+        except httpx.HTTPError:
+            pass
+
+        return Capabilities(vision=vision, streaming=True,
+                            context_length=int(context_length) if context_length else None)
+
+    async def health_check(self) -> bool:
+        try:
+            response = await self.client.get("/models", timeout=5.0)
+            return response.status_code == 200
+        except Exception:
+            return False
+
+    async def close(self):
+        await self.client.aclose()
+
+    def supports_vision(self) -> bool:
+        return True
+
+    def supports_streaming(self) -> bool:
+        return True
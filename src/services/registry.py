@@ -0,0 +1,124 @@
+import importlib
+import logging
+from typing import Dict, List, Optional, Set, Type, Union
+
+from .base import AIProvider
+
+logger = logging.getLogger(__name__)
+
+ENTRY_POINT_GROUP = "aitgbot.providers"
+OPENAI_COMPAT = ".openai_compat:OpenAICompatProvider"
+
+# Built-in providers are referenced by import path so their dependencies load on first use
+BUILTIN_PROVIDERS: Dict[str, str] = {
+    "lm_studio": ".lm_studio:LMStudioProvider",
+    "ollama": ".ollama:OllamaProvider",
+    "openai_compat": OPENAI_COMPAT,
+}
+
+
+class ProviderRegistry:
+    """Maps provider names to AIProvider classes.
+
+    Targets are classes or "module:Class" paths (relative paths resolve inside this package).
+    Third-party packages can add providers through the `aitgbot.providers` entry point group;
+    admins can add them with `name = module:Class` lines in the provider_plugins setting.
+
+    Resolving a target imports its module, which runs that module's code in the bot and web
+    processes: provider_plugins is as powerful as shell access to the host.
+    """
+
+    def __init__(self):
+        self._targets: Dict[str, Union[str, Type[AIProvider]]] = dict(BUILTIN_PROVIDERS)
+        self._classes: Dict[str, Type[AIProvider]] = {}
+        # Targets that turned out not to be AIProvider subclasses, so they are not registered again
+        self._rejected: Set[str] = set()
+        self._entry_points_loaded = False
+
+    def register(self, name: str, target: Union[str, Type[AIProvider]]):
+        if isinstance(target, str) and target in self._rejected:
+            return
+        if self._targets.get(name) != target:
+            self._targets[name] = target
+            self._classes.pop(name, None)
+
+    def register_from_config(self, text: str):
+        for line in (text or "").splitlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            name, sep, target = line.partition("=")
+            if not sep or ":" not in target:
+                logger.warning(f"Ignoring invalid provider plugin line: {line}")
+                continue
+            if name.strip() in BUILTIN_PROVIDERS:
+                logger.warning(f"Ignoring provider plugin that would replace built-in provider: {line}")
+                continue
+            self.register(name.strip(), target.strip())
+
+    def load_entry_points(self):
+        if self._entry_points_loaded:
+            return
+        self._entry_points_loaded = True
+        try:
+            from importlib.metadata import entry_points
+            eps = entry_points()
+            group = eps.select(group=ENTRY_POINT_GROUP) if hasattr(eps, "select") else eps.get(ENTRY_POINT_GROUP, [])
+        except Exception as e:
+            logger.warning(f"Could not read provider entry points: {e}")
+            return
+        for ep in group:
+            # Stored as a path, so the plugin module is only imported when selected
+            self._targets.setdefault(ep.name, ep.value)
+
+    def names(self) -> List[str]:
+        self.load_entry_points()
+        return list(self._targets.keys())
+
+    def __contains__(self, name: str) -> bool:
+        self.load_entry_points()
+        return name in self._targets
+
+    def get_class(self, name: str) -> Type[AIProvider]:
+        if name in self._classes:
+            return self._classes[name]
+        self.load_entry_points()
+        target = path = self._targets[name]
+        if isinstance(target, str):
+            module_path, _, class_name = target.partition(":")
+            package = __package__ if module_path.startswith(".") else None
+            target = getattr(importlib.import_module(module_path, package), class_name)
+        if not (isinstance(target, type) and issubclass(target, AIProvider)):
+            logger.error(f"Skipping provider {name}: {path} is not an AIProvider subclass")
+            del self._targets[name]
+            if isinstance(path, str):
+                self._rejected.add(path)
+            raise TypeError(f"{path} is not an AIProvider subclass")
+        self._classes[name] = target
+        return target
+
+
+def parse_endpoints(text: str) -> List[dict]:
+    """Parse `name url [max_concurrency] [api_key]` lines describing OpenAI-compatible servers."""
+    endpoints = []
+    for line in (text or "").splitlines():
+        parts = line.split()
+        if len(parts) < 2 or parts[0].startswith("#"):
+            continue
+        endpoint = {"name": parts[0], "base_url": parts[1]}
+        if len(parts) > 2 and parts[2].isdigit():
+            endpoint["max_concurrency"] = int(parts[2])
+        if len(parts) > 3:
+            endpoint["api_key"] = parts[3]
+        endpoints.append(endpoint)
+    return endpoints
+
+
+_registry_instance: Optional[ProviderRegistry] = None
+
+
+def get_registry() -> ProviderRegistry:
+    global _registry_instance
+    if _registry_instance is None:
+        _registry_instance = ProviderRegistry()
+    return _registry_instance
@@ -1,38 +1,46 @@
+import asyncio
 import logging
-from typing import Dict, List, Optional, Type
+import time
+from typing import Dict, List, Optional, Set
 
-from .base import AIProvider, Message, ChatResponse, Model
-from .lm_studio import LMStudioProvider
-from .ollama import OllamaProvider
+import tracing
 
-logger = logging.getLogger(__name__)
+from .base import AIProvider, Capabilities, Message, ChatResponse, Model, time_left, with_deadline
+from .fallback import CircuitBreaker, CircuitOpen, FallbackHop, FallbackPolicy
+from .registry import get_registry
+from .tokens import get_estimator
 
-PROVIDERS: Dict[str, Type[AIProvider]] = {
-    "lm_studio": LMStudioProvider,
-    "ollama": OllamaProvider,
-}
+logger = logging.getLogger(__name__)
 
 DEFAULT_PROVIDER = "lm_studio"
+# A hop failing this close to a deadline the request imposed on it is taken to have run out of time
+DEADLINE_SLACK = 0.1
 
 
 class AIRouter:
     def __init__(self):
         self._instances: Dict[str, AIProvider] = {}
+        self._configs: Dict[str, dict] = {}
         self._current_provider: str = DEFAULT_PROVIDER
+        self._fallback_policy: Optional[FallbackPolicy] = None
+        self._breakers: Dict[str, CircuitBreaker] = {}
 
     def configure_provider(self, provider_name: str, **kwargs) -> bool:
-        if provider_name not in PROVIDERS:
+        if provider_name not in get_registry():
             logger.error(f"Unknown provider: {provider_name}")
             return False
-        try:
-            self._instances[provider_name] = PROVIDERS[provider_name](**kwargs)
+        # Keep the existing instance (and its loaded state) when nothing changed
+        if provider_name in self._configs and self._configs[provider_name] == kwargs:
             return True
-        except Exception as e:
-            logger.error(f"Failed to configure {provider_name}: {e}")
-            return False
+        # The instance is (re)built lazily on first use
+        self._configs[provider_name] = kwargs
+        old = self._instances.pop(provider_name, None)
+        if old:
+            _close_later(old)
+        return True
 
     def set_current_provider(self, provider_name: str) -> bool:
-        if provider_name not in PROVIDERS:
+        if provider_name not in get_registry():
             return False
         self._current_provider = provider_name
         return True
@@ -43,31 +51,228 @@ class AIRouter:
     def get_provider(self, provider_name: Optional[str] = None) -> Optional[AIProvider]:
         name = provider_name or self._current_provider
         if name not in self._instances:
-            self.configure_provider(name)
+            if name not in get_registry():
+                return None
+            try:
+                self._instances[name] = get_registry().get_class(name)(**self._configs.get(name, {}))
+            except Exception as e:
+                logger.error(f"Failed to configure {name}: {e}")
+                return None
         return self._instances.get(name)
 
-    async def chat(self, messages: List[Message], model: str, provider_name: Optional[str] = None) -> ChatResponse:
-        provider = self.get_provider(provider_name)
+    def set_fallback_policy(self, policy: Optional[FallbackPolicy]):
+        self._fallback_policy = policy
+        # Breakers are created on first use, so existing ones need the new thresholds too
+        policy = policy or FallbackPolicy()
+        for breaker in self._breakers.values():
+            breaker.configure(policy.failure_threshold, policy.reset_timeout)
+
+    def get_breaker(self, provider_name: str) -> CircuitBreaker:
+        if provider_name not in self._breakers:
+            policy = self._fallback_policy or FallbackPolicy()
+            self._breakers[provider_name] = CircuitBreaker(policy.failure_threshold, policy.reset_timeout)
+        return self._breakers[provider_name]
+
+    async def chat(self, messages: List[Message], model: str, provider_name: Optional[str] = None,
+                   deadline: Optional[float] = None) -> ChatResponse:
+        """Generate a reply; deadline is a time.monotonic() timestamp covering all fallback hops."""
+        # An explicitly requested provider bypasses the fallback chain
+        use_fallback = bool(self._fallback_policy and not provider_name)
+        with tracing.span("router.chat", model=model, fallback=use_fallback):
+            if use_fallback:
+                return await self._chat_with_fallback(messages, model, self._fallback_policy, deadline)
+            name = provider_name or self._current_provider
+            provider = self.get_provider(name)
+            if not provider:
+                raise ValueError(f"Provider not configured: {name}")
+            with tracing.span("provider.chat", provider=name, model=model) as span:
+                response = await provider.chat(messages, model, deadline=deadline)
+                _record_response(span, response, messages)
+                return response
+
+    async def _chat_with_fallback(self, messages: List[Message], model: str, policy: FallbackPolicy,
+                                  deadline: Optional[float]) -> ChatResponse:
+        hops = [FallbackHop(self._current_provider, model, policy.timeout)]
+        hops += [h for h in policy.hops if (h.provider, h.model) != (self._current_provider, model)]
+
+        # Hops skipped by an open breaker don't hide the error of a hop that was actually tried
+        last_error: Optional[BaseException] = None
+        i = 0
+        while i < len(hops):
+            try:
+                if policy.hedge_after is not None and i + 1 < len(hops):
+                    step = 2
+                    return await self._hedged_chat(messages, hops[i], hops[i + 1], policy.hedge_after, deadline)
+                step = 1
+                return await self._run_hop(messages, hops[i], deadline)
+            except CircuitOpen:
+                pass
+            except Exception as e:
+                last_error = e
+            i += step
+        raise last_error or RuntimeError("All AI backends are failing, try again later")
+
+    async def _run_hop(self, messages: List[Message], hop: FallbackHop, deadline: Optional[float],
+                       first_token: Optional[asyncio.Event] = None) -> ChatResponse:
+        remaining = time_left(deadline)
+        if remaining is not None and remaining <= 0:
+            raise asyncio.TimeoutError("Request deadline exceeded")
+        provider = self.get_provider(hop.provider)
+        if not provider:
+            raise ValueError(f"Provider not configured: {hop.provider}")
+        breaker = self.get_breaker(hop.provider)
+        # Asked only now, so a half-open breaker's trial goes to a request that is really made
+        trial = breaker.is_open
+        if not breaker.allow():
+            raise CircuitOpen(f"{hop.provider} is failing, skipped")
+        hop_deadline = time.monotonic() + (hop.timeout if remaining is None else min(hop.timeout, remaining))
+        try:
+            with tracing.span("provider.chat", provider=hop.provider, model=hop.model,
+                              streamed=first_token is not None) as span:
+                if first_token is None:
+                    response = await provider.chat(messages, hop.model, deadline=hop_deadline)
+                else:
+                    response = await with_deadline(
+                        self._collect_stream(provider, messages, hop, first_token, hop_deadline), hop_deadline
+                    )
+                _record_response(span, response, messages)
+        except asyncio.CancelledError:
+            if trial:
+                breaker.release()
+            raise
+        except Exception as e:
+            if remaining is not None and remaining < hop.timeout and time_left(hop_deadline) <= DEADLINE_SLACK:
+                # The request ran out of time, not the backend: a short deadline says nothing about its health
+                if trial:
+                    breaker.release()
+            else:
+                breaker.record_failure()
+            logger.warning(f"{hop.provider}/{hop.model} failed: {e!r}")
+            raise
+        breaker.record_success()
+        return response
+
+    async def _collect_stream(self, provider: AIProvider, messages: List[Message], hop: FallbackHop,
+                              first_token: asyncio.Event, deadline: float) -> ChatResponse:
+        parts = []
+        async for chunk in provider.stream(messages, hop.model, deadline=deadline):
+            parts.append(chunk)
+            first_token.set()
+        return ChatResponse(text="".join(parts), model=hop.model, provider=hop.provider)
+
+    async def _hedged_chat(self, messages: List[Message], primary: FallbackHop, secondary: FallbackHop,
+                           hedge_after: float, deadline: Optional[float]) -> ChatResponse:
+        """Start the secondary hop too if the primary hasn't produced a token within hedge_after seconds."""
+        events: Dict[asyncio.Task, asyncio.Event] = {}
+
+        def start(hop: FallbackHop) -> asyncio.Task:
+            event = asyncio.Event()
+            task = asyncio.create_task(self._run_hop(messages, hop, deadline, event))
+            events[task] = event
+            return task
+
+        pending: Set[asyncio.Task] = {start(primary)}
+        hedged = False
+        last_error: Optional[BaseException] = None
+        try:
+            while pending:
+                winner = await _first_token(pending, events, None if hedged else hedge_after)
+                if winner is None:
+                    logger.info(f"No token from {primary.provider}/{primary.model} yet, hedging to {secondary.provider}")
+                    pending.add(start(secondary))
+                    hedged = True
+                    continue
+                if winner.done() and winner.exception():
+                    if last_error is None or not isinstance(winner.exception(), CircuitOpen):
+                        last_error = winner.exception()
+                    pending.discard(winner)
+                    if not hedged:
+                        pending.add(start(secondary))
+                        hedged = True
+                    continue
+                for task in pending - {winner}:
+                    task.cancel()
+                pending = {winner}
+                return await winner
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def embed(self, texts: List[str], model: str, provider_name: Optional[str] = None) -> List[List[float]]:
+        """Embeddings from one provider only: vectors from different backends can't be compared."""
+        name = provider_name or self._current_provider
+        provider = self.get_provider(name)
         if not provider:
-            raise ValueError(f"Provider not configured: {provider_name or self._current_provider}")
-        return await provider.chat(messages, model)
+            raise ValueError(f"Provider not configured: {name}")
+        with tracing.span("provider.embed", provider=name, model=model, texts=len(texts)):
+            return await provider.embed(texts, model)
 
     async def list_models(self, provider_name: Optional[str] = None) -> List[Model]:
         provider = self.get_provider(provider_name)
         return await provider.list_models() if provider else []
 
     async def list_all_models(self) -> Dict[str, List[Model]]:
-        return {name: await self.list_models(name) for name in self._instances}
+        return {name: await self.list_models(name) for name in self._configs}
+
+    async def get_capabilities(self, model: str, provider_name: Optional[str] = None) -> Capabilities:
+        provider = self.get_provider(provider_name)
+        return await provider.get_capabilities(model) if provider else Capabilities()
 
     async def health_check(self, provider_name: Optional[str] = None) -> bool:
         provider = self.get_provider(provider_name)
         return await provider.health_check() if provider else False
 
+    async def close(self):
+        """Close every provider's connections, e.g. before the event loop stops."""
+        instances, self._instances = list(self._instances.values()), {}
+        for provider in instances:
+            await provider.close()
+
     def list_providers(self) -> List[str]:
-        return list(PROVIDERS.keys())
+        return get_registry().names()
 
     def list_configured_providers(self) -> List[str]:
-        return list(self._instances.keys())
+        return list(self._configs.keys())
+
+
+def _record_response(span: Optional[tracing.Span], response: ChatResponse, messages: List[Message]):
+    if span is not None:
+        span.set(**(response.usage or {}), **(response.timings or {}))
+    if response.usage and response.usage.get("prompt_tokens"):
+        # Real prompt token counts keep the context guard's estimates honest
+        get_estimator().observe(response.model, messages, response.usage["prompt_tokens"])
+
+
+def _close_later(provider: AIProvider):
+    """Close a replaced provider's connections without blocking the caller."""
+    try:
+        asyncio.get_running_loop().create_task(provider.close())
+    except RuntimeError:
+        pass
+
+
+async def _first_token(tasks: Set[asyncio.Task], events: Dict[asyncio.Task, asyncio.Event],
+                       timeout: Optional[float]) -> Optional[asyncio.Task]:
+    """Wait until one task has streamed a token or finished; None on timeout."""
+    def ready() -> Optional[asyncio.Task]:
+        for task in tasks:
+            if events[task].is_set():
+                return task
+        for task in tasks:
+            if task.done():
+                return task
+        return None
+
+    if ready():
+        return ready()
+    watchers = [asyncio.ensure_future(events[task].wait()) for task in tasks]
+    try:
+        await asyncio.wait(watchers + list(tasks), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for watcher in watchers:
+            watcher.cancel()
+    return ready()
 
 
 _router_instance: Optional[AIRouter] = None
@@ -0,0 +1,130 @@
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, Optional
+
+if TYPE_CHECKING:
+    import numpy as np
+
+DEFAULT_CAPACITY = 1000
+# Cosine similarity above which two questions count as the same. High on purpose: a wrong
+# cached answer costs more than a generation.
+DEFAULT_THRESHOLD = 0.95
+
+
+@dataclass
+class CacheEntry:
+    question: str
+    answer: str
+    # Generation time the entry saves on every hit
+    seconds: float
+
+
+@dataclass
+class CacheHit:
+    entry: CacheEntry
+    score: float
+
+
+def scope_id(*parts: str) -> int:
+    """Answers are only shared between requests with the same model, system prompt, etc."""
+    digest = hashlib.blake2b("\0".join(parts).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+class SemanticCache:
+    """Answers to earlier questions, found by embedding similarity so paraphrases hit too.
+
+    Vectors live in one preallocated matrix; a lookup is a single matrix-vector product with
+    rows from other scopes masked out. Full caches evict the least recently used answer.
+    Vectors must be unit length. The matrix (and numpy) is only set up by the first put.
+    """
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, threshold: float = DEFAULT_THRESHOLD):
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self._reset(capacity)
+
+    def _reset(self, capacity: int, dim: int = 0):
+        self.capacity = max(1, capacity)
+        self.dim = dim
+        self._vectors: Optional["np.ndarray"] = None
+        self._scopes: Optional["np.ndarray"] = None
+        self._used: Optional["np.ndarray"] = None
+        self._entries: Dict[int, CacheEntry] = {}
+        self._lru: "OrderedDict[int, None]" = OrderedDict()
+
+    def _allocate(self, dim: int):
+        import numpy as np
+        self.dim = dim
+        self._vectors = np.zeros((self.capacity, dim), dtype=np.float32)
+        self._scopes = np.zeros(self.capacity, dtype=np.int64)
+        self._used = np.zeros(self.capacity, dtype=bool)
+
+    def configure(self, capacity: Optional[int] = None, threshold: Optional[float] = None):
+        if threshold is not None:
+            self.threshold = threshold
+        if capacity is not None and max(1, capacity) != self.capacity:
+            self._reset(capacity, self.dim)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(self, scope: int, vector: "np.ndarray") -> Optional[CacheHit]:
+        if not self._entries or vector.shape[0] != self.dim:
+            self.misses += 1
+            return None
+        import numpy as np
+        scores = self._vectors @ vector
+        scores[~self._used | (self._scopes != scope)] = -np.inf
+        slot = int(np.argmax(scores))
+        score = float(scores[slot])
+        if score < self.threshold:
+            self.misses += 1
+            return None
+        self._lru.move_to_end(slot)
+        entry = self._entries[slot]
+        self.hits += 1
+        self.saved_seconds += entry.seconds
+        return CacheHit(entry, score)
+
+    def put(self, scope: int, vector: "np.ndarray", entry: CacheEntry):
+        if vector.shape[0] != self.dim:
+            # A different embedding model: old vectors can't be compared with new ones
+            self._reset(self.capacity, vector.shape[0])
+        if self._vectors is None:
+            self._allocate(self.dim)
+        if len(self._entries) < self.capacity:
+            slot = int(self._used.argmin())
+        else:
+            slot, _ = self._lru.popitem(last=False)
+        self._vectors[slot] = vector
+        self._scopes[slot] = scope
+        self._used[slot] = True
+        self._entries[slot] = entry
+        self._lru[slot] = None
+
+    def clear(self):
+        self._reset(self.capacity, self.dim)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'saved_gpu_s': round(self.saved_seconds, 1),
+        }
+
+
+_cache_instance: Optional[SemanticCache] = None
+
+
+def get_semantic_cache() -> SemanticCache:
+    global _cache_instance
+    if _cache_instance is None:
+        _cache_instance = SemanticCache()
+    return _cache_instance
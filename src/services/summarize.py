@@ -0,0 +1,190 @@
+import asyncio
+import hashlib
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+
+import tracing
+
+from .base import ChatResponse, Message
+from .router import AIRouter
+from .tokens import TokenEstimator, get_estimator, reply_reserve
+
+logger = logging.getLogger(__name__)
+
+CHUNK_TOKENS = 2000
+# Room for the instructions around a chunk
+PROMPT_TOKENS = 200
+MAX_CHUNKS = 100
+MAX_REDUCE_LEVELS = 3
+DEFAULT_CONCURRENCY = 2
+
+# Bump when MAP_PROMPT changes so cached summaries are not reused
+MAP_PROMPT_VERSION = "1"
+MAP_PROMPT = (
+    "You condense one part of a longer document. Write a dense summary that keeps facts, names, "
+    "numbers, dates, decisions and open questions. Reply with the summary only."
+)
+
+# Preferred split points, best first
+_SEPARATORS = ("\n\n", "\n", ". ", " ")
+
+
+class DocumentTooLargeError(ValueError):
+    def __init__(self, chunks: int):
+        super().__init__(f"Document has more than {chunks} parts")
+        self.chunks = chunks
+
+
+class TextChunker:
+    """Splits streamed text into pieces of at most max_tokens, at paragraph, line,
+    sentence or word boundaries. It buffers less than one chunk of the text itself;
+    what happens to the chunks it yields is up to the caller.
+    """
+
+    def __init__(self, model: str, max_tokens: int, estimator: Optional[TokenEstimator] = None):
+        estimator = estimator or get_estimator()
+        # Work in bytes: far cheaper than re-estimating tokens for every piece. The family ratio,
+        # not the calibrated one, so a file splits the same way every time and cached parts match.
+        self.max_bytes = max(200, int(max_tokens * estimator.family_bytes_per_token(model) / 1.1))
+        self._buffer = ""
+
+    def feed(self, text: str) -> Iterator[str]:
+        self._buffer += text
+        while len(self._buffer.encode("utf-8")) > self.max_bytes:
+            window = self._buffer[:self.max_bytes]
+            # Non-ASCII text takes more bytes per character, shrink the window until it fits
+            while len(window.encode("utf-8")) > self.max_bytes:
+                window = window[:len(window) * 3 // 4]
+            cut = len(window)
+            for sep in _SEPARATORS:
+                pos = window.rfind(sep)
+                if pos > len(window) // 2:
+                    cut = pos + len(sep)
+                    break
+            chunk = self._buffer[:cut].strip()
+            self._buffer = self._buffer[cut:]
+            if chunk:
+                yield chunk
+
+    def flush(self) -> Iterator[str]:
+        chunk = self._buffer.strip()
+        self._buffer = ""
+        if chunk:
+            yield chunk
+
+
+async def chunk_stream(pieces: AsyncIterator[str], chunker: TextChunker) -> AsyncIterator[str]:
+    async for piece in pieces:
+        for chunk in chunker.feed(piece):
+            yield chunk
+    for chunk in chunker.flush():
+        yield chunk
+
+
+def chunk_tokens(context_length: Optional[int]) -> int:
+    """Chunk size that leaves room for the instructions and the summary in the model's context."""
+    if not context_length:
+        return CHUNK_TOKENS
+    return max(256, min(CHUNK_TOKENS, context_length - reply_reserve(context_length) - PROMPT_TOKENS))
+
+
+# Shared by every summarizer, so documents sent at the same time split the backend's slots
+_limiters: Dict[Tuple[str, str], Tuple[int, asyncio.Semaphore]] = {}
+
+
+def chunk_limiter(provider: str, model: str, concurrency: int) -> asyncio.Semaphore:
+    """The semaphore all chunk calls to one provider and model go through."""
+    concurrency = max(1, concurrency)
+    limiter = _limiters.get((provider, model))
+    if limiter is None or limiter[0] != concurrency:
+        limiter = _limiters[(provider, model)] = (concurrency, asyncio.Semaphore(concurrency))
+    return limiter[1]
+
+
+class MapReduceSummarizer:
+    """Summarizes text far larger than the model's context.
+
+    Chunks are summarized as soon as they arrive (map), at most `concurrency` at a time for
+    all documents on the same backend and model, then
+    the summaries are combined (reduce), summarizing them again while they don't fit. Chunk
+    summaries are cached by content, so asking again about the same document, even with a
+    different question, only runs the chunks that didn't finish before.
+    """
+
+    def __init__(self, router: AIRouter, model: str, context_length: Optional[int] = None,
+                 concurrency: int = DEFAULT_CONCURRENCY, deadline: Optional[float] = None,
+                 cache_get: Optional[Callable[[str], Optional[str]]] = None,
+                 cache_set: Optional[Callable[[str, str], None]] = None,
+                 max_chunks: int = MAX_CHUNKS,
+                 chat: Optional[Callable[..., Awaitable[ChatResponse]]] = None):
+        self.router = router
+        # Called as chat(messages, model, deadline=...); the bot passes its batching dispatcher here
+        self._chat = chat or router.chat
+        self.model = model
+        self.context_length = context_length
+        self.max_tokens = chunk_tokens(context_length)
+        self.deadline = deadline
+        self.max_chunks = max_chunks
+        self._cache_get = cache_get
+        self._cache_set = cache_set
+        self._semaphore = chunk_limiter(router.get_current_provider(), model, concurrency)
+        self.chunks = 0
+        self.cached = 0
+
+    def chunker(self) -> TextChunker:
+        return TextChunker(self.model, self.max_tokens)
+
+    async def summarize_stream(self, pieces: AsyncIterator[str]) -> List[str]:
+        """Map step over streamed text; returns the chunk summaries in document order.
+
+        Every chunk gets its task as it arrives, so chunks waiting for a slot stay in memory:
+        up to max_chunks of them.
+        """
+        tasks: List[asyncio.Task] = []
+        try:
+            async for chunk in chunk_stream(pieces, self.chunker()):
+                if len(tasks) >= self.max_chunks:
+                    raise DocumentTooLargeError(self.max_chunks)
+                tasks.append(asyncio.create_task(self._summarize_chunk(chunk, len(tasks) + 1)))
+            self.chunks += len(tasks)
+            return list(await asyncio.gather(*tasks))
+        finally:
+            # On errors or cancellation, stop the chunks still generating
+            for task in tasks:
+                task.cancel()
+
+    async def reduce(self, summaries: List[str]) -> str:
+        """Combine chunk summaries until they fit in one prompt."""
+        text = _join(summaries)
+        estimator = get_estimator()
+        for level in range(MAX_REDUCE_LEVELS):
+            if estimator.count_text(text, self.model) <= self.max_tokens:
+                break
+
+            async def pieces():
+                yield text
+            with tracing.span("summarize.reduce", level=level + 1):
+                text = _join(await self.summarize_stream(pieces()))
+        return text
+
+    async def _summarize_chunk(self, chunk: str, index: int) -> str:
+        key = hashlib.sha256(f"{self.model}\0{MAP_PROMPT_VERSION}\0{chunk}".encode("utf-8")).hexdigest()
+        if self._cache_get:
+            cached = await asyncio.to_thread(self._cache_get, key)
+            if cached is not None:
+                self.cached += 1
+                return cached
+        async with self._semaphore:
+            with tracing.span("summarize.chunk", index=index):
+                response = await self._chat(
+                    [Message(role="system", content=MAP_PROMPT), Message(role="user", content=chunk)],
+                    self.model, deadline=self.deadline
+                )
+        summary = response.text.strip()
+        if self._cache_set and summary:
+            await asyncio.to_thread(self._cache_set, key, summary)
+        return summary
+
+
+def _join(summaries: List[str]) -> str:
+    return "\n\n".join(f"[Part {i}]\n{summary}" for i, summary in enumerate(summaries, 1))
@@ -0,0 +1,167 @@
+import math
+import re
+from typing import Dict, List, Optional, Tuple
+
+from .base import Message
+
+# UTF-8 bytes per token by model family. Counting bytes rather than characters keeps the
+# estimate reasonable for non-Latin scripts too: a CJK character is 3 bytes and ~1-2 tokens.
+FAMILY_BYTES_PER_TOKEN: List[Tuple[re.Pattern, float]] = [
+    (re.compile(r"llama-?3|llama3", re.I), 4.2),
+    (re.compile(r"qwen", re.I), 4.0),
+    (re.compile(r"gemma", re.I), 4.2),
+    (re.compile(r"deepseek", re.I), 4.0),
+    (re.compile(r"mistral|mixtral|ministral|codestral", re.I), 3.6),
+    (re.compile(r"phi", re.I), 3.6),
+    (re.compile(r"llama|vicuna|llava", re.I), 3.4),
+]
+DEFAULT_BYTES_PER_TOKEN = 3.6
+# Chat template tokens per message (role markers, separators)
+MESSAGE_OVERHEAD = 4
+# Typical cost of one image for vision models (LLaVA 576, Qwen-VL and others more)
+IMAGE_TOKENS = 768
+# Observed ratios are trusted only within this range
+MIN_BYTES_PER_TOKEN, MAX_BYTES_PER_TOKEN = 1.5, 8.0
+CALIBRATION_WEIGHT = 0.2
+# Estimates err on the long side, so a prompt near the limit is not sent and then truncated
+SAFETY_MARGIN = 1.1
+
+TRUNCATION_NOTE = "\n\n[...message truncated to fit the model's context]"
+
+
+class PromptTooLongError(ValueError):
+    def __init__(self, tokens: int, limit: int):
+        super().__init__(f"Prompt is about {tokens} tokens, the model accepts {limit}")
+        self.tokens = tokens
+        self.limit = limit
+
+
+class TokenEstimator:
+    """Fast token counts without a tokenizer: a per-family bytes-per-token ratio,
+    calibrated per model from the prompt token counts backends report.
+    """
+
+    def __init__(self):
+        self._calibrated: Dict[str, float] = {}
+        self._family: Dict[str, float] = {}
+
+    def bytes_per_token(self, model: str) -> float:
+        ratio = self._calibrated.get(model)
+        if ratio is not None:
+            return ratio
+        return self.family_bytes_per_token(model)
+
+    def family_bytes_per_token(self, model: str) -> float:
+        """The uncalibrated ratio, which stays the same for a model across runs."""
+        if model not in self._family:
+            self._family[model] = next(
+                (ratio for pattern, ratio in FAMILY_BYTES_PER_TOKEN if pattern.search(model)),
+                DEFAULT_BYTES_PER_TOKEN
+            )
+        return self._family[model]
+
+    def count_text(self, text: str, model: str) -> int:
+        return math.ceil(len(text.encode("utf-8")) / self.bytes_per_token(model))
+
+    def count_messages(self, messages: List[Message], model: str) -> int:
+        text_bytes, images = _measure(messages)
+        raw = text_bytes / self.bytes_per_token(model) + images * IMAGE_TOKENS
+        return math.ceil((raw + MESSAGE_OVERHEAD * len(messages)) * SAFETY_MARGIN)
+
+    def observe(self, model: str, messages: List[Message], prompt_tokens: int):
+        """Calibrate the model's ratio from a prompt token count reported by the backend."""
+        text_bytes, images = _measure(messages)
+        text_tokens = prompt_tokens - MESSAGE_OVERHEAD * len(messages) - images * IMAGE_TOKENS
+        # Short prompts are dominated by template tokens and say little about the tokenizer
+        if text_bytes < 200 or text_tokens <= 0:
+            return
+        observed = min(MAX_BYTES_PER_TOKEN, max(MIN_BYTES_PER_TOKEN, text_bytes / text_tokens))
+        current = self._calibrated.get(model)
+        self._calibrated[model] = observed if current is None else (
+            current + CALIBRATION_WEIGHT * (observed - current)
+        )
+
+    def truncate(self, text: str, model: str, max_tokens: int) -> str:
+        """Cut text to roughly max_tokens, keeping the beginning."""
+        budget = int(max(0, max_tokens) / SAFETY_MARGIN * self.bytes_per_token(model))
+        data = text.encode("utf-8")
+        if len(data) <= budget:
+            return text
+        return data[:budget].decode("utf-8", "ignore").rstrip()
+
+
+def _measure(messages: List[Message]) -> Tuple[int, int]:
+    text_bytes = images = 0
+    for message in messages:
+        if isinstance(message.content, str):
+            text_bytes += len(message.content.encode("utf-8"))
+        elif isinstance(message.content, list):
+            for part in message.content:
+                if not isinstance(part, dict):
+                    continue
+                if part.get("type") == "text":
+                    text_bytes += len(part.get("text", "").encode("utf-8"))
+                elif part.get("type") == "image_url":
+                    images += 1
+    return text_bytes, images
+
+
+def reply_reserve(context_length: int) -> int:
+    """Tokens kept free for the model's answer."""
+    return min(1024, context_length // 4)
+
+
+def fit_to_context(messages: List[Message], model: str, context_length: Optional[int], policy: str = "reject",
+                   estimator: Optional["TokenEstimator"] = None) -> List[Message]:
+    """Check messages against the model's context before anything is sent.
+
+    With policy "trim" the oldest non-system messages are dropped and then the last message's
+    text is truncated; otherwise PromptTooLongError is raised. Unknown context lengths pass.
+    """
+    if not context_length:
+        return messages
+    estimator = estimator or get_estimator()
+    limit = context_length - reply_reserve(context_length)
+    tokens = estimator.count_messages(messages, model)
+    if tokens <= limit:
+        return messages
+    if policy != "trim":
+        raise PromptTooLongError(tokens, limit)
+
+    messages = list(messages)
+    while len(messages) > 2 and estimator.count_messages(messages, model) > limit:
+        # Keep the system prompt and the newest message
+        messages.pop(1)
+    if estimator.count_messages(messages, model) <= limit:
+        return messages
+
+    # Budget for the last message's text: whatever the rest of the prompt leaves free
+    last = messages[-1]
+    if isinstance(last.content, str):
+        base = messages[:-1] + [Message(role=last.role, content=TRUNCATION_NOTE)]
+        budget = limit - estimator.count_messages(base, model) - 1
+        content = estimator.truncate(last.content, model, budget) + TRUNCATION_NOTE
+    else:
+        stripped = [{**p, "text": TRUNCATION_NOTE} if isinstance(p, dict) and p.get("type") == "text" else p
+                    for p in last.content]
+        rest = messages[:-1] + [Message(role=last.role, content=stripped)]
+        budget = limit - estimator.count_messages(rest, model) - 1
+        content = [{**p, "text": estimator.truncate(p.get("text", ""), model, budget) + TRUNCATION_NOTE}
+                   if isinstance(p, dict) and p.get("type") == "text" else p
+                   for p in last.content]
+    messages[-1] = Message(role=last.role, content=content)
+    # The system prompt alone (or an image) may not fit either
+    tokens = estimator.count_messages(messages, model)
+    if tokens > limit:
+        raise PromptTooLongError(tokens, limit)
+    return messages
+
+
+_estimator_instance: Optional[TokenEstimator] = None
+
+
+def get_estimator() -> TokenEstimator:
+    global _estimator_instance
+    if _estimator_instance is None:
+        _estimator_instance = TokenEstimator()
+    return _estimator_instance
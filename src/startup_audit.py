@@ -0,0 +1,113 @@
+import importlib
+import importlib.abc
+import sys
+import time
+from typing import Dict, List
+
+
+class ImportTimer(importlib.abc.MetaPathFinder):
+    """Meta path hook that records cumulative and self import time per module.
+
+    Unlike `python -X importtime` this also works inside the frozen executable.
+    """
+
+    def __init__(self):
+        self.cumulative: Dict[str, float] = {}
+        self.self_time: Dict[str, float] = {}
+        self._child_time: List[float] = []
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TimedLoader(spec.loader, fullname, self)
+                return spec
+        return None
+
+    def _enter(self):
+        self._child_time.append(0.0)
+
+    def _exit(self, name: str, elapsed: float):
+        children = self._child_time.pop()
+        self.cumulative[name] = elapsed
+        self.self_time[name] = elapsed - children
+        if self._child_time:
+            self._child_time[-1] += elapsed
+
+
+class _TimedLoader:
+    def __init__(self, loader, name: str, timer: ImportTimer):
+        self._loader = loader
+        self._name = name
+        self._timer = timer
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        # Put the real loader back so code inspecting __loader__ sees what it expects
+        module.__loader__ = self._loader
+        if module.__spec__ is not None:
+            module.__spec__.loader = self._loader
+        self._timer._enter()
+        start = time.perf_counter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            self._timer._exit(self._name, time.perf_counter() - start)
+
+    def __getattr__(self, attr):
+        return getattr(self._loader, attr)
+
+
+def _timed(label: str, func, results: List[tuple]):
+    start = time.perf_counter()
+    try:
+        func()
+        status = ""
+    except Exception as e:
+        status = f" ({type(e).__name__}: {e})"
+    results.append((label, time.perf_counter() - start, status))
+
+
+def run_audit(top: int = 25):
+    """Import both process entry points and print where startup time goes."""
+    timer = ImportTimer()
+    timer.install()
+    steps: List[tuple] = []
+    try:
+        _timed("db.init_db()", lambda: importlib.import_module('db').init_db(), steps)
+        _timed("import services", lambda: importlib.import_module('services'), steps)
+        _timed("import web", lambda: importlib.import_module('web'), steps)
+        # Fails without a bot token, but the imports it needs are still timed
+        _timed("import bot", lambda: importlib.import_module('bot'), steps)
+    finally:
+        timer.uninstall()
+
+    print("aitgbot startup audit" + (" (frozen)" if getattr(sys, 'frozen', False) else ""))
+    print("-" * 60)
+    for label, elapsed, status in steps:
+        print(f"{elapsed * 1000:10.1f} ms  {label}{status}")
+
+    packages: Dict[str, float] = {}
+    for name, elapsed in timer.self_time.items():
+        root = name.split('.')[0]
+        packages[root] = packages.get(root, 0.0) + elapsed
+
+    print(f"\nTop {top} packages by total import time:")
+    for root, elapsed in sorted(packages.items(), key=lambda x: x[1], reverse=True)[:top]:
+        print(f"{elapsed * 1000:10.1f} ms  {root}")
+
+    print(f"\nTop {top} modules (cumulative / self):")
+    for name, elapsed in sorted(timer.cumulative.items(), key=lambda x: x[1], reverse=True)[:top]:
+        print(f"{elapsed * 1000:10.1f} ms {timer.self_time[name] * 1000:10.1f} ms  {name}")
@@ -0,0 +1,81 @@
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import db
+
+# Settings a hosted bot can override; backends, limits and caches are shared by all bots
+TENANT_CONFIG_KEYS = ('model', 'system_prompt', 'access_password')
+
+
+def bot_id_from_token(token: str) -> int:
+    """Telegram bot tokens start with the bot's user ID."""
+    bot_id, _, secret = token.strip().partition(':')
+    if not bot_id.isdigit() or not secret:
+        raise ValueError("Invalid bot token")
+    return int(bot_id)
+
+
+@dataclass
+class Tenant:
+    bot_id: int
+    name: str
+    # Users and invites live in their own collections per namespace; '' is the primary bot's
+    namespace: str = ''
+    overrides: dict = field(default_factory=dict)
+
+    @property
+    def is_primary(self) -> bool:
+        return not self.namespace
+
+    def get_config(self, key, default=None):
+        value = self.overrides.get(key)
+        if value not in (None, ''):
+            return value
+        return db.get_config(key, default)
+
+    def set_config(self, key, value):
+        if self.is_primary:
+            db.set_config(key, value)
+            return
+        self.overrides[key] = value
+        db.update_doc('bots', self.bot_id, {'config': self.overrides})
+
+
+def primary_bot_id() -> Optional[int]:
+    try:
+        return bot_id_from_token(db.get_config('bot_token', ''))
+    except ValueError:
+        return None
+
+
+def get_tenant(bot_id: int) -> Optional[Tenant]:
+    """The tenant a bot serves, or None for a bot that was removed or disabled since it started polling.
+
+    Only the bot of the primary token gets the global settings and users.
+    """
+    if bot_id == primary_bot_id():
+        return Tenant(bot_id, 'primary')
+    doc = db.get_bot(bot_id)
+    if not doc or not doc.get('enabled', True):
+        return None
+    return Tenant(bot_id, doc.get('name') or str(bot_id), str(bot_id), dict(doc.get('config') or {}))
+
+
+def tokens_to_serve() -> List[str]:
+    """The primary bot token followed by every enabled hosted bot."""
+    primary = db.get_config('bot_token', '')
+    tokens = [primary] if primary else []
+    for doc in db.get_bots():
+        if doc.get('enabled', True) and doc.get('token') and doc['token'] not in tokens:
+            tokens.append(doc['token'])
+    return tokens
+
+
+def models_to_serve() -> List[str]:
+    """The primary bot's model followed by every other model an enabled hosted bot uses."""
+    models = [db.get_config('model', 'local-model')]
+    for doc in db.get_bots():
+        model = (doc.get('config') or {}).get('model')
+        if doc.get('enabled', True) and model and model not in models:
+            models.append(model)
+    return models
@@ -0,0 +1,204 @@
+import contextvars
+import json
+import logging
+import os
+import queue
+import secrets
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Iterator, List, Optional
+
+import paths
+
+logger = logging.getLogger(__name__)
+
+TRACE_PATH = paths.get_data_path("traces.jsonl")
+RING_SIZE = 200
+MAX_FILE_BYTES = 5 * 1024 * 1024
+
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+
+class Trace:
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: List["Span"] = []
+        self.open = 0
+        self.finished = False
+
+
+class Span:
+    def __init__(self, trace: Trace, name: str, parent: Optional["Span"], attributes: dict):
+        self.trace = trace
+        self.name = name
+        self.span_id = secrets.token_hex(4)
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.error: Optional[str] = None
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+        self.duration_ms: Optional[float] = None
+        trace.spans.append(self)
+        trace.open += 1
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, error: Optional[BaseException] = None):
+        if self.duration_ms is not None:
+            return
+        self.duration_ms = (time.perf_counter() - self._t0) * 1000
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}" if str(error) else type(error).__name__
+        self.trace.open -= 1
+        # Detached spans (e.g. a queued Telegram send) can outlive the root, export once all are done
+        if self.trace.open == 0:
+            _finish(self.trace)
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def current_trace_id() -> Optional[str]:
+    span = _current_span.get()
+    return span.trace.trace_id if span else None
+
+
+def set_attributes(**attributes):
+    span = _current_span.get()
+    if span is not None:
+        span.set(**attributes)
+
+
+@contextmanager
+def _enter(new_span: Span) -> Iterator[Span]:
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.end(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        new_span.end()
+
+
+def start_trace(name: str, **attributes):
+    """Context manager for the root span of a new trace, e.g. one Telegram update."""
+    return _enter(Span(Trace(secrets.token_hex(8)), name, None, attributes))
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Optional[Span]]:
+    """Child span of the current one. Outside a trace this does nothing, so it is cheap to leave in place."""
+    parent = _current_span.get()
+    if parent is None or parent.trace.finished:
+        yield None
+        return
+    with _enter(Span(parent.trace, name, parent, attributes)) as child:
+        yield child
+
+
+def start_span(name: str, parent: Optional[Span] = None, **attributes) -> Optional[Span]:
+    """A span that is ended explicitly with .end(), for work handed off to another task."""
+    parent = parent or _current_span.get()
+    if parent is None or parent.trace.finished:
+        return None
+    return Span(parent.trace, name, parent, attributes)
+
+
+def _to_dict(trace: Trace) -> dict:
+    root = trace.spans[0]
+    return {
+        "trace_id": trace.trace_id,
+        "name": root.name,
+        "start": root.start,
+        "duration_ms": round(max(s.start * 1000 + s.duration_ms for s in trace.spans) - root.start * 1000, 3),
+        "attributes": root.attributes,
+        "error": next((s.error for s in trace.spans if s.error), None),
+        "spans": [{
+            "name": s.name,
+            "span_id": s.span_id,
+            "parent_id": s.parent_id,
+            "offset_ms": round((s.start - root.start) * 1000, 3),
+            "duration_ms": round(s.duration_ms, 3),
+            "attributes": s.attributes,
+            "error": s.error,
+        } for s in trace.spans],
+    }
+
+
+_recent: Deque[dict] = deque(maxlen=RING_SIZE)
+
+
+def _finish(trace: Trace):
+    trace.finished = True
+    record = _to_dict(trace)
+    _recent.append(record)
+    _get_exporter().export(record)
+
+
+def recent_traces(limit: int = 50) -> List[dict]:
+    """Most recent traces finished in this process, newest first."""
+    return list(reversed(_recent))[:limit]
+
+
+class JSONLExporter(threading.Thread):
+    """Appends finished traces to a JSONL file from a background thread, so the event loop never waits on disk."""
+
+    def __init__(self, path: str, max_bytes: int = MAX_FILE_BYTES):
+        super().__init__(name="trace-exporter", daemon=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._queue: "queue.SimpleQueue[dict]" = queue.SimpleQueue()
+
+    def export(self, record: dict):
+        self._queue.put(record)
+
+    def run(self):
+        while True:
+            lines = [json.dumps(self._queue.get(), default=str)]
+            while not self._queue.empty():
+                lines.append(json.dumps(self._queue.get(), default=str))
+            try:
+                self._write(lines)
+            except Exception as e:
+                logger.error(f"Failed to export traces: {e}")
+
+    def _write(self, lines: List[str]):
+        if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+            os.replace(self.path, self.path + ".1")
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+_exporter: Optional[JSONLExporter] = None
+_exporter_lock = threading.Lock()
+
+
+def _get_exporter() -> JSONLExporter:
+    global _exporter
+    with _exporter_lock:
+        if _exporter is None:
+            _exporter = JSONLExporter(TRACE_PATH)
+            _exporter.start()
+    return _exporter
+
+
+def read_traces(limit: int = 100, path: Optional[str] = None) -> List[dict]:
+    """Most recent exported traces from the JSONL file, newest first. Blocking: reads the file."""
+    path = path or TRACE_PATH
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        lines = deque(f, maxlen=limit)
+    traces = []
+    for line in reversed(lines):
+        try:
+            traces.append(json.loads(line))
+        except ValueError:
+            continue
+    return traces
@@ -1,15 +1,26 @@
+import asyncio
+from datetime import datetime
 import os
+import time
 import logging
-import requests
-from fastapi import FastAPI, Request, Form
-from fastapi.responses import RedirectResponse, HTMLResponse
+from urllib.parse import quote
+from fastapi import FastAPI, Request, Form, File, UploadFile
+from fastapi.responses import RedirectResponse, HTMLResponse, PlainTextResponse, JSONResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from starlette.middleware.sessions import SessionMiddleware
 
 import db
+import documents
+import knowledge
+import maintenance
 import paths
-from services import get_router
-from services import get_router
+import profiling
+import tenants
+import tracing
+from ai_config import configure_router, prepare_model
+from dashboard_feed import get_dashboard_feed
+from job_queue import DEFAULT_WORKERS
+from services.semantic_cache import DEFAULT_CAPACITY, DEFAULT_THRESHOLD
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +39,17 @@ def is_authenticated(request: Request) -> bool:
     return request.session.get("authenticated") is True
 
 
+@app.on_event("startup")
+async def start_instrumentation():
+    profiling.start_instrumentation("web")
+
+
+@app.on_event("startup")
+async def start_maintenance():
+    # One scheduler for both processes: the WebUI's, so bot handlers never wait on it
+    asyncio.create_task(maintenance.maintenance_loop())
+
+
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
     if is_authenticated(request):
@@ -49,39 +71,92 @@ async def logout(request: Request):
     return RedirectResponse(url="/")
 
 
+USERS_PAGE_SIZE = 50
+MODELS_CACHE_TTL = 30.0
+
+# provider -> (fetched_at, model ids); listing models can take seconds on a busy backend
+_models_cache = {}
+
+
+def _user_row(user):
+    return {
+        'user_id': user.get('user_id'),
+        'username': user.get('username'),
+        'is_admin': bool(user.get('is_admin')),
+        'is_super_admin': bool(user.get('is_super_admin')),
+        'authorized_at': user.get('created_at'),
+        'key': user['key']
+    }
+
+
+def _users_page(after, limit):
+    users = [_user_row(u) for u in db.get_users_page(after or None, limit)]
+    version = db.get_users_version()
+    return {
+        'users': users,
+        'next': users[-1]['key'] if len(users) == limit else None,
+        'total': version['count'],
+        'version': version
+    }
+
+
+async def _list_model_ids(router, provider, refresh=False):
+    cached = _models_cache.get(provider)
+    if cached and not refresh and time.monotonic() - cached[0] < MODELS_CACHE_TTL:
+        return cached[1]
+    try:
+        models = [m.id for m in await router.list_models(provider)]
+    except Exception as e:
+        logger.warning(f"Could not fetch models from {provider}: {e}")
+        return cached[1] if cached else []
+    _models_cache[provider] = (time.monotonic(), models)
+    return models
+
+
 @app.get("/dashboard", response_class=HTMLResponse)
-async def dashboard(request: Request):
+async def dashboard(request: Request, after: str = ""):
     if not is_authenticated(request):
         return RedirectResponse(url="/")
 
-    router = get_router()
-    current_provider = db.get_config("ai_provider", "lm_studio")
-    
-    # Configure the router's current provider
-    router.set_current_provider(current_provider)
-    
-    # Configure providers based on saved settings
+    router = configure_router()
+    current_provider = router.get_current_provider()
     lm_studio_url = db.get_config("lm_studio_url", "http://127.0.0.1:1234/v1")
     ollama_url = db.get_config("ollama_url", "http://127.0.0.1:11434")
-    
-    router.configure_provider("lm_studio", base_url=lm_studio_url)
-    router.configure_provider("ollama", base_url=ollama_url)
-    
-    # Get models from current provider
-    try:
-        models = await router.list_models(current_provider)
-    except Exception as e:
-        logger.warning(f"Could not fetch models from {current_provider}: {e}")
-        models = []
-    
-    users = db.get_users()
+
+    # Models are only served from the cache here; the page fetches a fresh list itself
+    cached = _models_cache.get(current_provider)
+    models = cached[1] if cached else []
+
+    users_page = await asyncio.to_thread(_users_page, after, USERS_PAGE_SIZE)
     access_password = db.get_config("access_password", "secret")
     current_model = db.get_config("model", "local-model")
     system_prompt = db.get_config("system_prompt", "You are a helpful assistant.")
+    keep_alive = db.get_config("keep_alive", "-1")
+    ollama_num_ctx = db.get_config("ollama_num_ctx", "")
+    model_load = db.get_metric("model_load")
+    fallback_chain = db.get_config("fallback_chain", "")
+    fallback_timeout = db.get_config("fallback_timeout", 60)
+    hedge_after_ms = db.get_config("hedge_after_ms", 0)
+    request_timeout = db.get_config("request_timeout", 120)
+    supersede_stale = db.get_config("supersede_stale", False)
+    context_overflow = db.get_config("context_overflow", "reject")
+    batching_enabled = db.get_config("batching_enabled", False)
+    batch_window_ms = db.get_config("batch_window_ms", 20)
+    batch_max_parallel = db.get_config("batch_max_parallel", 8)
+    job_queue_enabled = db.get_config("job_queue_enabled", False)
+    job_queue_workers = db.get_config("job_queue_workers", DEFAULT_WORKERS)
+    batch_parallelism = db.get_metric("batch_parallelism_by_model") or {}
+    model_capabilities = db.get_metric("model_capabilities")
+    openai_endpoints = db.get_config("openai_endpoints", "")
+    provider_plugins = db.get_config("provider_plugins", "")
 
     return templates.TemplateResponse("dashboard.html", {
         "request": request,
-        "users": users,
+        "users": users_page["users"],
+        "users_next": users_page["next"],
+        "users_total": users_page["total"],
+        "users_after": after,
+        "users_version": users_page["version"],
         "models": models,
         "current_model": current_model,
         "current_provider": current_provider,
@@ -89,9 +164,68 @@ async def dashboard(request: Request):
         "access_password": access_password,
         "lm_studio_url": lm_studio_url,
         "ollama_url": ollama_url,
+        "keep_alive": keep_alive,
+        "ollama_num_ctx": ollama_num_ctx,
+        "model_load": model_load,
+        "fallback_chain": fallback_chain,
+        "fallback_timeout": fallback_timeout,
+        "hedge_after_ms": hedge_after_ms,
+        "request_timeout": request_timeout,
+        "supersede_stale": supersede_stale,
+        "context_overflow": context_overflow,
+        "batching_enabled": batching_enabled,
+        "batch_window_ms": batch_window_ms,
+        "batch_max_parallel": batch_max_parallel,
+        "job_queue_enabled": job_queue_enabled,
+        "job_queue_workers": job_queue_workers,
+        "batch_parallelism": batch_parallelism,
+        "model_capabilities": model_capabilities,
+        "openai_endpoints": openai_endpoints,
+        "provider_plugins": provider_plugins,
         "providers": router.list_providers()
     })
 
+@app.get("/api/users")
+async def api_users(request: Request, after: str = "", limit: int = USERS_PAGE_SIZE):
+    if not is_authenticated(request):
+        return JSONResponse({"error": "Not authenticated"}, status_code=401)
+    return await asyncio.to_thread(_users_page, after, max(1, min(limit, 500)))
+
+
+@app.get("/api/models")
+async def api_models(request: Request, refresh: bool = False):
+    if not is_authenticated(request):
+        return JSONResponse({"error": "Not authenticated"}, status_code=401)
+    router = configure_router()
+    provider = router.get_current_provider()
+    return {
+        "provider": provider,
+        "current": db.get_config("model", "local-model"),
+        "models": await _list_model_ids(router, provider, refresh)
+    }
+
+
+@app.get("/api/status")
+async def api_status(request: Request):
+    if not is_authenticated(request):
+        return JSONResponse({"error": "Not authenticated"}, status_code=401)
+    feed = get_dashboard_feed()
+    await feed.poll(force_health=True)
+    return feed.snapshot()
+
+
+@app.get("/api/events")
+async def api_events(request: Request):
+    """Server-sent events: users, health and activity, each pushed when it changes."""
+    if not is_authenticated(request):
+        return JSONResponse({"error": "Not authenticated"}, status_code=401)
+    return StreamingResponse(
+        get_dashboard_feed().stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @app.post("/update_config")
 async def update_config(
     request: Request,
@@ -100,7 +234,22 @@ async def update_config(
     model: str = Form(...),
     system_prompt: str = Form(...),
     lm_studio_url: str = Form(...),
-    ollama_url: str = Form(...)
+    ollama_url: str = Form(...),
+    keep_alive: str = Form("-1"),
+    ollama_num_ctx: str = Form(""),
+    fallback_chain: str = Form(""),
+    fallback_timeout: str = Form("60"),
+    hedge_after_ms: str = Form("0"),
+    request_timeout: str = Form("120"),
+    supersede_stale: bool = Form(False),
+    context_overflow: str = Form("reject"),
+    batching_enabled: bool = Form(False),
+    batch_window_ms: str = Form("20"),
+    batch_max_parallel: str = Form("8"),
+    job_queue_enabled: bool = Form(False),
+    job_queue_workers: str = Form("4"),
+    openai_endpoints: str = Form(""),
+    provider_plugins: str = Form("")
 ):
     if not is_authenticated(request):
         return RedirectResponse(url="/")
@@ -111,7 +260,25 @@ async def update_config(
     db.set_config("system_prompt", system_prompt)
     db.set_config("lm_studio_url", lm_studio_url)
     db.set_config("ollama_url", ollama_url)
-    
+    db.set_config("keep_alive", keep_alive.strip())
+    db.set_config("ollama_num_ctx", ollama_num_ctx.strip())
+    db.set_config("fallback_chain", fallback_chain.strip())
+    db.set_config("fallback_timeout", fallback_timeout.strip())
+    db.set_config("hedge_after_ms", hedge_after_ms.strip())
+    db.set_config("request_timeout", request_timeout.strip())
+    db.set_config("supersede_stale", supersede_stale)
+    db.set_config("context_overflow", "trim" if context_overflow == "trim" else "reject")
+    db.set_config("batching_enabled", batching_enabled)
+    db.set_config("batch_window_ms", batch_window_ms.strip())
+    db.set_config("batch_max_parallel", batch_max_parallel.strip())
+    db.set_config("job_queue_enabled", job_queue_enabled)
+    db.set_config("job_queue_workers", job_queue_workers.strip())
+    db.set_config("openai_endpoints", openai_endpoints.strip())
+    db.set_config("provider_plugins", provider_plugins.strip())
+
+    # Load the (possibly new) model now rather than on the first user message
+    asyncio.create_task(prepare_model(model))
+
     return RedirectResponse(url="/dashboard", status_code=303)
 
 
@@ -124,15 +291,97 @@ async def settings(request: Request):
         'bot_token': db.get_config('bot_token', ''),
         'webui_password': db.get_config('webui_password', 'admin'),
         'secret_key': db.get_config('secret_key', 'change-me-in-production'),
-        'access_password': db.get_config('access_password', 'secret')
+        'access_password': db.get_config('access_password', 'secret'),
+        'profiling_enabled': db.get_config('profiling_enabled', False),
+        'slow_callback_ms': db.get_config('slow_callback_ms', 100),
+        'sampling_profiler_enabled': db.get_config('sampling_profiler_enabled', False),
+        'embedding_model': db.get_config('embedding_model', ''),
+        'retrieval_top_k': db.get_config('retrieval_top_k', knowledge.DEFAULT_TOP_K),
+        'retrieval_min_score': db.get_config('retrieval_min_score', knowledge.DEFAULT_MIN_SCORE),
+        'semantic_cache_enabled': db.get_config('semantic_cache_enabled', False),
+        'semantic_cache_threshold': db.get_config('semantic_cache_threshold', DEFAULT_THRESHOLD),
+        'semantic_cache_size': db.get_config('semantic_cache_size', DEFAULT_CAPACITY),
+        'vision_cache_mb': db.get_config('vision_cache_mb', 64),
+        'maintenance_interval_hours': db.get_config('maintenance_interval_hours', maintenance.DEFAULT_INTERVAL_HOURS),
+        'backups_kept': db.get_config('backups_kept', maintenance.DEFAULT_BACKUPS_KEPT)
     }
-    
+    loop_lag = {name: db.get_metric(f'loop_lag_{name}') for name in ('bot', 'web')}
+    knowledge_base = knowledge.get_knowledge_base()
+    await knowledge_base.refresh()
+    hosted_bots = await asyncio.to_thread(_hosted_bots)
+    last_maintenance = db.get_metric('maintenance')
+    if last_maintenance:
+        last_maintenance['finished'] = datetime.fromtimestamp(last_maintenance['finished_at']).strftime('%Y-%m-%d %H:%M')
+
     return templates.TemplateResponse("settings.html", {
         "request": request, 
-        "config": config
+        "config": config,
+        "loop_lag": loop_lag,
+        "hosted_bots": hosted_bots,
+        "database": await asyncio.to_thread(maintenance.database_stats),
+        "maintenance": last_maintenance,
+        "maintenance_running": maintenance.is_running(),
+        "conversion": db.get_metric('vacuum_conversion'),
+        "knowledge": {
+            'model': knowledge_base.model,
+            'passages': knowledge_base.size,
+            'documents': [
+                {**doc, 'added': datetime.fromtimestamp(doc['added_at']).strftime('%Y-%m-%d %H:%M')}
+                for doc in knowledge_base.documents()
+            ]
+        }
     })
 
 
+def _hosted_bots():
+    # Tokens are secrets: the page only shows bot IDs
+    return [{
+        'bot_id': doc['key'],
+        'name': doc.get('name', ''),
+        'model': (doc.get('config') or {}).get('model', ''),
+        'users': db.count_users(doc['key'])
+    } for doc in db.get_bots()]
+
+
+@app.post("/bots/save")
+async def save_bot(
+    request: Request,
+    token: str = Form(...),
+    name: str = Form(""),
+    model: str = Form(""),
+    system_prompt: str = Form(""),
+    access_password: str = Form("")
+):
+    if not is_authenticated(request):
+        return RedirectResponse(url="/")
+
+    try:
+        bot_id = tenants.bot_id_from_token(token)
+    except ValueError as e:
+        return RedirectResponse(url=f"/settings?bots_error={quote(str(e))}#bots", status_code=303)
+    primary = db.get_config('bot_token', '')
+    if primary and primary.partition(':')[0] == str(bot_id):
+        return RedirectResponse(url=f"/settings?bots_error={quote('This is the primary bot token.')}#bots",
+                                status_code=303)
+    # Empty fields fall back to the global settings
+    overrides = {'model': model.strip(), 'system_prompt': system_prompt, 'access_password': access_password}
+    db.save_bot(bot_id, {
+        'token': token.strip(),
+        'name': name.strip() or str(bot_id),
+        'enabled': True,
+        'config': {key: value for key, value in overrides.items() if value}
+    })
+    return RedirectResponse(url="/settings?saved=1#bots", status_code=303)
+
+
+@app.post("/bots/remove")
+async def remove_bot(request: Request, bot_id: str = Form(...)):
+    if not is_authenticated(request):
+        return RedirectResponse(url="/")
+    db.remove_bot(bot_id)
+    return RedirectResponse(url="/settings?saved=1#bots", status_code=303)
+
+
 @app.post("/update_app_config")
 async def update_app_config(
     request: Request,
@@ -153,6 +402,194 @@ async def update_app_config(
     return RedirectResponse(url="/settings?saved=1", status_code=303)
 
 
+@app.post("/update_diagnostics")
+async def update_diagnostics(
+    request: Request,
+    profiling_enabled: bool = Form(False),
+    slow_callback_ms: str = Form("100"),
+    sampling_profiler_enabled: bool = Form(False)
+):
+    if not is_authenticated(request):
+        return RedirectResponse(url="/")
+
+    # Both processes pick these up within a few seconds, no restart needed
+    db.set_config("profiling_enabled", profiling_enabled)
+    db.set_config("slow_callback_ms", slow_callback_ms.strip())
+    db.set_config("sampling_profiler_enabled", sampling_profiler_enabled)
+
+    return RedirectResponse(url="/settings?saved=1", status_code=303)
+
+
+@app.post("/update_maintenance")
+async def update_maintenance(
+    request: Request,
+    maintenance_interval_hours: str = Form("24"),
+    backups_kept: str = Form("7")
+):
+    if not is_authenticated(request):
+        return RedirectResponse(url="/")
+
+    db.set_config("maintenance_interval_hours", maintenance_interval_hours.strip())
+    db.set_config("backups_kept", backups_kept.strip())
+
+    return RedirectResponse(url="/settings?saved=1#maintenance", status_code=303)
+
+
+@app.post("/maintenance/run")
+async def run_maintenance(request: Request):
+    if not is_authenticated(request):
+        return RedirectResponse(url="/")
+    if not maintenance.is_running():
+        asyncio.create_task(maintenance.run_maintenance())
+    return RedirectResponse(url="/settings#maintenance", status_code=303)
+
+
+@app.post("/maintenance/convert")
+async def convert_database(request: Request):
+    if not is_authenticated(request):
+        return RedirectResponse(url="/")
+    if not maintenance.is_running():
+        asyncio.create_task(maintenance.run_conversion())
+    return RedirectResponse(url="/settings#maintenance", status_code=303)
+
+
+@app.post("/update_knowledge")
+async def update_knowledge(
+    request: Request,
+    embedding_model: str = Form(""),
+    retrieval_top_k: str = Form("3"),
+    retrieval_min_score: str = Form("0.3"),
+    semantic_cache_enabled: bool = Form(False),
+    semantic_cache_threshold: str = Form("0.95"),
+    semantic_cache_size: str = Form("1000"),
+    vision_cache_mb: str = Form("64")
+):
+    if not is_authenticated(request):
+        return RedirectResponse(url="/")
+
+    db.set_config("embedding_model", embedding_model.strip())
+    db.set_config("retrieval_top_k", retrieval_top_k.strip())
+    db.set_config("retrieval_min_score", retrieval_min_score.strip())
+    db.set_config("semantic_cache_enabled", semantic_cache_enabled)
+    db.set_config("semantic_cache_threshold", semantic_cache_threshold.strip())
+    db.set_config("semantic_cache_size", semantic_cache_size.strip())
+    db.set_config("vision_cache_mb", vision_cache_mb.strip())
+
+    return RedirectResponse(url="/settings?saved=1", status_code=303)
+
+
+def _knowledge_error(message: str) -> RedirectResponse:
+    return RedirectResponse(url=f"/settings?knowledge_error={quote(message)}", status_code=303)
+
+
+async def _read_upload(file: UploadFile):
+    while chunk := await file.read(documents.READ_CHUNK_BYTES):
+        yield chunk
+
+
+@app.post("/knowledge/upload")
+async def knowledge_upload(request: Request, file: UploadFile = File(...)):
+    if not is_authenticated(request):
+        return RedirectResponse(url="/")
+
+    model = db.get_config('embedding_model', '')
+    if not model:
+        return _knowledge_error("Set an embedding model first.")
+    if not documents.is_text_file(file.filename, file.content_type):
+        return _knowledge_error("Only text files are supported (plain text, Markdown, CSV, JSON, code...).")
+    try:
+        passages = await knowledge.get_knowledge_base().add_document(
+            configure_router(), file.filename or "document", documents.decode_text(_read_upload(file)), model
+        )
+    except (knowledge.KnowledgeError, documents.DocumentError) as e:
+        return _knowledge_error(str(e))
+    except Exception as e:
+        logger.exception("Knowledge base upload failed")
+        return _knowledge_error(f"Embedding failed: {e}")
+    logger.info(f"Added {file.filename} to the knowledge base ({passages} passages)")
+    return RedirectResponse(url="/settings?saved=1", status_code=303)
+
+
+@app.post("/knowledge/delete")
+async def knowledge_delete(request: Request, doc_id: str = Form(...)):
+    if not is_authenticated(request):
+        return RedirectResponse(url="/")
+    await knowledge.get_knowledge_base().remove_document(doc_id)
+    return RedirectResponse(url="/settings?saved=1", status_code=303)
+
+
+@app.post("/knowledge/rebuild")
+async def knowledge_rebuild(request: Request):
+    if not is_authenticated(request):
+        return RedirectResponse(url="/")
+
+    model = db.get_config('embedding_model', '')
+    if not model:
+        return _knowledge_error("Set an embedding model first.")
+    try:
+        await knowledge.get_knowledge_base().rebuild(configure_router(), model)
+    except knowledge.KnowledgeError as e:
+        return _knowledge_error(str(e))
+    except Exception as e:
+        logger.exception("Knowledge base rebuild failed")
+        return _knowledge_error(f"Embedding failed: {e}")
+    return RedirectResponse(url="/settings?saved=1", status_code=303)
+
+
+@app.get("/debug/profile")
+async def debug_profile(request: Request, target: str = "web", seconds: float = 10.0):
+    """Folded stacks for flamegraph.pl or speedscope: sampled live for web, from the bot's profile file for bot."""
+    if not is_authenticated(request):
+        return RedirectResponse(url="/")
+
+    if target == "bot":
+        path = profiling.folded_profile_path("bot")
+        if not os.path.exists(path):
+            return PlainTextResponse("No bot profile yet. Enable the sampling profiler and wait a few seconds.",
+                                     status_code=404)
+        with open(path, encoding="utf-8") as f:
+            return PlainTextResponse(f.read())
+
+    instrumentation = profiling.get_instrumentation()
+    if instrumentation is None:
+        return PlainTextResponse("Instrumentation is not running", status_code=503)
+    seconds = max(1.0, min(seconds, 60.0))
+    folded = await asyncio.to_thread(profiling.profile_thread, instrumentation.loop_thread_id, seconds)
+    return PlainTextResponse(folded)
+
+
+@app.get("/traces", response_class=HTMLResponse)
+async def traces(request: Request, trace_id: str = "", limit: int = 100):
+    if not is_authenticated(request):
+        return RedirectResponse(url="/")
+
+    # The bot process writes the traces; read its JSONL export off the event loop
+    recent = await asyncio.to_thread(tracing.read_traces, max(1, min(limit, 1000)))
+    for trace in recent:
+        trace["time"] = datetime.fromtimestamp(trace["start"]).strftime("%Y-%m-%d %H:%M:%S")
+    selected = next((t for t in recent if t["trace_id"] == trace_id), recent[0] if recent else None)
+
+    spans = []
+    if selected:
+        depth = {}
+        for span in selected["spans"]:
+            depth[span["span_id"]] = depth.get(span["parent_id"], -1) + 1
+            total = selected["duration_ms"] or 1
+            spans.append({
+                **span,
+                "depth": depth[span["span_id"]],
+                "left": 100 * span["offset_ms"] / total,
+                "width": max(0.5, 100 * span["duration_ms"] / total)
+            })
+
+    return templates.TemplateResponse("traces.html", {
+        "request": request,
+        "traces": recent,
+        "selected": selected,
+        "spans": spans
+    })
+
+
 @app.post("/add_user")
 async def add_user(request: Request, user_id: int = Form(...), username: str = Form(None)):
     if not is_authenticated(request):
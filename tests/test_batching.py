@@ -0,0 +1,73 @@
+import asyncio
+from typing import List, Optional
+
+from services.base import AIProvider, ChatResponse, Message, Model
+from services.batching import BatchDispatcher
+from services.router import AIRouter
+
+MESSAGES = [Message(role="user", content="hi")]
+
+
+class CountingProvider(AIProvider):
+    """Answers with a fixed number of tokens; `fail` makes every request raise."""
+
+    def __init__(self, name: str = "fake", max_concurrency: Optional[int] = None, fail: bool = False):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.fail = fail
+        self.calls = 0
+
+    async def chat(self, messages: List[Message], model: str, deadline: Optional[float] = None) -> ChatResponse:
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        if self.fail:
+            raise RuntimeError("down")
+        return ChatResponse(text="a b c", model=model, provider=self.name,
+                            usage={"prompt_tokens": 1, "completion_tokens": 3, "total_tokens": 4})
+
+    async def list_models(self) -> List[Model]:
+        return []
+
+    async def health_check(self) -> bool:
+        return not self.fail
+
+
+def make_dispatcher(provider: AIProvider, max_parallelism: int = 8, on_probe=None) -> BatchDispatcher:
+    router = AIRouter()
+    router._instances[provider.name] = provider
+    router._current_provider = provider.name
+    return BatchDispatcher(router, window=0.0, max_parallelism=max_parallelism, on_probe=on_probe)
+
+
+def test_unprobed_model_defaults_to_max_parallelism():
+    assert make_dispatcher(CountingProvider(), max_parallelism=6).get_parallelism("m") == 6
+
+
+def test_unprobed_model_defaults_to_provider_limit():
+    dispatcher = make_dispatcher(CountingProvider(max_concurrency=3), max_parallelism=6)
+    assert dispatcher.get_parallelism("m") == 3
+
+
+def test_first_request_probes_model_in_background():
+    probed = []
+
+    async def run():
+        dispatcher = make_dispatcher(CountingProvider(), max_parallelism=4,
+                                     on_probe=lambda *args: probed.append(args))
+        await dispatcher.submit(MESSAGES, "m")
+        await asyncio.gather(*dispatcher._probes.values())
+        return dispatcher
+
+    dispatcher = asyncio.run(run())
+    assert dispatcher.is_probed("m")
+    assert probed == [("fake", "m", dispatcher.get_parallelism("m"))]
+
+
+def test_failed_probe_keeps_default_limit():
+    async def run():
+        dispatcher = make_dispatcher(CountingProvider(fail=True), max_parallelism=4)
+        assert await dispatcher.probe("m") is None
+        return dispatcher
+
+    dispatcher = asyncio.run(run())
+    assert not dispatcher.is_probed("m") and dispatcher.get_parallelism("m") == 4
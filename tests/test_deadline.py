@@ -0,0 +1,47 @@
+import asyncio
+import time
+
+import pytest
+
+from services.base import request_timeout, stream_with_deadline
+
+
+async def ticks(delay: float, closed: list):
+    try:
+        for i in range(5):
+            await asyncio.sleep(delay)
+            yield i
+    finally:
+        closed.append(True)
+
+
+async def drain(chunks):
+    return [chunk async for chunk in chunks]
+
+
+def test_request_timeout_uses_default_without_deadline():
+    assert request_timeout(None, 120.0) == 120.0
+
+
+def test_request_timeout_raises_once_deadline_passed():
+    with pytest.raises(asyncio.TimeoutError):
+        request_timeout(time.monotonic() - 1, 120.0)
+    assert 0 < request_timeout(time.monotonic() + 5, 120.0) <= 5
+
+
+def test_stream_without_deadline_yields_everything():
+    closed = []
+    assert asyncio.run(drain(stream_with_deadline(ticks(0, closed), None))) == [0, 1, 2, 3, 4]
+    assert closed
+
+
+def test_stream_times_out_and_closes():
+    closed, seen = [], []
+
+    async def run():
+        async for chunk in stream_with_deadline(ticks(0.05, closed), time.monotonic() + 0.12):
+            seen.append(chunk)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(run())
+    assert seen == [0, 1] and closed
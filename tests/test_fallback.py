@@ -0,0 +1,178 @@
+import asyncio
+import time
+from typing import List, Optional
+
+import pytest
+
+from services.base import AIProvider, ChatResponse, Message, Model, with_deadline
+from services.fallback import CircuitBreaker, FallbackHop, FallbackPolicy, parse_fallback_chain
+from services.router import AIRouter
+
+MESSAGES = [Message(role="user", content="hi")]
+
+
+class FakeProvider(AIProvider):
+    """Answers after `delay` seconds, or raises `error`; honours the deadline like the real providers."""
+
+    def __init__(self, name: str, delay: float = 0.0, error: Optional[Exception] = None):
+        self.name = name
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    async def chat(self, messages: List[Message], model: str, deadline: Optional[float] = None) -> ChatResponse:
+        self.calls += 1
+        await with_deadline(asyncio.sleep(self.delay), deadline)
+        if self.error:
+            raise self.error
+        return ChatResponse(text=f"{self.name}:{model}", model=model, provider=self.name)
+
+    async def list_models(self) -> List[Model]:
+        return []
+
+    async def health_check(self) -> bool:
+        return self.error is None
+
+
+def make_router(providers, hops, timeout=5.0, hedge_after=None, failure_threshold=1, reset_timeout=60.0):
+    router = AIRouter()
+    router._instances.update({p.name: p for p in providers})
+    router._current_provider = providers[0].name
+    router.set_fallback_policy(FallbackPolicy(
+        hops=[FallbackHop(provider, model, timeout) for provider, model in hops], timeout=timeout,
+        hedge_after=hedge_after, failure_threshold=failure_threshold, reset_timeout=reset_timeout
+    ))
+    return router
+
+
+def half_open(breaker: CircuitBreaker):
+    breaker.record_failure()
+    breaker.opened_at = time.monotonic() - breaker.reset_timeout
+
+
+def test_breaker_opens_after_threshold_and_closes_on_success():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.is_open and not breaker.allow()
+    breaker.record_success()
+    assert not breaker.is_open and breaker.allow()
+
+
+def test_breaker_half_open_allows_a_single_trial():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    half_open(breaker)
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.release()
+    assert breaker.allow()
+
+
+def test_parse_fallback_chain_keeps_model_tags():
+    hops = parse_fallback_chain("# comment\nollama:llama3:8b 5\nlm_studio:qwen\nbroken\n", 30.0)
+    assert hops == [FallbackHop("ollama", "llama3:8b", 5.0), FallbackHop("lm_studio", "qwen", 30.0)]
+
+
+def test_falls_back_when_primary_fails():
+    primary, backup = FakeProvider("a", error=RuntimeError("down")), FakeProvider("b")
+    router = make_router([primary, backup], [("b", "m2")])
+    response = asyncio.run(router.chat(MESSAGES, "m1"))
+    assert response.text == "b:m2"
+    assert router.get_breaker("a").is_open
+
+
+def test_open_breaker_skips_hop_but_keeps_real_error():
+    primary, backup = FakeProvider("a", error=RuntimeError("down")), FakeProvider("b")
+    router = make_router([primary, backup], [("b", "m2")])
+    router.get_breaker("b").record_failure()
+    with pytest.raises(RuntimeError, match="down"):
+        asyncio.run(router.chat(MESSAGES, "m1"))
+    assert backup.calls == 0
+
+
+def test_all_breakers_open():
+    router = make_router([FakeProvider("a"), FakeProvider("b")], [("b", "m2")])
+    router.get_breaker("a").record_failure()
+    router.get_breaker("b").record_failure()
+    with pytest.raises(RuntimeError, match="All AI backends are failing"):
+        asyncio.run(router.chat(MESSAGES, "m1"))
+
+
+def test_half_open_trial_not_spent_when_primary_answers():
+    primary, backup = FakeProvider("a"), FakeProvider("b")
+    router = make_router([primary, backup], [("b", "m2")])
+    half_open(router.get_breaker("b"))
+    asyncio.run(router.chat(MESSAGES, "m1"))
+    assert backup.calls == 0
+    # The recovering backend still has its trial for the next request that needs it
+    assert router.get_breaker("b").allow()
+
+
+def test_second_hop_on_same_provider_gets_tried_after_trial_succeeds():
+    primary = FakeProvider("a", error=RuntimeError("down"))
+    backup = FakeProvider("b")
+    router = make_router([primary, backup], [("b", "m2"), ("b", "m3")])
+    half_open(router.get_breaker("b"))
+    response = asyncio.run(router.chat(MESSAGES, "m1"))
+    assert response.text == "b:m2"
+    assert not router.get_breaker("b").is_open
+
+
+def test_request_deadline_does_not_open_breaker():
+    slow, backup = FakeProvider("a", delay=1.0), FakeProvider("b")
+    router = make_router([slow, backup], [("b", "m2")])
+
+    async def run():
+        return await router.chat(MESSAGES, "m1", deadline=time.monotonic() + 0.05)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(run())
+    assert not router.get_breaker("a").is_open
+    assert backup.calls == 0
+
+
+def test_hop_timeout_counts_as_failure():
+    slow, backup = FakeProvider("a", delay=1.0), FakeProvider("b")
+    router = make_router([slow, backup], [("b", "m2")], timeout=0.05)
+    response = asyncio.run(router.chat(MESSAGES, "m1", deadline=time.monotonic() + 5))
+    assert response.text == "b:m2"
+    assert router.get_breaker("a").is_open
+
+
+def test_hedge_starts_secondary_when_primary_is_slow():
+    slow, fast = FakeProvider("a", delay=1.0), FakeProvider("b")
+    router = make_router([slow, fast], [("b", "m2")], hedge_after=0.05)
+    started = time.monotonic()
+    response = asyncio.run(router.chat(MESSAGES, "m1"))
+    assert response.text == "b:m2"
+    assert time.monotonic() - started < 0.5
+    # The cancelled primary wasn't at fault
+    assert not router.get_breaker("a").is_open
+
+
+def test_no_hedge_when_primary_is_fast():
+    fast, other = FakeProvider("a"), FakeProvider("b")
+    router = make_router([fast, other], [("b", "m2")], hedge_after=0.5)
+    assert asyncio.run(router.chat(MESSAGES, "m1")).text == "a:m1"
+    assert other.calls == 0
+
+
+def test_hedge_moves_on_when_primary_fails_early():
+    failing, backup = FakeProvider("a", error=RuntimeError("down")), FakeProvider("b")
+    router = make_router([failing, backup], [("b", "m2")], hedge_after=5.0)
+    started = time.monotonic()
+    assert asyncio.run(router.chat(MESSAGES, "m1")).text == "b:m2"
+    assert time.monotonic() - started < 1.0
+
+
+def test_policy_change_reconfigures_existing_breakers():
+    router = make_router([FakeProvider("a")], [], failure_threshold=3, reset_timeout=60.0)
+    breaker = router.get_breaker("a")
+    breaker.record_failure()
+    breaker.record_failure()
+    assert not breaker.is_open
+    router.set_fallback_policy(FallbackPolicy(failure_threshold=2, reset_timeout=5.0))
+    assert breaker.is_open and breaker.reset_timeout == 5.0
+    router.set_fallback_policy(FallbackPolicy(failure_threshold=5))
+    assert not breaker.is_open and breaker.failure_threshold == 5
@@ -0,0 +1,70 @@
+import asyncio
+
+from job_queue import JobQueue, JobStore
+
+
+def make_queue(tmp_path, processed):
+    async def process(payload):
+        processed.append(payload)
+        return payload["n"]
+
+    async def healthy():
+        return True
+
+    async def on_failure(payload, error):
+        pass
+
+    return JobQueue(process, healthy, on_failure, JobStore(str(tmp_path / "jobs.db")))
+
+
+def test_job_runs_and_is_removed(tmp_path):
+    processed = []
+
+    async def run():
+        queue = make_queue(tmp_path, processed)
+        queue.start(1)
+        try:
+            ticket = await queue.submit("chat", {"n": 1})
+            return await asyncio.wait_for(queue.wait(ticket), 5), queue.store.counts()
+        finally:
+            await queue.stop()
+
+    assert asyncio.run(run()) == (1, {})
+    assert processed == [{"n": 1}]
+
+
+def test_cancel_pending_job_removes_it(tmp_path):
+    processed = []
+
+    async def run():
+        queue = make_queue(tmp_path, processed)
+        ticket = await queue.submit("chat", {"n": 1})
+        await queue.cancel(ticket)
+        return queue.store.counts(), queue._cancelled
+
+    assert asyncio.run(run()) == ({}, set())
+    assert processed == []
+
+
+def test_cancel_racing_a_claim_drops_the_job(tmp_path):
+    processed = []
+
+    async def run():
+        queue = make_queue(tmp_path, processed)
+        ticket = await queue.submit("chat", {"n": 1})
+        # A worker has claimed the row but not started it yet; a zero lease lets the worker below reclaim it
+        assert queue.store.claim("other", lease=0).ticket == ticket
+        await queue.cancel(ticket)
+        assert queue.store.counts() == {"running": 1}
+        queue.start(1)
+        try:
+            for _ in range(50):
+                if not queue.store.counts():
+                    break
+                await asyncio.sleep(0.05)
+            return queue.store.counts(), queue._cancelled
+        finally:
+            await queue.stop()
+
+    assert asyncio.run(run()) == ({}, set())
+    assert processed == []
@@ -0,0 +1,32 @@
+import pytest
+
+from services.registry import BUILTIN_PROVIDERS, ProviderRegistry
+
+
+class NotAProvider:
+    pass
+
+
+def test_plugin_cannot_replace_builtin_provider():
+    registry = ProviderRegistry()
+    registry.register_from_config("ollama = collections:OrderedDict\nmine = services.ollama:OllamaProvider")
+    assert registry._targets["ollama"] == BUILTIN_PROVIDERS["ollama"]
+    assert registry._targets["mine"] == "services.ollama:OllamaProvider"
+
+
+def test_target_that_is_not_a_provider_is_skipped():
+    registry = ProviderRegistry()
+    registry.register_from_config("bad = collections:OrderedDict")
+    with pytest.raises(TypeError):
+        registry.get_class("bad")
+    assert "bad" not in registry
+    # Saved settings are applied again on every request; the rejected target stays out
+    registry.register_from_config("bad = collections:OrderedDict")
+    assert "bad" not in registry
+
+
+def test_class_targets_are_checked_too():
+    registry = ProviderRegistry()
+    registry.register("plain", NotAProvider)
+    with pytest.raises(TypeError):
+        registry.get_class("plain")
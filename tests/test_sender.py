@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+from aiogram.exceptions import TelegramBadRequest
+
+from sender import SendPipeline, split_message
+
+
+def balanced(chunk: str) -> bool:
+    inline = chunk.replace("```", "")
+    return chunk.count("```") % 2 == 0 and all(line.count("`") % 2 == 0 for line in inline.split("\n"))
+
+
+def test_plain_split_respects_limit():
+    assert split_message("a" * 9000) == ["a" * 4096, "a" * 4096, "a" * 808]
+    parts = split_message(("word " * 300 + "\n\n") * 10)
+    assert all(len(p) <= 4096 for p in parts)
+
+
+def test_markup_split_keeps_entities_whole():
+    text = "*Models:*\n" + "\n".join(f"- `model-{i:04d}-with-a-long-name`" for i in range(400))
+    parts = split_message(text, markup=True)
+    assert len(parts) > 1
+    assert all(len(p) <= 4096 and balanced(p) for p in parts)
+
+
+def test_markup_split_reopens_long_code_blocks():
+    text = "intro\n```python\n" + "\n".join(f"x = {i}" for i in range(3000)) + "\n```\nbye"
+    parts = split_message(text, markup=True)
+    assert all(len(p) <= 4096 and balanced(p) for p in parts)
+    assert "".join(parts).count("x = ") == 3000
+
+
+class FakeBot:
+    id = 1
+
+    def __init__(self, error: str = "can't parse entities"):
+        self.error = error
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if kwargs.get("parse_mode") or self.error == "chat not found":
+            raise TelegramBadRequest(method=None, message=self.error)
+        self.sent.append((text, kwargs))
+
+
+def test_rejected_markup_is_resent_as_plain_text():
+    bot = FakeBot()
+
+    async def run():
+        await SendPipeline(chat_rate=100).send(bot, 1, "broken *bold", parse_mode="Markdown", reply_to_message_id=5)
+
+    asyncio.run(run())
+    assert bot.sent == [("broken *bold", {"reply_to_message_id": 5})]
+
+
+def test_bad_request_without_markup_is_raised():
+    bot = FakeBot("chat not found")
+
+    async def run():
+        await SendPipeline(chat_rate=100).send(bot, 1, "hello")
+
+    with pytest.raises(TelegramBadRequest):
+        asyncio.run(run())
+    assert bot.sent == []